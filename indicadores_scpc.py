@@ -2,205 +2,828 @@ import schedule
 import time
 import threading
 import streamlit as st
+from streamlit import runtime
 import xlsxwriter
 import os
+import sys
+import argparse
 import re
 import json
+import gzip
 import hashlib
+import hmac
+import struct
+import shutil
+import tempfile
 import pandas as pd
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from decimal import Decimal
 import base64
-from io import BytesIO
+from io import BytesIO, StringIO, BufferedReader, RawIOBase
 import plotly.express as px
+import plotly.io as pio
 import locale
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 from pathlib import Path
-from sympy import symbols, sympify, SympifyError
+from sympy import Symbol, sympify, lambdify, SympifyError
 from streamlit_scroll_to_top import scroll_to_here
+try:
+    import zstandard # Opcional: compressão zstd dos backups (sem ele, os backups usam gzip)
+except ImportError:
+    zstandard = None
 
 # --- Importações e configurações do PostgreSQL ---
 import psycopg2
 from psycopg2 import sql
-from psycopg2.extras import Json # Para lidar com JSONB
+from psycopg2.extras import Json, execute_values # Json para lidar com JSONB
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import PoolError
 
 KEY_FILE = "secret.key"
 
+# Parâmetros de conexão. Os valores padrão são os de produção; podem ser sobrescritos por variáveis de ambiente.
+DB_CONFIG = {
+    "host": os.environ.get("SCPC_DB_HOST", "localhost"),
+    "port": int(os.environ.get("SCPC_DB_PORT", "5432")),
+    "database": os.environ.get("SCPC_DB_NAME", "scpc_indicadores"),
+    "user": os.environ.get("SCPC_DB_USER", "streamlit"),
+    "password": os.environ.get("SCPC_DB_PASSWORD", "6105/*"),
+}
+
+# Parâmetros do pool de conexões (tempos em segundos)
+DB_POOL_CONFIG = {
+    "minconn": int(os.environ.get("SCPC_DB_POOL_MIN", "1")),
+    "maxconn": int(os.environ.get("SCPC_DB_POOL_MAX", "10")),
+    "checkout_timeout": float(os.environ.get("SCPC_DB_POOL_TIMEOUT", "10")),
+    "idle_timeout": float(os.environ.get("SCPC_DB_POOL_IDLE_TIMEOUT", "300")),
+    "health_check_interval": float(os.environ.get("SCPC_DB_POOL_HEALTH_CHECK", "30")),
+}
+
+# --- Pool de Conexões do PostgreSQL ---
+
+class PooledConnection:
+    """
+    Envolve uma conexão psycopg2 emprestada do pool.
+    Todos os atributos são delegados à conexão real; close() devolve a conexão ao pool
+    em vez de encerrá-la, de modo que o padrão `finally: conn.close()` continua válido.
+    """
+
+    def __init__(self, pool, raw_conn):
+        self._pool = pool
+        self._raw = raw_conn
+        self._checked_out_at = time.monotonic()
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        # Atributos internos ficam no proxy; os demais (ex.: autocommit) são aplicados à conexão real
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._raw, name, value)
+
+    @property
+    def closed(self):
+        # Após devolvida ao pool, a conexão é considerada fechada para quem a emprestou
+        return 1 if self._released else self._raw.closed
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._pool.putconn(self._raw, held_for=time.monotonic() - self._checked_out_at)
+
+
+class DBConnectionPool:
+    """
+    Pool de conexões thread-safe compartilhado por todo o processo.
+    - Mantém entre `minconn` e `maxconn` conexões abertas;
+    - Bloqueia até `checkout_timeout` segundos quando todas estão em uso;
+    - Verifica a conexão (SELECT 1) no empréstimo se ela ficou ociosa mais que `health_check_interval`;
+    - Fecha conexões ociosas há mais de `idle_timeout` (mantendo o mínimo).
+    """
+
+    def __init__(self, dsn_params, minconn=1, maxconn=10, checkout_timeout=10.0,
+                 idle_timeout=300.0, health_check_interval=30.0):
+        self._dsn_params = dict(dsn_params)
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.checkout_timeout = checkout_timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._idle = []  # Lista de (conexão, instante em que ficou ociosa)
+        self._in_use = 0
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "connections_created": 0,
+            "connections_closed": 0,
+            "health_check_failures": 0,
+            "total_wait_time": 0.0,
+            "max_wait_time": 0.0,
+            "total_checkout_latency": 0.0,
+            "max_checkout_latency": 0.0,
+            "total_hold_time": 0.0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._dsn_params)
+        self._stats["connections_created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            if not conn.closed:
+                conn.close()
+        except Exception:
+            pass
+        self._stats["connections_closed"] += 1
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _prune_idle(self):
+        """Fecha conexões ociosas além do tempo limite. Deve ser chamada com o lock adquirido."""
+        now = time.monotonic()
+        total = self._in_use + len(self._idle)
+        keep = []
+        for conn, idle_since in self._idle:
+            if now - idle_since > self.idle_timeout and total > self.minconn:
+                self._discard(conn)
+                total -= 1
+            else:
+                keep.append((conn, idle_since))
+        self._idle = keep
+
+    def getconn(self):
+        """Empresta uma conexão do pool. Levanta PoolError se o tempo de espera esgotar."""
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        waited = 0.0
+        raw = None
+        with self._cond:
+            self._prune_idle()
+            while True:
+                if self._idle:
+                    raw, idle_since = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use + len(self._idle) < self.maxconn:
+                    self._in_use += 1
+                    idle_since = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolError(f"Tempo de espera esgotado ({self.checkout_timeout}s) aguardando conexão livre no pool.")
+                wait_started = time.monotonic()
+                self._cond.wait(remaining)
+                waited += time.monotonic() - wait_started
+
+        # Conexão e verificação de saúde fora do lock para não bloquear outras threads
+        try:
+            if raw is not None and not self._is_healthy(raw, idle_since):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                    self._discard(raw)
+                raw = None
+            if raw is None:
+                raw = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        latency = time.monotonic() - started
+        with self._cond:
+            self._stats["checkouts"] += 1
+            if waited > 0:
+                self._stats["waits"] += 1
+            self._stats["total_wait_time"] += waited
+            self._stats["max_wait_time"] = max(self._stats["max_wait_time"], waited)
+            self._stats["total_checkout_latency"] += latency
+            self._stats["max_checkout_latency"] = max(self._stats["max_checkout_latency"], latency)
+        return PooledConnection(self, raw)
+
+    def putconn(self, raw, held_for=0.0):
+        """Devolve uma conexão ao pool, descartando-a se estiver quebrada."""
+        reusable = not raw.closed
+        if reusable:
+            try:
+                # Garante que a próxima sessão não herde uma transação aberta ou abortada
+                if raw.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    raw.rollback()
+                if raw.autocommit:
+                    raw.autocommit = False
+            except psycopg2.Error:
+                reusable = False
+        with self._cond:
+            self._in_use -= 1
+            self._stats["total_hold_time"] += held_for
+            if reusable:
+                self._idle.append((raw, time.monotonic()))
+            else:
+                self._discard(raw)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+
+    def stats(self):
+        """Retorna um retrato das estatísticas do pool (tempos em milissegundos)."""
+        with self._cond:
+            s = dict(self._stats)
+            checkouts = s["checkouts"] or 1
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "em_uso": self._in_use,
+                "ociosas": len(self._idle),
+                "abertas": self._in_use + len(self._idle),
+                "emprestimos": s["checkouts"],
+                "emprestimos_com_espera": s["waits"],
+                "timeouts": s["timeouts"],
+                "conexoes_criadas": s["connections_created"],
+                "conexoes_fechadas": s["connections_closed"],
+                "falhas_health_check": s["health_check_failures"],
+                "espera_media_ms": s["total_wait_time"] / checkouts * 1000,
+                "espera_max_ms": s["max_wait_time"] * 1000,
+                "latencia_emprestimo_media_ms": s["total_checkout_latency"] / checkouts * 1000,
+                "latencia_emprestimo_max_ms": s["max_checkout_latency"] * 1000,
+                "uso_medio_ms": s["total_hold_time"] / checkouts * 1000,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_db_pool():
+    """
+    Retorna o pool de conexões do processo.
+    st.cache_resource garante uma única instância por processo, sobrevivendo aos reruns do Streamlit.
+    """
+    return DBConnectionPool(DB_CONFIG, **DB_POOL_CONFIG)
+
+
+def get_db_pool_stats():
+    """Retorna as estatísticas do pool de conexões."""
+    return get_db_pool().stats()
+
+
+# --- Cache de Dados por Versão de Tabela ---
+
+# Tempo máximo (segundos) que um snapshot em cache é reutilizado, mesmo sem escrita conhecida.
+# Limita a defasagem quando o banco é alterado por outro processo.
+DATA_CACHE_TTL = int(os.environ.get("SCPC_CACHE_TTL", "300"))
+
+# Tabelas cujas versões são controladas pelo cache
+DATA_TABLES = ("usuarios", "usuario_setores", "indicadores", "resultados", "indicator_summary", "configuracoes",
+               "log_backup", "log_indicadores", "log_usuarios")
+
+
+class DataVersions:
+    """
+    Contadores de versão por tabela, compartilhados pelo processo.
+    Toda escrita incrementa a versão das tabelas alteradas; os snapshots em cache usam a versão
+    como parte da chave, de modo que uma escrita invalida imediatamente os snapshots afetados.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def get(self, *tables):
+        with self._lock:
+            return tuple(self._versions.get(table, 0) for table in tables)
+
+    def bump(self, *tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+
+@st.cache_resource(show_spinner=False)
+def get_data_versions():
+    """Retorna os contadores de versão das tabelas (uma instância por processo)."""
+    return DataVersions()
+
+
+def get_data_version(*tables):
+    """Retorna a versão atual das tabelas informadas, usada como chave dos snapshots em cache."""
+    return get_data_versions().get(*tables)
+
+
+def invalidate_data_cache(*tables):
+    """Invalida os snapshots em cache que dependem das tabelas informadas. Chamar após cada commit de escrita."""
+    get_data_versions().bump(*tables)
+
+
 # --- Funções de Conexão e Criação de Tabelas do PostgreSQL ---
 
+# Falhas de acesso ao banco contadas por thread. Os carregadores devolvem um valor de fallback ([] / {} / None)
+# em caso de erro; os snapshots em cache (_load_or_raise) usam o contador para não memorizar esse fallback.
+_db_errors = threading.local()
+
+
+def _note_db_error():
+    """Registra uma falha de acesso ao banco na thread atual (ver _load_or_raise)."""
+    _db_errors.count = getattr(_db_errors, "count", 0) + 1
+
+
+def _db_error_count():
+    return getattr(_db_errors, "count", 0)
+
+
 def get_db_connection():
     """
-    Estabelece e retorna uma conexão com o banco de dados PostgreSQL.
+    Empresta uma conexão do pool de conexões do PostgreSQL.
+    A conexão deve ser devolvida com conn.close() (normalmente no bloco finally).
     """
     try:
-        # --- ATENÇÃO: Credenciais hardcoded. Considerar usar variáveis de ambiente ou arquivo de config seguro ---
-        conn = psycopg2.connect(
-            host="localhost",
-            database="scpc_indicadores",
-            user="streamlit",
-            password="6105/*"
-        )
-        return conn
+        return get_db_pool().getconn()
     except psycopg2.Error as e:
+        _note_db_error()
         print(f"Erro ao conectar ao banco de dados: {e}")
         # Em uma aplicação Streamlit, você pode querer usar st.error aqui
         # st.error(f"Erro ao conectar ao banco de dados: {e}")
         return None
 
-def create_tables_if_not_exists():
+# --- Migrações de Esquema do PostgreSQL ---
+# O esquema é versionado na tabela schema_version. Cada migração é aplicada uma única vez, em ordem.
+# Migrações "online" (ex.: CREATE INDEX CONCURRENTLY) não podem rodar dentro de uma transação e não
+# bloqueiam leituras/escritas; elas rodam em segundo plano após as migrações bloqueantes, para não
+# atrasar a renderização das páginas. Migrações online não podem ser pré-requisito de migrações bloqueantes.
+# Para adicionar uma alteração de esquema, acrescente uma nova entrada ao final de SCHEMA_MIGRATIONS.
+
+# Chaves de pg_advisory_lock que serializam as migrações entre processos
+SCHEMA_MIGRATION_LOCK_ID = 7421001
+SCHEMA_ONLINE_MIGRATION_LOCK_ID = 7421002
+
+# Recalcula as linhas de indicator_summary (uma por indicador) a partir de indicadores e resultados.
+# Mesmas regras de compute_indicator_analytics: status respeitando `comparacao` (nula = "Maior é melhor"),
+# variação vs meta em % (±infinito com meta zero) e resultado nulo lido como 0, como em _result_row_to_dict.
+# {where} restringe os indicadores recalculados (ver refresh_indicator_summary); é sempre informado, pois um
+# SELECT terminado no FROM seguido de ON CONFLICT é ambíguo para o parser.
+INDICATOR_SUMMARY_REFRESH_SQL = """
+    INSERT INTO indicator_summary (indicator_id, ultimo_resultado, data_referencia, resultado_anterior,
+                                   num_resultados, status, variacao, atualizado_em)
+    SELECT i.id, u.ultimo, u.data_referencia, u.anterior, u.num_resultados,
+           CASE
+               WHEN u.num_resultados = 0 THEN 'Sem Resultados'
+               WHEN COALESCE(i.comparacao, 'Maior é melhor') = 'Maior é melhor' AND u.ultimo >= COALESCE(i.meta, 0) THEN 'Acima da Meta'
+               WHEN i.comparacao = 'Menor é melhor' AND u.ultimo <= COALESCE(i.meta, 0) THEN 'Acima da Meta'
+               WHEN COALESCE(i.comparacao, 'Maior é melhor') IN ('Maior é melhor', 'Menor é melhor') THEN 'Abaixo da Meta'
+               ELSE 'N/A'
+           END,
+           CASE
+               WHEN u.num_resultados = 0 THEN 0
+               WHEN COALESCE(i.meta, 0) <> 0 THEN
+                   ((u.ultimo / i.meta - 1) * 100)::double precision * (CASE WHEN i.comparacao = 'Menor é melhor' THEN -1 ELSE 1 END)
+               WHEN u.ultimo > 0 THEN 'Infinity'::double precision
+               WHEN u.ultimo < 0 THEN '-Infinity'::double precision
+               ELSE 0
+           END,
+           CURRENT_TIMESTAMP
+    FROM indicadores i
+    CROSS JOIN LATERAL (
+        SELECT COUNT(*) AS num_resultados,
+               MAX(r.data_referencia) AS data_referencia,
+               (ARRAY_AGG(COALESCE(r.resultado, 0) ORDER BY r.data_referencia DESC))[1] AS ultimo,
+               (ARRAY_AGG(COALESCE(r.resultado, 0) ORDER BY r.data_referencia DESC))[2] AS anterior
+        FROM resultados r
+        WHERE r.indicator_id = i.id
+    ) u
+    {where}
+    ON CONFLICT (indicator_id) DO UPDATE
+    SET ultimo_resultado = EXCLUDED.ultimo_resultado,
+        data_referencia = EXCLUDED.data_referencia,
+        resultado_anterior = EXCLUDED.resultado_anterior,
+        num_resultados = EXCLUDED.num_resultados,
+        status = EXCLUDED.status,
+        variacao = EXCLUDED.variacao,
+        atualizado_em = EXCLUDED.atualizado_em;
+"""
+
+SCHEMA_MIGRATIONS = [
+    {
+        "version": 1,
+        "descricao": "Esquema inicial",
+        "online": False,
+        "statements": [
+            # usuarios (a coluna 'setor' antiga foi substituída pela tabela usuario_setores)
+            """
+            CREATE TABLE IF NOT EXISTS usuarios (
+                username TEXT PRIMARY KEY,
+                password_hash TEXT NOT NULL,
+                tipo TEXT NOT NULL, -- 'Administrador', 'Operador', 'Visualizador'
+                nome_completo TEXT, -- Permite NULL
+                email TEXT, -- Permite NULL
+                data_criacao TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            # usuario_setores (ligação para múltiplos setores por usuário)
+            """
+            CREATE TABLE IF NOT EXISTS usuario_setores (
+                username TEXT REFERENCES usuarios(username) ON DELETE CASCADE,
+                setor TEXT NOT NULL,
+                PRIMARY KEY (username, setor)
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS indicadores (
+                id TEXT PRIMARY KEY,
+                nome TEXT NOT NULL UNIQUE,
+                objetivo TEXT,
+                formula TEXT,
+                variaveis JSONB,
+                unidade TEXT,
+                meta NUMERIC(10, 2),
+                comparacao TEXT,
+                tipo_grafico TEXT,
+                responsavel TEXT, -- Responsável ainda é um único setor para o indicador
+                data_criacao TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                data_atualizacao TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS resultados (
+                indicator_id TEXT NOT NULL,
+                data_referencia TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                resultado NUMERIC(10, 2),
+                valores_variaveis JSONB,
+                observacao TEXT,
+                analise_critica JSONB,
+                data_criacao TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                data_atualizacao TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                usuario TEXT,
+                status_analise TEXT,
+                PRIMARY KEY (indicator_id, data_referencia),
+                FOREIGN KEY (indicator_id) REFERENCES indicadores(id) ON DELETE CASCADE
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS configuracoes (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS log_backup (
+                id SERIAL PRIMARY KEY,
+                timestamp TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                action TEXT,
+                file_name TEXT,
+                user_performed TEXT
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS log_indicadores (
+                id SERIAL PRIMARY KEY,
+                timestamp TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                action TEXT,
+                indicator_id TEXT,
+                user_performed TEXT
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS log_usuarios (
+                id SERIAL PRIMARY KEY,
+                timestamp TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                action TEXT,
+                username_affected TEXT,
+                user_performed TEXT
+            );
+            """,
+        ],
+    },
+    {
+        "version": 2,
+        "descricao": "Índice resultados(indicator_id, data_referencia DESC)",
+        "online": True,
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_resultados_indicador_data
+            ON resultados (indicator_id, data_referencia DESC);
+            """,
+        ],
+    },
+    {
+        "version": 3,
+        "descricao": "Restrições de domínio em usuarios.tipo, indicadores.comparacao e indicadores.tipo_grafico",
+        "online": False,
+        # NOT VALID: as restrições valem para novas linhas sem varrer (nem bloquear) as tabelas existentes
+        "statements": [
+            """
+            ALTER TABLE usuarios ADD CONSTRAINT usuarios_tipo_check
+            CHECK (tipo IN ('Administrador', 'Operador', 'Visualizador')) NOT VALID;
+            """,
+            """
+            ALTER TABLE indicadores ADD CONSTRAINT indicadores_comparacao_check
+            CHECK (comparacao IS NULL OR comparacao IN ('Maior é melhor', 'Menor é melhor')) NOT VALID;
+            """,
+            """
+            ALTER TABLE indicadores ADD CONSTRAINT indicadores_tipo_grafico_check
+            CHECK (tipo_grafico IS NULL OR tipo_grafico IN ('Linha', 'Barra', 'Pizza', 'Área', 'Dispersão')) NOT VALID;
+            """,
+        ],
+    },
+    {
+        "version": 4,
+        "descricao": "Índices indicadores(responsavel) e log_*(timestamp DESC, id DESC) para a paginação por keyset",
+        "online": True,
+        "statements": [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_indicadores_responsavel ON indicadores (responsavel);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_log_backup_timestamp_id ON log_backup (timestamp DESC, id DESC);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_log_indicadores_timestamp_id ON log_indicadores (timestamp DESC, id DESC);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_log_usuarios_timestamp_id ON log_usuarios (timestamp DESC, id DESC);",
+        ],
+    },
+    {
+        "version": 5,
+        "descricao": "Tabela indicator_summary (último resultado, status e variação por indicador)",
+        "online": False,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS indicator_summary (
+                indicator_id TEXT PRIMARY KEY REFERENCES indicadores(id) ON DELETE CASCADE,
+                ultimo_resultado NUMERIC(10, 2),
+                data_referencia TIMESTAMP WITHOUT TIME ZONE,
+                resultado_anterior NUMERIC(10, 2),
+                num_resultados INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL, -- 'Acima da Meta', 'Abaixo da Meta', 'Sem Resultados', 'N/A'
+                variacao DOUBLE PRECISION NOT NULL DEFAULT 0, -- % vs meta; ±Infinity com meta zero
+                atualizado_em TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            INDICATOR_SUMMARY_REFRESH_SQL.format(where="WHERE TRUE"),
+        ],
+    },
+    {
+        "version": 6,
+        "descricao": "Índices trigram (pg_trgm) em indicadores(nome) e indicadores(responsavel) para a busca com ILIKE",
+        "online": True,
+        "statements": [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_indicadores_nome_trgm ON indicadores USING gin (nome gin_trgm_ops);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_indicadores_responsavel_trgm ON indicadores USING gin (responsavel gin_trgm_ops);",
+        ],
+    },
+    {
+        "version": 7,
+        "descricao": "Tabela backup_exclusoes (chaves das linhas excluídas, para os backups incrementais)",
+        "online": False,
+        # Os gatilhos não disparam na restauração, que roda com session_replication_role = 'replica'
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS backup_exclusoes (
+                id BIGSERIAL PRIMARY KEY,
+                tabela TEXT NOT NULL,
+                chave JSONB NOT NULL, -- {coluna: valor} da chave primária da linha excluída
+                excluido_em TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_backup_exclusoes_tabela_excluido_em ON backup_exclusoes (tabela, excluido_em);",
+            """
+            CREATE OR REPLACE FUNCTION registrar_exclusao() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO backup_exclusoes (tabela, chave)
+                SELECT TG_TABLE_NAME, jsonb_object_agg(coluna, to_jsonb(OLD) -> coluna) FROM unnest(TG_ARGV) AS coluna;
+                RETURN OLD;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+            "CREATE TRIGGER trg_indicadores_exclusao AFTER DELETE ON indicadores FOR EACH ROW EXECUTE PROCEDURE registrar_exclusao('id');",
+            "CREATE TRIGGER trg_resultados_exclusao AFTER DELETE ON resultados FOR EACH ROW EXECUTE PROCEDURE registrar_exclusao('indicator_id', 'data_referencia');",
+            "CREATE TRIGGER trg_log_backup_exclusao AFTER DELETE ON log_backup FOR EACH ROW EXECUTE PROCEDURE registrar_exclusao('id');",
+            "CREATE TRIGGER trg_log_indicadores_exclusao AFTER DELETE ON log_indicadores FOR EACH ROW EXECUTE PROCEDURE registrar_exclusao('id');",
+            "CREATE TRIGGER trg_log_usuarios_exclusao AFTER DELETE ON log_usuarios FOR EACH ROW EXECUTE PROCEDURE registrar_exclusao('id');",
+        ],
+    },
+]
+
+
+def _seed_default_data(cur):
+    """Cria o usuário administrador padrão e as configurações padrão, se ainda não existirem."""
+    # Verificar se o usuário admin já existe
+    cur.execute("SELECT COUNT(*) FROM usuarios WHERE username = 'admin';")
+    admin_exists = cur.fetchone()[0] > 0
+
+    # Se o admin não existir, criar um usuário admin padrão e associá-lo ao setor "Todos" (logicamente)
+    if not admin_exists:
+        # Defina aqui o usuário e senha padrão para o primeiro acesso
+        admin_username = "admin"
+        admin_password = "admin123"  # Você pode alterar para a senha que preferir
+
+        # Gerar hash da senha
+        admin_password_hash = hashlib.sha256(admin_password.encode()).hexdigest()
+
+        # Inserir o usuário admin
+        cur.execute("""
+            INSERT INTO usuarios (username, password_hash, tipo, nome_completo, email)
+            VALUES (%s, %s, %s, %s, %s);
+        """, (admin_username, admin_password_hash, "Administrador", "Administrador do Sistema", "admin@example.com"))
+
+        # Associar o admin ao setor "Todos" na nova tabela (para consistência, embora admin ignore setores)
+        cur.execute("""
+            INSERT INTO usuario_setores (username, setor)
+            VALUES (%s, %s)
+            ON CONFLICT (username, setor) DO NOTHING;
+        """, (admin_username, "Todos"))
+
+        print(f"Usuário administrador padrão criado. Username: {admin_username}, Senha: {admin_password}")
+
+    # Inserir configurações padrão se a tabela estiver vazia
+    cur.execute("SELECT COUNT(*) FROM configuracoes;")
+    if cur.fetchone()[0] == 0:
+        cur.execute("INSERT INTO configuracoes (key, value) VALUES (%s, %s);", ("theme", "padrao"))
+        cur.execute("INSERT INTO configuracoes (key, value) VALUES (%s, %s);", ("backup_hour", "00:00"))
+        cur.execute("INSERT INTO configuracoes (key, value) VALUES (%s, %s);", ("last_backup_date", ""))
+        print("Configurações padrão inseridas.")
+
+
+_CONCURRENT_INDEX_RE = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE)
+
+
+def _drop_invalid_index(cur, statement):
     """
-    Cria as tabelas necessárias no banco de dados PostgreSQL se elas não existirem.
-    Também cria um usuário administrador padrão para o primeiro acesso.
+    Um CREATE INDEX CONCURRENTLY interrompido (cancelamento, deadlock, queda de conexão) deixa um índice
+    INVALID com o mesmo nome, que o IF NOT EXISTS pularia para sempre. Remove esse índice antes de recriá-lo.
     """
-    conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
+    match = _CONCURRENT_INDEX_RE.search(statement)
+    if not match:
+        return
+    cur.execute("""
+        SELECT 1 FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+        WHERE c.relname = %s AND NOT x.indisvalid AND pg_table_is_visible(c.oid);
+    """, (match.group(1),))
+    if cur.fetchone():
+        print(f"Removendo índice inválido {match.group(1)} (criação concorrente anterior interrompida)")
+        cur.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {};").format(sql.Identifier(match.group(1))))
 
-            # 1. Tabela: usuarios (Removendo a coluna 'setor' na definição, a remoção física deve ser feita via ALTER TABLE)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS usuarios (
-                    username TEXT PRIMARY KEY,
-                    password_hash TEXT NOT NULL,
-                    tipo TEXT NOT NULL, -- 'Administrador', 'Operador', 'Visualizador'
-                    nome_completo TEXT, -- Permite NULL
-                    email TEXT, -- Permite NULL
-                    data_criacao TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
 
-            # 2. Tabela: usuario_setores (Nova tabela de ligação para múltiplos setores)
+def _apply_migration(cur, migration):
+    """
+    Aplica uma migração e registra sua versão em schema_version.
+    A conexão deve estar em autocommit: migrações bloqueantes são envolvidas em BEGIN/COMMIT;
+    os comandos das migrações online rodam um a um, fora de transação (índices inválidos deixados por
+    uma execução interrompida são removidos antes, ver _drop_invalid_index).
+    """
+    print(f"Aplicando migração {migration['version']}: {migration['descricao']}")
+    if migration["online"]:
+        for statement in migration["statements"]:
+            _drop_invalid_index(cur, statement)
+            cur.execute(statement)
+        cur.execute("INSERT INTO schema_version (version, descricao) VALUES (%s, %s) ON CONFLICT (version) DO NOTHING;",
+                    (migration["version"], migration["descricao"]))
+        return
+
+    cur.execute("BEGIN;")
+    try:
+        for statement in migration["statements"]:
+            cur.execute(statement)
+        cur.execute("INSERT INTO schema_version (version, descricao) VALUES (%s, %s);",
+                    (migration["version"], migration["descricao"]))
+        cur.execute("COMMIT;")
+    except psycopg2.Error:
+        cur.execute("ROLLBACK;")
+        raise
+
+
+def migrate_schema(online=False):
+    """
+    Aplica as migrações pendentes de SCHEMA_MIGRATIONS.
+    online=False aplica as migrações bloqueantes (tabelas, restrições) e os dados padrão;
+    online=True aplica apenas as migrações online (índices criados com CONCURRENTLY).
+    Um pg_advisory_lock impede que dois processos migrem ao mesmo tempo; nas migrações online,
+    se outro processo já estiver migrando, esta chamada não faz nada.
+    Retorna True se o esquema ficou atualizado (ou se a migração online foi delegada a outro processo).
+    """
+    conn = get_db_connection()
+    if conn is None:
+        return False
+    cur = None
+    lock_id = SCHEMA_ONLINE_MIGRATION_LOCK_ID if online else SCHEMA_MIGRATION_LOCK_ID
+    try:
+        conn.autocommit = True # Necessário para CREATE INDEX CONCURRENTLY; as demais migrações usam BEGIN/COMMIT explícitos
+        cur = conn.cursor()
+        if online:
+            cur.execute("SELECT pg_try_advisory_lock(%s);", (lock_id,))
+            if not cur.fetchone()[0]:
+                return True
+        else:
+            cur.execute("SELECT pg_advisory_lock(%s);", (lock_id,))
+        try:
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS usuario_setores (
-                    username TEXT REFERENCES usuarios(username) ON DELETE CASCADE,
-                    setor TEXT NOT NULL,
-                    PRIMARY KEY (username, setor)
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    descricao TEXT,
+                    aplicada_em TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
                 );
             """)
+            cur.execute("SELECT version FROM schema_version;")
+            applied = {row[0] for row in cur.fetchall()}
 
-            # Verificar se o usuário admin já existe
-            cur.execute("SELECT COUNT(*) FROM usuarios WHERE username = 'admin';")
-            admin_exists = cur.fetchone()[0] > 0
+            for migration in SCHEMA_MIGRATIONS:
+                if migration["online"] == online and migration["version"] not in applied:
+                    _apply_migration(cur, migration)
 
-            # Se o admin não existir, criar um usuário admin padrão e associá-lo ao setor "Todos" (logicamente)
-            if not admin_exists:
-                # Defina aqui o usuário e senha padrão para o primeiro acesso
-                admin_username = "admin"
-                admin_password = "admin123"  # Você pode alterar para a senha que preferir
+            if not online:
+                cur.execute("BEGIN;")
+                try:
+                    _seed_default_data(cur)
+                    cur.execute("COMMIT;")
+                except psycopg2.Error:
+                    cur.execute("ROLLBACK;")
+                    raise
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (lock_id,))
+        return True
+    except psycopg2.Error as e:
+        print(f"Erro ao aplicar migrações do esquema: {e}")
+        return False
+    finally:
+        if cur is not None: cur.close()
+        conn.close()
 
-                # Gerar hash da senha
-                admin_password_hash = hashlib.sha256(admin_password.encode()).hexdigest()
 
-                # Inserir o usuário admin
-                cur.execute("""
-                    INSERT INTO usuarios (username, password_hash, tipo, nome_completo, email)
-                    VALUES (%s, %s, %s, %s, %s);
-                """, (admin_username, admin_password_hash, "Administrador", "Administrador do Sistema", "admin@example.com"))
+def get_schema_version():
+    """Retorna a lista de migrações aplicadas (versão, descrição, data), ou [] se o esquema ainda não foi versionado."""
+    conn = get_db_connection()
+    if conn is None:
+        return []
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+        if not cur.fetchone()[0]:
+            return []
+        cur.execute("SELECT version, descricao, aplicada_em FROM schema_version ORDER BY version;")
+        return cur.fetchall()
+    except psycopg2.Error as e:
+        print(f"Erro ao consultar a versão do esquema: {e}")
+        return []
+    finally:
+        if cur is not None: cur.close()
+        conn.close()
 
-                # Associar o admin ao setor "Todos" na nova tabela (para consistência, embora admin ignore setores)
-                cur.execute("""
-                    INSERT INTO usuario_setores (username, setor)
-                    VALUES (%s, %s)
-                    ON CONFLICT (username, setor) DO NOTHING;
-                """, (admin_username, "Todos"))
 
-                print(f"Usuário administrador padrão criado. Username: {admin_username}, Senha: {admin_password}")
+def _run_online_migrations():
+    if not migrate_schema(online=True):
+        print("Migrações online não concluídas; serão tentadas novamente na próxima inicialização.")
 
-            # Resto do código para criar outras tabelas...
-            # 3. Tabela: indicadores (Mantida)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS indicadores (
-                    id TEXT PRIMARY KEY,
-                    nome TEXT NOT NULL UNIQUE,
-                    objetivo TEXT,
-                    formula TEXT,
-                    variaveis JSONB,
-                    unidade TEXT,
-                    meta NUMERIC(10, 2),
-                    comparacao TEXT,
-                    tipo_grafico TEXT,
-                    responsavel TEXT, -- Responsável ainda é um único setor para o indicador
-                    data_criacao TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    data_atualizacao TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
 
-            # 4. Tabela: resultados (Mantida)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS resultados (
-                    indicator_id TEXT NOT NULL,
-                    data_referencia TIMESTAMP WITHOUT TIME ZONE NOT NULL,
-                    resultado NUMERIC(10, 2),
-                    valores_variaveis JSONB,
-                    observacao TEXT,
-                    analise_critica JSONB,
-                    data_criacao TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    data_atualizacao TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    usuario TEXT,
-                    status_analise TEXT,
-                    PRIMARY KEY (indicator_id, data_referencia),
-                    FOREIGN KEY (indicator_id) REFERENCES indicadores(id) ON DELETE CASCADE
-                );
-            """)
+@st.cache_resource(show_spinner=False)
+def _schema_state():
+    """Estado do processo indicando se o esquema já foi migrado (sobrevive aos reruns do Streamlit)."""
+    return {"migrated": False, "lock": threading.Lock()}
 
-            # 5. Tabela: configuracoes (Mantida)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS configuracoes (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                );
-            """)
-            # Inserir configurações padrão se a tabela estiver vazia
-            cur.execute("SELECT COUNT(*) FROM configuracoes;")
-            if cur.fetchone()[0] == 0:
-                cur.execute("INSERT INTO configuracoes (key, value) VALUES (%s, %s);", ("theme", "padrao"))
-                cur.execute("INSERT INTO configuracoes (key, value) VALUES (%s, %s);", ("backup_hour", "00:00"))
-                cur.execute("INSERT INTO configuracoes (key, value) VALUES (%s, %s);", ("last_backup_date", ""))
-                print("Configurações padrão inseridas.")
-
-            # 6. Tabela: log_backup (Mantida)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS log_backup (
-                    id SERIAL PRIMARY KEY,
-                    timestamp TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    action TEXT,
-                    file_name TEXT,
-                    user_performed TEXT
-                );
-            """)
 
-            # 7. Tabela: log_indicadores (Mantida)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS log_indicadores (
-                    id SERIAL PRIMARY KEY,
-                    timestamp TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    action TEXT,
-                    indicator_id TEXT,
-                    user_performed TEXT
-                );
-            """)
+def ensure_schema():
+    """
+    Garante, uma única vez por processo, que o esquema do banco está atualizado.
+    As migrações bloqueantes rodam na primeira execução; as online são disparadas em uma thread
+    em segundo plano. Os reruns seguintes não acessam o banco. Em caso de falha, tenta novamente
+    no próximo rerun.
+    """
+    state = _schema_state()
+    if state["migrated"]:
+        return True
+    with state["lock"]:
+        if not state["migrated"]:
+            state["migrated"] = migrate_schema()
+            if state["migrated"]:
+                threading.Thread(target=_run_online_migrations, daemon=True).start()
+    return state["migrated"]
 
-            # 8. Tabela: log_usuarios (Mantida)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS log_usuarios (
-                    id SERIAL PRIMARY KEY,
-                    timestamp TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    action TEXT,
-                    username_affected TEXT,
-                    user_performed TEXT
-                );
-            """)
 
-            conn.commit()
-            print("Tabelas verificadas/criadas com sucesso no PostgreSQL.")
-            return True
-        except psycopg2.Error as e:
-            print(f"Erro ao criar tabelas: {e}")
-            conn.rollback()
-            return False
-        finally:
-            cur.close()
-            conn.close()
-    return False
+def create_tables_if_not_exists():
+    """
+    Cria as tabelas necessárias no banco de dados PostgreSQL se elas não existirem.
+    Também cria um usuário administrador padrão para o primeiro acesso.
+    Mantida por compatibilidade: aplica todas as migrações pendentes (bloqueantes e online).
+    """
+    return migrate_schema() and migrate_schema(online=True)
 
 def load_users():
     """
@@ -242,6 +865,7 @@ def load_users():
 
             return users
         except psycopg2.Error as e:
+            _note_db_error()
             print(f"Erro ao carregar usuários e setores: {e}")
             return {}
         finally:
@@ -250,147 +874,265 @@ def load_users():
     return {}
 
 
-# Função save_users corrigida e sem DEBUG prints
-def save_users(users_data):
+def _sync_user_sectors(cur, username, setores):
     """
-    Salva os usuários no banco de dados PostgreSQL.
-    Esta função sincroniza o dicionário 'users_data' com as tabelas 'usuarios' e 'usuario_setores',
-    limpando as tabelas e reinserindo todos os dados fornecidos.
+    Ajusta os setores de um usuário para exatamente `setores`, dentro da transação do cursor:
+    remove apenas os setores que saíram e insere apenas os novos.
     """
-    conn = get_db_connection()
-    if conn:
-        cur = None # Initialize cursor to None
-        try:
-            cur = conn.cursor()
+    setores = list(dict.fromkeys(setores or [])) # Remove duplicados mantendo a ordem
+    cur.execute("DELETE FROM usuario_setores WHERE username = %s AND NOT (setor = ANY(%s));", (username, setores))
+    if setores:
+        cur.executemany("""
+            INSERT INTO usuario_setores (username, setor) VALUES (%s, %s)
+            ON CONFLICT (username, setor) DO NOTHING;
+        """, [(username, setor) for setor in setores])
 
-            # Limpa as tabelas de usuários e setores ANTES de inserir os dados restaurados
-            # Limpa primeiro a tabela de setores que depende da tabela de usuários
-            cur.execute("DELETE FROM usuario_setores;")
-            cur.execute("DELETE FROM usuarios;")
 
-            # Prepara listas para inserção em massa
-            user_records = []
-            sector_records = []
+def create_user(username, password_hash, tipo, nome_completo="", email="", setores=None, data_criacao=None):
+    """
+    Cria um usuário e associa seus setores em uma única transação.
+    Retorna False se o login já existir ou em caso de erro no banco.
+    """
+    conn = get_db_connection()
+    if conn is None:
+        print("Erro: Não foi possível obter conexão com o banco de dados para criar o usuário.")
+        return False
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO usuarios (username, password_hash, tipo, nome_completo, email, data_criacao)
+            VALUES (%s, %s, %s, %s, %s, COALESCE(%s, CURRENT_TIMESTAMP));
+        """, (username, password_hash, tipo, nome_completo or None, email or None,
+              datetime.fromisoformat(data_criacao) if isinstance(data_criacao, str) and data_criacao else data_criacao or None))
+        _sync_user_sectors(cur, username, setores)
+        conn.commit()
+        invalidate_data_cache("usuarios", "usuario_setores", _user_cache_key(username))
+        return True
+    except psycopg2.IntegrityError as e:
+        print(f"Erro ao criar usuário '{username}' (login já existente ou dados inválidos): {e}")
+        conn.rollback()
+        return False
+    except psycopg2.Error as e:
+        print(f"Erro ao criar usuário no banco de dados: {e}")
+        conn.rollback()
+        return False
+    finally:
+        if cur is not None: cur.close()
+        conn.close()
 
-            for username, data in users_data.items():
-                # Prepara dados para a tabela usuarios
-                password_hash = data.get("password", "")
-                tipo = data.get("tipo", "Visualizador")
-                nome_completo = data.get("nome_completo", "")
-                email = data.get("email", "")
-                 # Use data_criacao do dicionário se existir, senão CURRENT_TIMESTAMP via COALESCE no INSERT
-                data_criacao_str = data.get("data_criacao")
-                data_criacao_dt = datetime.fromisoformat(data_criacao_str) if data_criacao_str else None
-
-
-                user_records.append((
-                    username,
-                    password_hash,
-                    tipo,
-                    nome_completo if nome_completo else None, # Insere None se string vazia para permitir NULL no DB
-                    email if email else None, # Insere None se string vazia para permitir NULL no DB
-                    data_criacao_dt # Pode ser datetime object ou None
-                ))
-
-                # Prepara dados para a tabela usuario_setores
-                setores = data.get("setores", [])
-                for setor in setores:
-                    sector_records.append((username, setor))
-
-            # --- Inserir dados de usuários ---
-            if user_records:
-                 # Usa COALESCE para definir data_criacao para CURRENT_TIMESTAMP se o valor for None
-                sql_insert_users = """
-                    INSERT INTO usuarios (username, password_hash, tipo, nome_completo, email, data_criacao)
-                    VALUES (%s, %s, %s, %s, %s, COALESCE(%s, CURRENT_TIMESTAMP));
-                """
-                cur.executemany(sql_insert_users, user_records)
-
-
-            # --- Inserir dados de setores ---
-            if sector_records:
-                sql_insert_sectors = "INSERT INTO usuario_setores (username, setor) VALUES (%s, %s);"
-                cur.executemany(sql_insert_sectors, sector_records)
-
-
-            conn.commit() # Confirma a transação
-            return True
 
-        except psycopg2.Error as e:
-            print(f"Erro ao salvar usuários no banco de dados: {e}") # Mantém este print essencial para logs
-            if conn:
-                conn.rollback() # Reverte a transação em caso de erro
+def update_user(username, tipo=None, nome_completo=None, email=None, password_hash=None, setores=None):
+    """
+    Atualiza apenas os campos informados (None = mantém o valor atual) de um usuário.
+    Se `setores` for informado, os setores são ajustados na mesma transação.
+    Retorna False se o usuário não existir ou em caso de erro no banco.
+    """
+    fields = {"tipo": tipo, "nome_completo": nome_completo, "email": email, "password_hash": password_hash}
+    assignments = [(column, value) for column, value in fields.items() if value is not None]
+    conn = get_db_connection()
+    if conn is None:
+        print("Erro: Não foi possível obter conexão com o banco de dados para atualizar o usuário.")
+        return False
+    cur = None
+    try:
+        cur = conn.cursor()
+        if assignments:
+            query = sql.SQL("UPDATE usuarios SET {} WHERE username = %s;").format(
+                sql.SQL(", ").join(sql.SQL("{} = %s").format(sql.Identifier(column)) for column, _ in assignments))
+            # Strings vazias em nome/email são gravadas como NULL, como no cadastro
+            values = [value or None if column in ("nome_completo", "email") else value for column, value in assignments]
+            cur.execute(query, values + [username])
+        else:
+            cur.execute("SELECT 1 FROM usuarios WHERE username = %s FOR UPDATE;", (username,))
+        if cur.rowcount == 0:
+            print(f"Erro ao atualizar usuário: '{username}' não encontrado.")
+            conn.rollback()
             return False
-        except Exception as e: # Captura outros tipos de erro Python/lógica
-             print(f"Erro inesperado durante o salvamento de usuários: {e}") # Mantém este print
-             if conn:
-                conn.rollback() # Reverte a transação
-             return False
+        if setores is not None:
+            _sync_user_sectors(cur, username, setores)
+        conn.commit()
+        invalidate_data_cache("usuarios", "usuario_setores", _user_cache_key(username))
+        return True
+    except psycopg2.Error as e:
+        print(f"Erro ao atualizar usuário no banco de dados: {e}")
+        conn.rollback()
+        return False
+    finally:
+        if cur is not None: cur.close()
+        conn.close()
 
-        finally:
-            if cur is not None:
-                try:
-                    cur.close()
-                except Exception as e:
-                     print(f"Erro ao fechar cursor no save_users finally: {e}") # Mantém para debug de fechamento
 
-            if conn is not None:
-                 try:
-                    if not conn.closed:
-                         conn.close()
-                 except Exception as e:
-                     print(f"Erro ao fechar conexão DB no save_users finally: {e}") # Mantém para debug de fechamento
+def set_user_sectors(username, setores):
+    """Define os setores de um usuário, alterando apenas as linhas que mudaram."""
+    return update_user(username, setores=setores)
 
 
-    else:
-        print("Erro: Não foi possível obter conexão com o banco de dados para salvar usuários.") # Mantém este print
+def delete_user(username, user_performed):
+    """
+    Exclui um usuário do banco de dados.
+    Os setores são removidos pela chave estrangeira de 'usuario_setores' (ON DELETE CASCADE).
+    """
+    conn = get_db_connection()
+    if conn is None:
+        return False
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM usuarios WHERE username = %s;", (username,))
+        deleted = cur.rowcount
+        conn.commit()
+        invalidate_data_cache("usuarios", "usuario_setores", _user_cache_key(username))
+        if deleted:
+            log_user_action("Usuário excluído", username, user_performed) # Log
+        return deleted > 0
+    except psycopg2.Error as e:
+        print(f"Erro ao excluir usuário do banco de dados: {e}") # Mantém este print
+        conn.rollback()
         return False
+    finally:
+        if cur is not None: cur.close()
+        conn.close()
 
 # Indicadores (Mantidas, pois a associação de setor do indicador não muda)
+INDICATOR_COLUMNS = """i.id, i.nome, i.objetivo, i.formula, i.variaveis, i.unidade, i.meta, i.comparacao,
+                       i.tipo_grafico, i.responsavel, i.data_criacao, i.data_atualizacao"""
+
+
+def _indicator_row_to_dict(row):
+    """Converte uma linha de INDICATOR_COLUMNS no dicionário de indicador usado pela aplicação."""
+    (id, nome, objetivo, formula, variaveis, unidade, meta, comparacao,
+     tipo_grafico, responsavel, data_criacao, data_atualizacao) = row[:12]
+    return {
+        "id": id,
+        "nome": nome,
+        "objetivo": objetivo,
+        "formula": formula if formula is not None else "",
+        "variaveis": variaveis if variaveis is not None else {},
+        "unidade": unidade if unidade is not None else "",
+        "meta": float(meta) if meta is not None else 0.0,
+        "comparacao": comparacao if comparacao is not None else "Maior é melhor",
+        "tipo_grafico": tipo_grafico if tipo_grafico is not None else "Linha",
+        "responsavel": responsavel if responsavel is not None else "Todos",
+        "data_criacao": data_criacao.isoformat() if data_criacao else "",
+        "data_atualizacao": data_atualizacao.isoformat() if data_atualizacao else ""
+    }
+
+
+def _query_indicators(query, params=(), error_context="indicadores"):
+    """Executa uma consulta que retorna INDICATOR_COLUMNS e converte as linhas em dicionários."""
+    conn = get_db_connection()
+    if conn:
+        cur = None
+        try:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            return [_indicator_row_to_dict(row) for row in cur.fetchall()]
+        except psycopg2.Error as e:
+            _note_db_error()
+            print(f"Erro ao carregar {error_context} do banco de dados: {e}")
+            return []
+        finally:
+            if cur is not None: cur.close()
+            if conn is not None: conn.close()
+    return []
+
+
 def load_indicators():
     """
     Carrega os indicadores do banco de dados PostgreSQL.
     Retorna uma lista de dicionários de indicadores no formato esperado pela aplicação.
     """
+    return _query_indicators(f"SELECT {INDICATOR_COLUMNS} FROM indicadores i;")
+
+
+def _escape_like(text):
+    """Escapa os curingas de LIKE/ILIKE (\\, % e _) para buscar o texto literalmente."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _indicator_filter_clause(setores=None, status=None, search=None):
+    """
+    Monta o WHERE (e seus parâmetros) dos filtros de indicadores; o status vem de indicator_summary (alias s).
+    setores/status=None não filtram; uma lista vazia não retorna nenhum indicador.
+    """
+    conditions = []
+    params = []
+    if setores is not None:
+        conditions.append("i.responsavel = ANY(%s)") # Usa o índice idx_indicadores_responsavel
+        params.append(list(setores))
+    if status is not None:
+        conditions.append("COALESCE(s.status, 'Sem Resultados') = ANY(%s)")
+        params.append(list(status))
+    if search:
+        # ILIKE com '%texto%' usa os índices trigram (pg_trgm) de nome e responsavel
+        conditions.append("(i.nome ILIKE %s OR i.responsavel ILIKE %s)")
+        pattern = f"%{_escape_like(search)}%"
+        params.extend([pattern, pattern])
+    return (f"WHERE {' AND '.join(conditions)}" if conditions else ""), params
+
+
+def load_indicators_filtered(setores=None, status=None, search=None):
+    """
+    Carrega apenas os indicadores que passam pelos filtros, aplicados no PostgreSQL:
+    setores (lista de responsáveis), status (lista de status de indicator_summary, indicadores sem linha
+    contam como "Sem Resultados") e search (trecho de nome ou setor, sem diferenciar maiúsculas).
+    Retorna a lista ordenada por nome.
+    """
+    where, params = _indicator_filter_clause(setores, status, search)
+    return _query_indicators(f"""
+        SELECT {INDICATOR_COLUMNS}
+        FROM indicadores i
+        LEFT JOIN indicator_summary s ON s.indicator_id = i.id
+        {where}
+        ORDER BY i.nome;
+    """, params, error_context="indicadores filtrados")
+
+
+def load_indicator_sectors():
+    """Retorna a lista ordenada dos setores responsáveis que possuem indicadores."""
     conn = get_db_connection()
     if conn:
+        cur = None
         try:
             cur = conn.cursor()
-            cur.execute("""
-                SELECT id, nome, objetivo, formula, variaveis, unidade, meta, comparacao,
-                       tipo_grafico, responsavel, data_criacao, data_atualizacao
-                FROM indicadores;
-            """)
-            indicators_data = cur.fetchall()
-
-            indicators = []
-            for row in indicators_data:
-                (id, nome, objetivo, formula, variaveis, unidade, meta, comparacao,
-                 tipo_grafico, responsavel, data_criacao, data_atualizacao) = row
-
-                indicators.append({
-                    "id": id,
-                    "nome": nome,
-                    "objetivo": objetivo,
-                    "formula": formula if formula is not None else "",
-                    "variaveis": variaveis if variaveis is not None else {},
-                    "unidade": unidade if unidade is not None else "",
-                    "meta": float(meta) if meta is not None else 0.0,
-                    "comparacao": comparacao if comparacao is not None else "Maior é melhor",
-                    "tipo_grafico": tipo_grafico if tipo_grafico is not None else "Linha",
-                    "responsavel": responsavel if responsavel is not None else "Todos",
-                    "data_criacao": data_criacao.isoformat() if data_criacao else "",
-                    "data_atualizacao": data_atualizacao.isoformat() if data_atualizacao else ""
-                })
-            return indicators
+            cur.execute("SELECT DISTINCT COALESCE(responsavel, 'Todos') FROM indicadores ORDER BY 1;")
+            return [row[0] for row in cur.fetchall()]
         except psycopg2.Error as e:
-            print(f"Erro ao carregar indicadores do banco de dados: {e}")
+            _note_db_error()
+            print(f"Erro ao carregar os setores dos indicadores: {e}")
             return []
         finally:
-            cur.close()
-            conn.close()
+            if cur is not None: cur.close()
+            if conn is not None: conn.close()
     return []
 
+
+def count_indicators_by_status(setores=None):
+    """Retorna {status: quantidade de indicadores} dos setores informados (None: todos), contado no PostgreSQL."""
+    where, params = _indicator_filter_clause(setores)
+    conn = get_db_connection()
+    if conn:
+        cur = None
+        try:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT COALESCE(s.status, 'Sem Resultados'), COUNT(*)
+                FROM indicadores i
+                LEFT JOIN indicator_summary s ON s.indicator_id = i.id
+                {where}
+                GROUP BY 1;
+            """, params)
+            return dict(cur.fetchall())
+        except psycopg2.Error as e:
+            _note_db_error()
+            print(f"Erro ao contar os indicadores por status: {e}")
+            return {}
+        finally:
+            if cur is not None: cur.close()
+            if conn is not None: conn.close()
+    return {}
+
 def save_indicators(indicators_data):
     """
     Salva os indicadores no banco de dados PostgreSQL.
@@ -403,10 +1145,12 @@ def save_indicators(indicators_data):
         try:
             cur = conn.cursor()
 
-            cur.execute("SELECT id FROM indicadores;")
-            existing_indicator_ids_in_db = {row[0] for row in cur.fetchall()}
+            cur.execute("SELECT id, meta, comparacao FROM indicadores;")
+            existing_targets = {row[0]: (float(row[1]) if row[1] is not None else None, row[2]) for row in cur.fetchall()}
+            existing_indicator_ids_in_db = set(existing_targets)
 
             current_indicator_ids_to_save = {ind["id"] for ind in indicators_data}
+            summary_ids = [] # Indicadores novos ou com meta/comparação alterada
 
             for ind in indicators_data:
                 indicator_id = ind.get("id")
@@ -421,6 +1165,9 @@ def save_indicators(indicators_data):
                 responsavel = ind.get("responsavel")
 
                 if indicator_id in existing_indicator_ids_in_db:
+                    new_target = (round(float(meta), 2) if meta is not None else None, comparacao)
+                    if existing_targets[indicator_id] != new_target:
+                        summary_ids.append(indicator_id)
                     cur.execute("""
                         UPDATE indicadores
                         SET nome = %s, objetivo = %s, formula = %s, variaveis = %s,
@@ -441,13 +1188,17 @@ def save_indicators(indicators_data):
                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP);
                     """, (indicator_id, nome, objetivo, formula, variaveis, unidade, meta, comparacao,
                           tipo_grafico, responsavel))
+                    summary_ids.append(indicator_id)
 
             indicators_to_delete = existing_indicator_ids_in_db - current_indicator_ids_to_save
             for id_to_delete in indicators_to_delete:
                 cur.execute("DELETE FROM indicadores WHERE id = %s;", (id_to_delete,))
                 print(f"Indicador com ID '{id_to_delete}' removido do banco de dados.")
 
+            # A linha de resumo dos indicadores removidos é excluída pelo ON DELETE CASCADE
+            refresh_indicator_summary(cur, summary_ids)
             conn.commit()
+            invalidate_data_cache("indicadores", "resultados", "indicator_summary")
             return True
         except psycopg2.Error as e:
             print(f"Erro ao salvar indicadores no banco de dados: {e}")
@@ -458,139 +1209,354 @@ def save_indicators(indicators_data):
             if conn is not None: conn.close()
     return False
 
-# Resultados (Mantidas)
-def load_results():
-    """
-    Carrega os resultados dos indicadores do banco de dados PostgreSQL.
-    Retorna uma lista de dicionários de resultados no formato esperado pela aplicação.
-    """
+# Resultados
+RESULT_COLUMNS = """indicator_id, data_referencia, resultado, valores_variaveis,
+                       observacao, analise_critica, data_criacao, data_atualizacao,
+                       usuario, status_analise"""
+
+
+def _result_row_to_dict(row):
+    """Converte uma linha de RESULT_COLUMNS no dicionário de resultado usado pela aplicação."""
+    (indicator_id, data_referencia, resultado, valores_variaveis,
+     observacao, analise_critica, data_criacao, data_atualizacao,
+     usuario, status_analise) = row[:10]
+    return {
+        "indicator_id": indicator_id,
+        "data_referencia": data_referencia.isoformat() if data_referencia else "",
+        "resultado": float(resultado) if resultado is not None else 0.0,
+        "valores_variaveis": valores_variaveis if valores_variaveis is not None else {},
+        "observacao": observacao if observacao is not None else "",
+        "analise_critica": analise_critica if analise_critica is not None else {}, # JSONB é carregado como dict
+        "data_criacao": data_criacao.isoformat() if data_criacao else "",
+        "data_atualizacao": data_atualizacao.isoformat() if data_atualizacao else "",
+        "usuario": usuario if usuario is not None else "System",
+        "status_analise": status_analise if status_analise is not None else "N/A"
+    }
+
+
+def _query_results(query, params=(), error_context="resultados"):
+    """Executa uma consulta que retorna RESULT_COLUMNS e converte as linhas em dicionários."""
     conn = get_db_connection()
     if conn:
+        cur = None
         try:
             cur = conn.cursor()
-            cur.execute("""
-                SELECT indicator_id, data_referencia, resultado, valores_variaveis,
-                       observacao, analise_critica, data_criacao, data_atualizacao,
-                       usuario, status_analise
-                FROM resultados;
-            """)
-            results_data = cur.fetchall()
-
-            results = []
-            for row in results_data:
-                (indicator_id, data_referencia, resultado, valores_variaveis,
-                 observacao, analise_critica, data_criacao, data_atualizacao,
-                 usuario, status_analise) = row
-
-                results.append({
-                    "indicator_id": indicator_id,
-                    "data_referencia": data_referencia.isoformat() if data_referencia else "",
-                    "resultado": float(resultado) if resultado is not None else 0.0,
-                    "valores_variaveis": valores_variaveis if valores_variaveis is not None else {},
-                    "observacao": observacao if observacao is not None else "",
-                    "analise_critica": analise_critica if analise_critica is not None else {}, # JSONB é carregado como dict
-                    "data_criacao": data_criacao.isoformat() if data_criacao else "",
-                    "data_atualizacao": data_atualizacao.isoformat() if data_atualizacao else "",
-                    "usuario": usuario if usuario is not None else "System",
-                    "status_analise": status_analise if status_analise is not None else "N/A"
-                })
-            return results
+            cur.execute(query, params)
+            return [_result_row_to_dict(row) for row in cur.fetchall()]
         except psycopg2.Error as e:
-            print(f"Erro ao carregar resultados do banco de dados: {e}")
+            _note_db_error()
+            print(f"Erro ao carregar {error_context} do banco de dados: {e}")
             return []
         finally:
-            cur.close()
-            conn.close()
+            if cur is not None: cur.close()
+            if conn is not None: conn.close()
     return []
 
-def save_results(results_data):
+
+def load_results():
     """
-    Salva os resultados dos indicadores no banco de dados PostgreSQL.
-    Esta função sincroniza a lista 'results_data' com a tabela 'resultados'.
-    Ela insere novos resultados e atualiza os existentes.
+    Carrega todos os resultados dos indicadores do banco de dados PostgreSQL.
+    Retorna uma lista de dicionários de resultados no formato esperado pela aplicação.
+    Para páginas que exibem poucos indicadores, prefira load_results_for().
     """
-    conn = get_db_connection()
-    if conn:
-        cur = None
-        try:
-            cur = conn.cursor()
+    return _query_results(f"SELECT {RESULT_COLUMNS} FROM resultados;")
 
-            cur.execute("SELECT indicator_id, data_referencia FROM resultados;")
-            existing_results_keys_in_db = {(row[0], row[1].isoformat()) for row in cur.fetchall()}
 
-            for res in results_data:
-                indicator_id = res.get("indicator_id")
-                data_referencia_str = res.get("data_referencia")
+def load_results_for(indicator_ids=None, date_from=None, date_to=None):
+    """
+    Carrega os resultados dos indicadores informados, opcionalmente limitados a um intervalo
+    de datas de referência (inclusivo). O filtro e a ordenação (indicador, data DESC) são feitos
+    no PostgreSQL, usando o índice resultados(indicator_id, data_referencia DESC).
+    indicator_ids=None carrega todos os indicadores.
+    """
+    conditions = []
+    params = []
+    if indicator_ids is not None:
+        indicator_ids = list(indicator_ids)
+        if not indicator_ids:
+            return []
+        conditions.append("indicator_id = ANY(%s)")
+        params.append(indicator_ids)
+    if date_from is not None:
+        conditions.append("data_referencia >= %s")
+        params.append(_parse_data_referencia(date_from))
+    if date_to is not None:
+        conditions.append("data_referencia <= %s")
+        params.append(_parse_data_referencia(date_to))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return _query_results(f"""
+        SELECT {RESULT_COLUMNS}
+        FROM resultados
+        {where}
+        ORDER BY indicator_id, data_referencia DESC;
+    """, params)
+
+
+def latest_result_per_indicator(indicator_ids=None):
+    """
+    Retorna o resultado mais recente (maior data_referencia) de cada indicador, usando DISTINCT ON.
+    Retorna um dicionário {indicator_id: resultado}.
+    """
+    params = []
+    where = ""
+    if indicator_ids is not None:
+        indicator_ids = list(indicator_ids)
+        if not indicator_ids:
+            return {}
+        where = "WHERE indicator_id = ANY(%s)"
+        params.append(indicator_ids)
+    rows = _query_results(f"""
+        SELECT DISTINCT ON (indicator_id) {RESULT_COLUMNS}
+        FROM resultados
+        {where}
+        ORDER BY indicator_id, data_referencia DESC;
+    """, params, error_context="últimos resultados")
+    return {r["indicator_id"]: r for r in rows}
+
+
+def last_n_results_per_indicator(indicator_ids=None, n=3):
+    """
+    Retorna os N resultados mais recentes de cada indicador (ordenados do mais recente para o mais antigo).
+    Retorna um dicionário {indicator_id: [resultados]}.
+    """
+    params = []
+    where = ""
+    if indicator_ids is not None:
+        indicator_ids = list(indicator_ids)
+        if not indicator_ids:
+            return {}
+        where = "WHERE indicator_id = ANY(%s)"
+        params.append(indicator_ids)
+    params.append(int(n))
+    rows = _query_results(f"""
+        SELECT {RESULT_COLUMNS}
+        FROM (
+            SELECT {RESULT_COLUMNS},
+                   ROW_NUMBER() OVER (PARTITION BY indicator_id ORDER BY data_referencia DESC) AS posicao
+            FROM resultados
+            {where}
+        ) ultimos
+        WHERE posicao <= %s
+        ORDER BY indicator_id, data_referencia DESC;
+    """, params, error_context="últimos resultados")
+    grouped = {}
+    for r in rows:
+        grouped.setdefault(r["indicator_id"], []).append(r)
+    return grouped
+
+def recalculate_histories(indicator_ids=None, user_performed=None):
+    """
+    Recalcula o `resultado` armazenado a partir de `valores_variaveis`, com a fórmula atual de cada
+    indicador (indicator_ids=None: todos os indicadores com fórmula).
+    Os valores de cada indicador são avaliados em uma única chamada vetorizada (evaluate_batch) e todas
+    as alterações são gravadas em um único UPDATE ... FROM (VALUES ...), na mesma transação.
+    Linhas cujo resultado não muda não são reescritas.
+    Retorna {"atualizados": n, "avaliados": n, "invalidos": [(indicator_id, data_referencia, mensagem)]},
+    ou None em caso de erro no banco.
+    """
+    conn = get_db_connection()
+    if conn is None:
+        return None
+    cur = None
+    try:
+        cur = conn.cursor()
+        query = "SELECT id, formula, variaveis FROM indicadores WHERE COALESCE(formula, '') <> ''"
+        params = []
+        if indicator_ids is not None:
+            query += " AND id = ANY(%s)"
+            params.append(list(indicator_ids))
+        cur.execute(query + ";", params)
+        formulas = {indicator_id: (formula, variaveis or {}) for indicator_id, formula, variaveis in cur.fetchall()}
+        if not formulas:
+            return {"atualizados": 0, "avaliados": 0, "invalidos": []}
+
+        cur.execute("""
+            SELECT indicator_id, data_referencia, valores_variaveis FROM resultados
+            WHERE indicator_id = ANY(%s) AND valores_variaveis IS NOT NULL AND valores_variaveis <> '{}'::jsonb;
+        """, (list(formulas),))
+        rows_by_indicator = {}
+        for indicator_id, data_referencia, valores_variaveis in cur.fetchall():
+            rows_by_indicator.setdefault(indicator_id, ([], []))
+            rows_by_indicator[indicator_id][0].append(data_referencia)
+            rows_by_indicator[indicator_id][1].append(valores_variaveis)
+
+        updates = []
+        invalid = []
+        evaluated = 0
+        for indicator_id, (datas, valores) in rows_by_indicator.items():
+            formula, variaveis = formulas[indicator_id]
+            try:
+                compiled = compile_formula(formula, indicator_id=indicator_id, variables=list(variaveis.keys()) or None)
+            except FormulaError as e:
+                invalid.extend((indicator_id, data, str(e)) for data in datas)
+                continue
+            results, errors = compiled.evaluate_batch(valores)
+            evaluated += len(datas)
+            for pos, message in errors.items():
+                invalid.append((indicator_id, datas[pos], message))
+            rounded = np.round(results, 2)
+            updates.extend((indicator_id, datas[pos], float(rounded[pos]))
+                           for pos in np.flatnonzero(np.isfinite(rounded)))
+
+        updated = 0
+        if updates:
+            execute_values(cur, """
+                UPDATE resultados AS r
+                SET resultado = v.resultado, data_atualizacao = CURRENT_TIMESTAMP
+                FROM (VALUES %s) AS v (indicator_id, data_referencia, resultado)
+                WHERE r.indicator_id = v.indicator_id AND r.data_referencia = v.data_referencia
+                  AND r.resultado IS DISTINCT FROM v.resultado;
+            """, updates, template="(%s, %s::timestamp, %s::numeric)", page_size=len(updates))
+            updated = cur.rowcount
+            if updated:
+                refresh_indicator_summary(cur, {u[0] for u in updates})
+        conn.commit()
+        if updated:
+            invalidate_data_cache("resultados", "indicator_summary")
+            for indicator_id in {u[0] for u in updates}:
+                log_indicator_action("Histórico de resultados recalculado", indicator_id, user_performed)
+        return {"atualizados": updated, "avaliados": evaluated, "invalidos": invalid}
+    except psycopg2.Error as e:
+        print(f"Erro ao recalcular o histórico de resultados: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if cur is not None: cur.close()
+        conn.close()
 
-                try:
-                    data_referencia_dt = datetime.fromisoformat(data_referencia_str)
-                except (ValueError, TypeError):
-                    print(f"Erro: data_referencia inválida para o resultado: {data_referencia_str}. Ignorando.") # Manter este log
-                    continue
-
-                resultado = res.get("resultado")
-                valores_variaveis = Json(res.get("valores_variaveis", {}))
-                observacao = res.get("observacao")
-
-                analise_critica_data = res.get("analise_critica", {})
-                # Garante que analise_critica_data é um dicionário, mesmo se vier como string JSON
-                if isinstance(analise_critica_data, str):
-                    try:
-                        analise_critica_data = json.loads(analise_critica_data)
-                    except json.JSONDecodeError:
-                        analise_critica_data = {}
-                analise_critica = Json(analise_critica_data)
 
-                usuario = res.get("usuario")
-                status_analise = res.get("status_analise")
+def recalculate_indicator_history(indicator_id, user_performed=None):
+    """Recalcula o histórico de resultados de um indicador (ver recalculate_histories)."""
+    return recalculate_histories([indicator_id], user_performed)
 
-                current_key = (indicator_id, data_referencia_dt.isoformat())
 
-                if current_key in existing_results_keys_in_db:
-                    cur.execute("""
-                        UPDATE resultados
-                        SET resultado = %s, valores_variaveis = %s, observacao = %s,
-                            analise_critica = %s, data_atualizacao = CURRENT_TIMESTAMP,
-                            usuario = %s, status_analise = %s
-                        WHERE indicator_id = %s AND data_referencia = %s;
-                    """, (resultado, valores_variaveis, observacao, analise_critica,
-                          usuario, status_analise, indicator_id, data_referencia_dt))
-                else:
-                    cur.execute("""
-                        INSERT INTO resultados (indicator_id, data_referencia, resultado,
-                                                valores_variaveis, observacao, analise_critica,
-                                                data_criacao, data_atualizacao, usuario, status_analise)
-                        VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, %s, %s);
-                    """, (indicator_id, data_referencia_dt, resultado, valores_variaveis,
-                          observacao, analise_critica, usuario, status_analise))
-
-            # Lógica para deletar resultados que não estão mais na lista (se aplicável)
-            # Esta lógica é mais complexa e geralmente não usada para resultados,
-            # a menos que a lista results_data represente o estado COMPLETO esperado da tabela.
-            # A implementação atual parece adicionar/atualizar. Se precisar deletar,
-            # a lógica com existing_results_keys_in_db e current_results_keys_to_save
-            # precisaria ser adicionada aqui, semelhante ao save_indicators.
-            # A versão anterior da save_results já incluía essa lógica de deleção.
-            # Mantenho a versão anterior que deleta para sincronização completa.
-            current_results_keys_to_save = {(res.get("indicator_id"), datetime.fromisoformat(res.get("data_referencia")).isoformat()) for res in results_data if res.get("data_referencia")}
-            results_to_delete = existing_results_keys_in_db - current_results_keys_to_save
-            for ind_id, data_ref_str in results_to_delete:
-                try:
-                    data_ref_dt = datetime.fromisoformat(data_ref_str)
-                    cur.execute("DELETE FROM resultados WHERE indicator_id = %s AND data_referencia = %s;", (ind_id, data_ref_dt))
-                    # print(f"Resultado para indicador '{ind_id}' e data '{data_ref_str}' removido do banco de dados.") # Removido DEBUG print
-                except (ValueError, TypeError):
-                    print(f"Erro ao tentar deletar resultado com data inválida: '{data_ref_str}'. Ignorando.") # Manter log de erro
+def show_recalculation_report(report):
+    """Exibe o resultado de recalculate_histories, incluindo as linhas com entradas inválidas."""
+    if report is None:
+        st.error("❌ Erro ao recalcular o histórico de resultados. Verifique o console.")
+        return
+    st.success(f"✅ {report['atualizados']} resultado(s) atualizado(s) de {report['avaliados']} avaliado(s).")
+    if report["invalidos"]:
+        st.warning(f"⚠️ {len(report['invalidos'])} resultado(s) não puderam ser recalculados (valores mantidos):")
+        st.dataframe(pd.DataFrame([{
+            "Indicador": indicator_id,
+            "Período": format_date_as_month_year(data_referencia),
+            "Motivo": message,
+        } for indicator_id, data_referencia, message in report["invalidos"]]), use_container_width=True, hide_index=True)
+
+def _parse_data_referencia(data_referencia):
+    """Converte a data de referência (string ISO, date ou datetime) para datetime."""
+    if isinstance(data_referencia, datetime):
+        return data_referencia
+    if hasattr(data_referencia, "year") and hasattr(data_referencia, "month"):
+        return datetime(data_referencia.year, data_referencia.month, getattr(data_referencia, "day", 1))
+    return datetime.fromisoformat(data_referencia)
+
+
+# Upsert de um resultado pela chave primária (indicator_id, data_referencia)
+UPSERT_RESULT_SQL = """
+    INSERT INTO resultados (indicator_id, data_referencia, resultado, valores_variaveis,
+                            observacao, analise_critica, data_criacao, data_atualizacao,
+                            usuario, status_analise)
+    VALUES (%s, %s, %s, %s, %s, %s,
+            COALESCE(%s, CURRENT_TIMESTAMP), COALESCE(%s, CURRENT_TIMESTAMP), %s, %s)
+    ON CONFLICT (indicator_id, data_referencia) DO UPDATE
+    SET resultado = EXCLUDED.resultado,
+        valores_variaveis = EXCLUDED.valores_variaveis,
+        observacao = EXCLUDED.observacao,
+        analise_critica = EXCLUDED.analise_critica,
+        data_atualizacao = EXCLUDED.data_atualizacao,
+        usuario = EXCLUDED.usuario,
+        status_analise = EXCLUDED.status_analise;
+"""
+
+
+def _result_upsert_params(indicator_id, data_referencia, resultado, valores_variaveis=None,
+                          observacao=None, analise_critica=None, usuario=None, status_analise=None,
+                          data_criacao=None, data_atualizacao=None):
+    """
+    Monta a tupla de parâmetros de UPSERT_RESULT_SQL.
+    data_criacao/data_atualizacao só são informadas na restauração; caso contrário o banco usa CURRENT_TIMESTAMP.
+    """
+    # Garante que analise_critica é um dicionário, mesmo se vier como string JSON
+    if isinstance(analise_critica, str):
+        try:
+            analise_critica = json.loads(analise_critica)
+        except json.JSONDecodeError:
+            analise_critica = {}
+    return (
+        indicator_id,
+        _parse_data_referencia(data_referencia),
+        resultado,
+        Json(valores_variaveis or {}),
+        observacao if observacao else None,
+        Json(analise_critica or {}),
+        datetime.fromisoformat(data_criacao) if isinstance(data_criacao, str) and data_criacao else (data_criacao or None),
+        datetime.fromisoformat(data_atualizacao) if isinstance(data_atualizacao, str) and data_atualizacao else (data_atualizacao or None),
+        usuario,
+        status_analise,
+    )
 
 
+def upsert_result(indicator_id, data_referencia, resultado, valores_variaveis=None, observacao=None,
+                  analise_critica=None, usuario=None, status_analise=None):
+    """
+    Insere ou atualiza um único resultado de indicador.
+    Usa INSERT ... ON CONFLICT na chave (indicator_id, data_referencia), de modo que o custo
+    não depende do tamanho da tabela e gravações concorrentes de outros períodos não se sobrescrevem.
+    """
+    try:
+        params = _result_upsert_params(indicator_id, data_referencia, resultado, valores_variaveis,
+                                       observacao, analise_critica, usuario, status_analise)
+    except (ValueError, TypeError):
+        print(f"Erro: data_referencia inválida para o resultado: {data_referencia}.")
+        return False
+
+    conn = get_db_connection()
+    if conn:
+        cur = None
+        try:
+            cur = conn.cursor()
+            cur.execute(UPSERT_RESULT_SQL, params)
+            refresh_indicator_summary(cur, [indicator_id])
             conn.commit()
+            invalidate_data_cache("resultados", "indicator_summary")
             return True
         except psycopg2.Error as e:
-            print(f"Erro ao salvar resultados no banco de dados: {e}") # Mantém este print
+            print(f"Erro ao salvar resultado no banco de dados: {e}")
             conn.rollback()
             return False
-        except Exception as e:
-            print(f"Erro inesperado durante o salvamento de resultados: {e}") # Mantém este print
+        finally:
+            if cur is not None: cur.close()
+            if conn is not None: conn.close()
+    return False
+
+
+def delete_result(indicator_id, data_referencia, user_performed):
+    """Exclui um único resultado de indicador e registra a ação no log."""
+    try:
+        data_referencia_dt = _parse_data_referencia(data_referencia)
+    except (ValueError, TypeError):
+        print(f"Erro ao tentar excluir resultado com data inválida: '{data_referencia}'.")
+        return False
+
+    conn = get_db_connection()
+    if conn:
+        cur = None
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM resultados WHERE indicator_id = %s AND data_referencia = %s;",
+                        (indicator_id, data_referencia_dt))
+            deleted = cur.rowcount
+            if deleted:
+                refresh_indicator_summary(cur, [indicator_id])
+            conn.commit()
+            invalidate_data_cache("resultados", "indicator_summary")
+            if deleted:
+                log_indicator_action(f"Resultado excluído ({data_referencia_dt.strftime('%m/%Y')})", indicator_id, user_performed)
+            return True
+        except psycopg2.Error as e:
+            print(f"Erro ao excluir resultado do banco de dados: {e}")
             conn.rollback()
             return False
         finally:
@@ -598,6 +1564,345 @@ def save_results(results_data):
             if conn is not None: conn.close()
     return False
 
+# Resumo por indicador
+# indicator_summary guarda uma linha por indicador (último resultado, status, variação vs meta), recalculada
+# por refresh_indicator_summary na mesma transação de cada escrita em resultados ou de cada alteração de
+# meta/comparação. Assim, a visão geral e o gráfico de status do dashboard custam O(indicadores).
+
+def refresh_indicator_summary(cur, indicator_ids=None):
+    """
+    Recalcula (upsert) as linhas de indicator_summary dos indicadores informados (None: todos),
+    usando o cursor e a transação do chamador. Não faz commit.
+    Antes do recálculo, as linhas dos indicadores em indicadores são bloqueadas (em ordem de id, FOR NO KEY
+    UPDATE, que não conflita com os bloqueios das chaves estrangeiras de resultados): duas transações que
+    gravam resultados do mesmo indicador recalculam o resumo uma depois da outra, e a segunda enxerga o
+    resultado já confirmado pela primeira (READ COMMITTED tira um novo snapshot a cada comando).
+    """
+    if indicator_ids is None:
+        cur.execute("SELECT 1 FROM indicadores ORDER BY id FOR NO KEY UPDATE;")
+        cur.execute(INDICATOR_SUMMARY_REFRESH_SQL.format(where="WHERE TRUE"))
+        return
+    indicator_ids = list(indicator_ids)
+    if indicator_ids:
+        cur.execute("SELECT 1 FROM indicadores WHERE id = ANY(%s) ORDER BY id FOR NO KEY UPDATE;", (indicator_ids,))
+        cur.execute(INDICATOR_SUMMARY_REFRESH_SQL.format(where="WHERE i.id = ANY(%s)"), (indicator_ids,))
+
+
+def load_indicator_summary(indicator_ids=None):
+    """
+    Carrega as linhas de indicator_summary (todas, ou apenas dos indicadores informados).
+    Retorna um dicionário {indicator_id: resumo}; indicadores sem linha devem ser tratados como "Sem Resultados".
+    """
+    params = []
+    where = ""
+    if indicator_ids is not None:
+        indicator_ids = list(indicator_ids)
+        if not indicator_ids:
+            return {}
+        where = "WHERE indicator_id = ANY(%s)"
+        params.append(indicator_ids)
+    conn = get_db_connection()
+    if conn:
+        cur = None
+        try:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT indicator_id, ultimo_resultado, data_referencia, resultado_anterior,
+                       num_resultados, status, variacao, atualizado_em
+                FROM indicator_summary
+                {where};
+            """, params)
+            summary = {}
+            for (indicator_id, ultimo_resultado, data_referencia, resultado_anterior,
+                 num_resultados, status, variacao, atualizado_em) in cur.fetchall():
+                summary[indicator_id] = {
+                    "indicator_id": indicator_id,
+                    "ultimo_resultado": float(ultimo_resultado) if ultimo_resultado is not None else None,
+                    "data_referencia": data_referencia.isoformat() if data_referencia else "",
+                    "resultado_anterior": float(resultado_anterior) if resultado_anterior is not None else None,
+                    "num_resultados": num_resultados,
+                    "status": status,
+                    "variacao": float(variacao) if variacao is not None else 0.0,
+                    "atualizado_em": atualizado_em.isoformat() if atualizado_em else "",
+                }
+            return summary
+        except psycopg2.Error as e:
+            _note_db_error()
+            print(f"Erro ao carregar o resumo dos indicadores do banco de dados: {e}")
+            return {}
+        finally:
+            if cur is not None: cur.close()
+            if conn is not None: conn.close()
+    return {}
+
+# Pendências de preenchimento
+# Períodos sem resultado de cada indicador em uma janela recente, calculados em uma única consulta: os períodos
+# da janela (generate_series, com o passo da frequência de preenchimento, ver FILL_FREQUENCY) cruzados com os
+# indicadores e testados com NOT EXISTS no índice resultados(indicator_id, data_referencia). Um período conta
+# como preenchido se houver resultado em qualquer data dele, como em filled_period_keys; períodos encerrados
+# antes da criação do indicador não contam como pendentes.
+
+# Tamanho padrão da janela (em meses) do relatório de pendências
+PENDING_WINDOW_MONTHS = int(os.environ.get("SCPC_PENDING_WINDOW_MONTHS", "12"))
+
+PENDING_PERIODS_SQL = """
+    SELECT i.id, i.nome, COALESCE(i.responsavel, 'Todos') AS setor,
+           ARRAY_AGG(p.inicio ORDER BY p.inicio DESC) AS periodos
+    FROM indicadores i
+    CROSS JOIN generate_series(%(inicio)s::timestamp, %(fim)s::timestamp, make_interval(months => %(passo)s)) AS p (inicio)
+    WHERE p.inicio + make_interval(months => %(passo)s) > COALESCE(i.data_criacao, p.inicio)
+      AND NOT EXISTS (
+          SELECT 1 FROM resultados r
+          WHERE r.indicator_id = i.id
+            AND r.data_referencia >= p.inicio AND r.data_referencia < p.inicio + make_interval(months => %(passo)s)
+      )
+      {where}
+    GROUP BY i.id, i.nome, i.responsavel
+    ORDER BY setor, i.nome;
+"""
+
+
+def load_pending_periods(meses=PENDING_WINDOW_MONTHS, setores=None, incluir_periodo_atual=False, frequencia=None):
+    """
+    Retorna os indicadores com períodos sem resultado nos períodos que cobrem os últimos `meses` meses (por padrão
+    até o período anterior; incluir_periodo_atual=True inclui o período corrente), opcionalmente apenas dos setores
+    informados. Os períodos são os da frequência de preenchimento (frequencia=None: FILL_FREQUENCY).
+    Cada item: {"indicator_id", "nome", "setor", "periodos_pendentes": [inícios ISO, do mais recente], "num_pendentes"}.
+    Retorna None em caso de erro no banco.
+    """
+    frequencia = frequencia or FILL_FREQUENCY
+    passo = 12 // PERIOD_FREQUENCIES[frequencia]
+    ultimo = period_key(datetime.now(), frequencia) - (0 if incluir_periodo_atual else 1)
+    quantidade = max(1, -(-int(meses) // passo)) # Períodos necessários para cobrir a janela
+    params = {"inicio": period_start(ultimo - quantidade + 1, frequencia), "fim": period_start(ultimo, frequencia),
+              "passo": passo}
+    where = ""
+    if setores is not None:
+        setores = list(setores)
+        if not setores:
+            return []
+        where = "AND i.responsavel = ANY(%(setores)s)"
+        params["setores"] = setores
+    conn = get_db_connection()
+    if conn:
+        cur = None
+        try:
+            cur = conn.cursor()
+            cur.execute(PENDING_PERIODS_SQL.format(where=where), params)
+            return [{
+                "indicator_id": indicator_id,
+                "nome": nome,
+                "setor": setor,
+                "periodos_pendentes": [inicio.isoformat() for inicio in periodos_pendentes],
+                "num_pendentes": len(periodos_pendentes),
+            } for indicator_id, nome, setor, periodos_pendentes in cur.fetchall()]
+        except psycopg2.Error as e:
+            _note_db_error()
+            print(f"Erro ao calcular as pendências de preenchimento: {e}")
+            return None
+        finally:
+            if cur is not None: cur.close()
+            if conn is not None: conn.close()
+    return None
+
+
+def pending_periods_frame(pending, frequencia=None):
+    """Converte o resultado de load_pending_periods em DataFrame para exibição/exportação (períodos como em period_label)."""
+    frequencia = frequencia or FILL_FREQUENCY
+    return pd.DataFrame([{
+        "Indicador": item["nome"],
+        "Setor": item["setor"],
+        "Períodos Pendentes": item["num_pendentes"],
+        "Períodos": ", ".join(period_label(period_key(datetime.fromisoformat(inicio), frequencia), frequencia)
+                              for inicio in item["periodos_pendentes"]),
+    } for item in pending], columns=["Indicador", "Setor", "Períodos Pendentes", "Períodos"])
+
+
+# Importação em lote de resultados
+# Uma planilha (.xlsx/.csv) com as colunas indicador (id ou nome), periodo, resultado (indicadores sem fórmula),
+# observacao (opcional) e uma coluna por variável das fórmulas. Validação e cálculo são vetorizados (uma
+# chamada evaluate_batch por indicador) e as linhas válidas são gravadas em um único INSERT ... ON CONFLICT
+# de várias linhas (execute_values), na mesma transação.
+
+IMPORT_COLUMN_ALIASES = {"indicador": "indicador", "periodo": "periodo", "período": "periodo",
+                         "resultado": "resultado", "observacao": "observacao", "observação": "observacao"}
+# Maior valor absoluto aceito por resultados.resultado (NUMERIC(10, 2))
+IMPORT_RESULT_LIMIT = 99999999.99
+# Formatos aceitos na coluna periodo: (expressão, formato do pd.to_datetime, prefixo adicionado)
+IMPORT_PERIOD_FORMATS = [
+    (r"\d{1,2}/\d{4}", "%d/%m/%Y", "01/"),             # 03/2024
+    (r"\d{1,2}/\d{1,2}/\d{4}", "%d/%m/%Y", ""),        # 01/03/2024
+    (r"\d{4}-\d{1,2}", "%Y-%m-%d", None),               # 2024-03
+    (r"\d{4}-\d{1,2}-\d{1,2}( .*)?", "%Y-%m-%d", None), # 2024-03-01 (ou data/hora do Excel)
+]
+
+UPSERT_IMPORTED_RESULTS_SQL = """
+    INSERT INTO resultados (indicator_id, data_referencia, resultado, valores_variaveis,
+                            observacao, analise_critica, usuario, status_analise)
+    VALUES %s
+    ON CONFLICT (indicator_id, data_referencia) DO UPDATE
+    SET resultado = EXCLUDED.resultado,
+        valores_variaveis = EXCLUDED.valores_variaveis,
+        observacao = COALESCE(EXCLUDED.observacao, resultados.observacao),
+        data_atualizacao = CURRENT_TIMESTAMP,
+        usuario = EXCLUDED.usuario;
+"""
+
+
+def read_import_file(uploaded_file):
+    """Lê a planilha de importação (.csv ou .xlsx) como texto, com as colunas padrão normalizadas."""
+    if getattr(uploaded_file, "name", "").lower().endswith(".csv"):
+        df = pd.read_csv(uploaded_file, sep=None, engine="python", dtype=str) # Detecta ',' ou ';'
+    else:
+        df = pd.read_excel(uploaded_file, dtype=str)
+    df.columns = [IMPORT_COLUMN_ALIASES.get(str(col).strip().lower(), str(col).strip()) for col in df.columns]
+    return df
+
+
+def _import_numbers(series):
+    """Converte uma coluna de texto em números (aceita vírgula decimal); valores inválidos viram NaN."""
+    return pd.to_numeric(series.astype(str).str.strip().str.replace(",", ".", regex=False), errors="coerce")
+
+
+def _import_periods(series):
+    """Converte a coluna periodo em datetime (NaT quando inválida), aceitando os formatos de IMPORT_PERIOD_FORMATS."""
+    raw = series.fillna("").astype(str).str.strip()
+    parsed = pd.Series(pd.NaT, index=series.index, dtype="datetime64[ns]")
+    for pattern, fmt, prefix in IMPORT_PERIOD_FORMATS:
+        mask = raw.str.fullmatch(pattern) & parsed.isna()
+        if not mask.any():
+            continue
+        values = raw[mask]
+        if prefix:
+            values = prefix + values
+        elif prefix is None:
+            values = values.str[:10].where(values.str.count("-") >= 2, values + "-01").str.split(" ").str[0]
+        parsed[mask] = pd.to_datetime(values, format=fmt, errors="coerce")
+    return parsed
+
+
+def import_results(df, usuario, allowed_sectors=None, sobrescrever=False, dry_run=False, frequencia=None):
+    """
+    Valida, calcula e grava os resultados de uma planilha de importação (ver read_import_file).
+    allowed_sectors limita os indicadores aceitos (Operadores); sobrescrever=False rejeita períodos já
+    preenchidos; dry_run=True apenas valida. Cada período é gravado no primeiro dia do período da frequência
+    (frequencia=None: FILL_FREQUENCY).
+    Retorna {"validos": n, "importados": n, "erros": [(linha da planilha, mensagem)]}; "importados" é None
+    se a gravação falhar.
+    """
+    missing = [col for col in ("indicador", "periodo") if col not in df.columns]
+    if missing:
+        return {"validos": 0, "importados": 0, "erros": [(None, f"Colunas obrigatórias ausentes: {', '.join(missing)}")]}
+
+    frequencia = frequencia or FILL_FREQUENCY
+    df = df.reset_index(drop=True)
+    errors = pd.Series([None] * len(df), dtype=object)
+
+    def reject(mask, message):
+        # Marca a primeira mensagem de erro de cada linha (valores NA na máscara não rejeitam)
+        mask = pd.Series(mask, index=errors.index).astype("boolean").fillna(False).astype(bool)
+        errors[mask & errors.isna()] = message
+
+    # Indicador: aceita o id ou o nome (sem diferenciar maiúsculas)
+    indicators = load_indicators()
+    by_key = {ind["id"]: ind for ind in indicators}
+    by_key.update({ind["nome"].strip().lower(): ind for ind in indicators})
+    keys = df["indicador"].fillna("").astype(str).str.strip()
+    indicator_ids = keys.map(lambda key: (by_key.get(key) or by_key.get(key.lower()) or {}).get("id"))
+    reject(indicator_ids.isna(), "Indicador não encontrado")
+    if allowed_sectors is not None:
+        sectors = indicator_ids.map(lambda indicator_id: by_key[indicator_id]["responsavel"] if pd.notna(indicator_id) else None)
+        reject(~sectors.isin(list(allowed_sectors)), "Indicador fora dos setores do usuário")
+
+    # Período: chave inteira do período (ver period_key), no passado ou atual
+    periods = _import_periods(df["periodo"])
+    reject(periods.isna(), "Período inválido (use MM/AAAA, AAAA-MM ou uma data)")
+    per_year = PERIOD_FREQUENCIES[frequencia]
+    period_keys = (periods.dt.year * per_year + (periods.dt.month - 1) // (12 // per_year)).astype("Int64")
+    reject(period_keys > period_key(datetime.now(), frequencia), "Período futuro")
+
+    # Duplicidades dentro da planilha
+    reject(pd.DataFrame({"id": indicator_ids, "periodo": period_keys}).duplicated(keep=False) & indicator_ids.notna() & period_keys.notna(),
+           "Linha duplicada para o mesmo indicador e período")
+
+    # Resultado: fórmula avaliada em lote por indicador, ou coluna resultado para indicadores sem fórmula
+    resultados = pd.Series(np.nan, index=df.index)
+    valores = pd.Series([{}] * len(df), dtype=object)
+    for indicator_id, rows in df[errors.isna()].groupby(indicator_ids[errors.isna()]):
+        ind = by_key[indicator_id]
+        variables = list((ind.get("variaveis") or {}).keys())
+        if ind.get("formula") and variables:
+            missing_vars = [var for var in variables if var not in df.columns]
+            if missing_vars:
+                reject(df.index.isin(rows.index), f"Colunas das variáveis ausentes: {', '.join(missing_vars)}")
+                continue
+            try:
+                compiled = compile_formula(ind["formula"], indicator_id=indicator_id, variables=variables)
+            except FormulaError as e:
+                reject(df.index.isin(rows.index), f"Fórmula inválida: {e}")
+                continue
+            numbers = rows[variables].apply(_import_numbers)
+            values, row_errors = compiled.evaluate_batch(numbers)
+            for pos, message in row_errors.items():
+                errors[rows.index[pos]] = message
+            resultados[rows.index] = values
+            for label, record in zip(rows.index, numbers.to_dict("records")):
+                valores.at[label] = record
+        elif "resultado" in df.columns:
+            resultados[rows.index] = _import_numbers(rows["resultado"])
+        else:
+            reject(df.index.isin(rows.index), "Coluna resultado ausente (indicador sem fórmula)")
+    resultados = resultados.round(2)
+    reject(resultados.isna(), "Resultado ausente ou inválido")
+    reject(resultados.abs() > IMPORT_RESULT_LIMIT, f"Resultado fora do intervalo aceito (±{IMPORT_RESULT_LIMIT:,.2f})")
+
+    starts = {int(key): period_start(int(key), frequencia) for key in period_keys[errors.isna()].unique()}
+    data_referencia = pd.Series([starts.get(int(key)) if pd.notna(key) else None for key in period_keys], dtype=object)
+    observacoes = df["observacao"].fillna("").astype(str).str.strip() if "observacao" in df.columns else pd.Series([""] * len(df))
+
+    conn = get_db_connection()
+    if conn is None:
+        return {"validos": int(errors.isna().sum()), "importados": None, "erros": [(None, "Erro ao conectar ao banco de dados")]}
+    cur = None
+    try:
+        cur = conn.cursor()
+        valid = errors.isna()
+        if not sobrescrever and valid.any():
+            # Períodos já preenchidos no banco, consultados de uma vez
+            cur.execute("""
+                SELECT r.indicator_id, r.data_referencia FROM resultados r
+                JOIN unnest(%s::text[], %s::timestamp[]) AS v (indicator_id, data_referencia)
+                  ON r.indicator_id = v.indicator_id AND r.data_referencia = v.data_referencia;
+            """, (indicator_ids[valid].tolist(), data_referencia[valid].tolist()))
+            existing = set(cur.fetchall())
+            reject(pd.Series([(i, d) in existing for i, d in zip(indicator_ids, data_referencia)]), "Período já preenchido")
+            valid = errors.isna()
+
+        report = {"validos": int(valid.sum()), "importados": 0,
+                  "erros": [(int(pos) + 2, message) for pos, message in errors.dropna().items()]} # +2: cabeçalho e base 1
+        if dry_run or not valid.any():
+            return report
+
+        rows = [(indicator_ids[pos], data_referencia[pos], float(resultados[pos]), Json(valores[pos]),
+                 observacoes[pos] or None, Json({}), usuario, get_analise_status({}))
+                for pos in np.flatnonzero(valid.to_numpy())]
+        execute_values(cur, UPSERT_IMPORTED_RESULTS_SQL, rows, page_size=1000)
+        imported_ids = sorted({row[0] for row in rows})
+        refresh_indicator_summary(cur, imported_ids)
+        conn.commit()
+        invalidate_data_cache("resultados", "indicator_summary")
+        for indicator_id in imported_ids:
+            log_indicator_action(f"Resultados importados ({sum(1 for row in rows if row[0] == indicator_id)})", indicator_id, usuario)
+        report["importados"] = len(rows)
+        return report
+    except psycopg2.Error as e:
+        print(f"Erro ao importar resultados: {e}")
+        conn.rollback()
+        return {"validos": int(errors.isna().sum()), "importados": None, "erros": [(None, f"Erro no banco de dados: {e}")]}
+    finally:
+        if cur is not None: cur.close()
+        conn.close()
+
 # Configurações (Mantidas)
 def load_config():
     """
@@ -625,6 +1930,7 @@ def load_config():
 
             return config
         except psycopg2.Error as e:
+            _note_db_error()
             print(f"Erro ao carregar configurações do banco de dados: {e}")
             return {"theme": "padrao", "backup_hour": "00:00", "last_backup_date": ""}
         finally:
@@ -651,6 +1957,7 @@ def save_config(config_data):
                 """, (key, value))
 
             conn.commit()
+            invalidate_data_cache("configuracoes")
             return True
         except psycopg2.Error as e:
             print(f"Erro ao salvar configurações no banco de dados: {e}") # Mantém este print
@@ -665,75 +1972,130 @@ def save_config(config_data):
             if conn is not None: conn.close()
     return False
 
-# Logs de Backup (Mantidas)
-def load_backup_log():
+# Logs de Auditoria
+# Os logs são somente de inclusão (log_*_action). A leitura é paginada por keyset: cada página traz as
+# `limit` entradas mais recentes anteriores ao cursor (timestamp, id) da última entrada da página anterior,
+# usando os índices log_*(timestamp DESC, id DESC). Entradas antigas saem apenas por archive_audit_logs().
+
+AUDIT_LOG_PAGE_SIZE = 100
+
+# Tabela de log -> (coluna do objeto afetado, chave correspondente no dicionário de entrada)
+AUDIT_LOG_TABLES = {
+    "log_backup": ("file_name", "file_name"),
+    "log_indicadores": ("indicator_id", "indicator_id"),
+    "log_usuarios": ("username_affected", "username_affected"),
+}
+
+
+def _load_audit_log(table, limit=AUDIT_LOG_PAGE_SIZE, before_timestamp=None, before_id=None,
+                    user=None, action=None, target=None):
     """
-    Carrega o log de backup do banco de dados PostgreSQL.
-    Retorna uma lista de dicionários de entradas de log.
+    Lê uma página de um log de auditoria, do mais recente para o mais antigo.
+    before_timestamp/before_id: cursor da página anterior (timestamp e id da sua última entrada);
+    before_id=None usa apenas o timestamp. limit=None lê todas as entradas (usado pelo backup).
+    user, action e target filtram por igualdade em user_performed, action e no objeto afetado.
     """
+    target_column, target_key = AUDIT_LOG_TABLES[table]
+    conditions = []
+    params = []
+    if before_timestamp is not None:
+        before_timestamp = datetime.fromisoformat(before_timestamp) if isinstance(before_timestamp, str) else before_timestamp
+        if before_id is not None:
+            conditions.append(sql.SQL("(timestamp, id) < (%s, %s)"))
+            params.extend([before_timestamp, before_id])
+        else:
+            conditions.append(sql.SQL("timestamp < %s"))
+            params.append(before_timestamp)
+    for column, value in (("user_performed", user), ("action", action), (target_column, target)):
+        if value:
+            conditions.append(sql.SQL("{} = %s").format(sql.Identifier(column)))
+            params.append(value)
+
+    query = sql.SQL("SELECT id, timestamp, action, {}, user_performed FROM {}").format(
+        sql.Identifier(target_column), sql.Identifier(table))
+    if conditions:
+        query += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions)
+    query += sql.SQL(" ORDER BY timestamp DESC, id DESC")
+    if limit is not None:
+        query += sql.SQL(" LIMIT %s")
+        params.append(int(limit))
+
     conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT timestamp, action, file_name, user_performed FROM log_backup ORDER BY timestamp DESC;")
-            log_data = cur.fetchall()
-
-            log_entries = []
-            for row in log_data:
-                timestamp, action, file_name, user_performed = row
-                log_entries.append({
-                    "timestamp": timestamp.isoformat() if timestamp else "",
-                    "action": action if action is not None else "",
-                    "file_name": file_name if file_name is not None else "",
-                    "user": user_performed if user_performed is not None else "System"
-                })
-            return log_entries
-        except psycopg2.Error as e:
-            print(f"Erro ao carregar log de backup do banco de dados: {e}")
-            return []
-        finally:
-            cur.close()
-            conn.close()
-    return []
+    if conn is None:
+        return []
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        return [{
+            "id": log_id,
+            "timestamp": timestamp.isoformat() if timestamp else "",
+            "action": action_value if action_value is not None else "",
+            target_key: target_value if target_value is not None else "",
+            "user": user_performed if user_performed is not None else "System"
+        } for log_id, timestamp, action_value, target_value, user_performed in cur.fetchall()]
+    except psycopg2.Error as e:
+        print(f"Erro ao carregar {table} do banco de dados: {e}")
+        return []
+    finally:
+        if cur is not None: cur.close()
+        conn.close()
 
-def save_backup_log(log_data):
+
+def archive_audit_logs(older_than_days, archive_dir="backups"):
     """
-    Salva o log de backup no banco de dados PostgreSQL.
-    Esta função limpa o log existente e reinseri as entradas fornecidas.
+    Retenção dos logs de auditoria: move para um arquivo JSON Lines compactado
+    (archive_dir/arquivo_logs_AAAAMMDD_HHMMSS.jsonl.gz) as entradas com mais de `older_than_days` dias
+    e as exclui das tabelas. A exclusão só é confirmada depois que o arquivo foi gravado.
+    Retorna (caminho do arquivo ou None, {tabela: linhas arquivadas}); em caso de erro, (None, {}).
     """
+    cutoff = datetime.now() - timedelta(days=int(older_than_days))
+    os.makedirs(archive_dir, exist_ok=True)
+    archive_path = os.path.join(archive_dir, f"arquivo_logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl.gz")
     conn = get_db_connection()
-    if conn:
-        cur = None
-        try:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM log_backup;")
-
-            for entry in log_data:
-                # COALESCE para timestamp e user, se necessário
-                timestamp_dt = datetime.fromisoformat(entry.get("timestamp")) if entry.get("timestamp") else None
-                action = entry.get("action")
-                file_name = entry.get("file_name")
-                user_performed = entry.get("user", "System")
-
-                cur.execute("""
-                    INSERT INTO log_backup (timestamp, action, file_name, user_performed)
-                    VALUES (COALESCE(%s, CURRENT_TIMESTAMP), %s, %s, COALESCE(%s, 'Sistema'));
-                """, (timestamp_dt, action, file_name, user_performed))
-
-            conn.commit()
-            return True
-        except psycopg2.Error as e:
-            print(f"Erro ao salvar o log de backup no banco de dados: {e}") # Mantém este print
+    if conn is None:
+        return None, {}
+    cur = None
+    counts = {}
+    try:
+        cur = conn.cursor()
+        with gzip.open(archive_path, "wt", encoding="utf-8") as archive:
+            for table, (target_column, _) in AUDIT_LOG_TABLES.items():
+                cur.execute(sql.SQL("""
+                    DELETE FROM {} WHERE timestamp < %s
+                    RETURNING id, timestamp, action, {}, user_performed;
+                """).format(sql.Identifier(table), sql.Identifier(target_column)), (cutoff,))
+                counts[table] = 0
+                for log_id, timestamp, action, target_value, user_performed in cur:
+                    archive.write(json.dumps({
+                        "tabela": table, "id": log_id, "timestamp": timestamp.isoformat() if timestamp else None,
+                        "action": action, target_column: target_value, "user_performed": user_performed
+                    }, ensure_ascii=False) + "\n")
+                    counts[table] += 1
+        if not any(counts.values()):
             conn.rollback()
-            return False
-        except Exception as e:
-             print(f"Erro inesperado durante o salvamento do log de backup: {e}") # Mantém este print
-             conn.rollback()
-             return False
-        finally:
-            if cur is not None: cur.close()
-            if conn is not None: conn.close()
-    return False
+            os.remove(archive_path)
+            return None, counts
+        conn.commit()
+        invalidate_data_cache(*AUDIT_LOG_TABLES)
+        return archive_path, counts
+    except (psycopg2.Error, OSError) as e:
+        print(f"Erro ao arquivar logs de auditoria: {e}")
+        conn.rollback()
+        if os.path.exists(archive_path): os.remove(archive_path)
+        return None, {}
+    finally:
+        if cur is not None: cur.close()
+        conn.close()
+
+# Logs de Backup (Mantidas)
+def load_backup_log(limit=AUDIT_LOG_PAGE_SIZE, before_timestamp=None, before_id=None,
+                    user=None, action=None, file_name=None):
+    """
+    Carrega uma página do log de backup do banco de dados PostgreSQL (mais recentes primeiro).
+    Retorna uma lista de dicionários de entradas de log. Ver _load_audit_log para a paginação.
+    """
+    return _load_audit_log("log_backup", limit, before_timestamp, before_id, user, action, file_name)
 
 
 def log_backup_action(action, file_name, user_performed):
@@ -754,6 +2116,7 @@ def log_backup_action(action, file_name, user_performed):
             """, (action, file_name, log_entry_user))
 
             conn.commit()
+            invalidate_data_cache("log_backup")
             return True
         except psycopg2.Error as e:
             print(f"Erro ao registrar ação de backup no banco de dados: {e}") # Mantém este print
@@ -769,73 +2132,14 @@ def log_backup_action(action, file_name, user_performed):
     return False
 
 # Logs de Indicadores (Mantidas)
-def load_indicator_log():
-    """
-    Carrega o log de indicadores do banco de dados PostgreSQL.
-    Retorna uma lista de dicionários de entradas de log.
-    """
-    conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT timestamp, action, indicator_id, user_performed FROM log_indicadores ORDER BY timestamp DESC;")
-            log_data = cur.fetchall()
-
-            log_entries = []
-            for row in log_data:
-                timestamp, action, indicator_id, user_performed = row
-                log_entries.append({
-                    "timestamp": timestamp.isoformat() if timestamp else "",
-                    "action": action if action is not None else "",
-                    "indicator_id": indicator_id if indicator_id is not None else "",
-                    "user": user_performed if user_performed is not None else "System"
-                })
-            return log_entries
-        except psycopg2.Error as e:
-            print(f"Erro ao carregar log de indicadores do banco de dados: {e}")
-            return []
-        finally:
-            cur.close()
-            conn.close()
-    return []
-
-def save_indicator_log(log_data):
+def load_indicator_log(limit=AUDIT_LOG_PAGE_SIZE, before_timestamp=None, before_id=None,
+                       user=None, action=None, indicator_id=None):
     """
-    Salva o log de indicadores no banco de dados PostgreSQL.
-    Esta função limpa o log existente e reinseri as entradas fornecidas.
+    Carrega uma página do log de indicadores do banco de dados PostgreSQL (mais recentes primeiro).
+    Retorna uma lista de dicionários de entradas de log. Ver _load_audit_log para a paginação.
     """
-    conn = get_db_connection()
-    if conn:
-        cur = None
-        try:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM log_indicadores;")
-
-            for entry in log_data:
-                timestamp_dt = datetime.fromisoformat(entry.get("timestamp")) if entry.get("timestamp") else None
-                action = entry.get("action")
-                indicator_id = entry.get("indicator_id")
-                user_performed = entry.get("user", "System")
-
-                cur.execute("""
-                    INSERT INTO log_indicadores (timestamp, action, indicator_id, user_performed)
-                    VALUES (COALESCE(%s, CURRENT_TIMESTAMP), %s, %s, COALESCE(%s, 'Sistema'));
-                """, (timestamp_dt, action, indicator_id, user_performed))
-
-            conn.commit()
-            return True
-        except psycopg2.Error as e:
-            print(f"Erro ao salvar o log de indicadores no banco de dados: {e}") # Mantém este print
-            conn.rollback()
-            return False
-        except Exception as e:
-            print(f"Erro inesperado durante o salvamento do log de indicadores: {e}") # Mantém este print
-            conn.rollback()
-            return False
-        finally:
-            if cur is not None: cur.close()
-            if conn is not None: conn.close()
-    return False
+    return _load_audit_log("log_indicadores", limit, before_timestamp, before_id, user, action, indicator_id)
+
 
 def log_indicator_action(action, indicator_id, user_performed):
     """
@@ -855,6 +2159,7 @@ def log_indicator_action(action, indicator_id, user_performed):
             """, (action, indicator_id, log_entry_user))
 
             conn.commit()
+            invalidate_data_cache("log_indicadores")
             return True
         except psycopg2.Error as e:
             print(f"Erro ao registrar ação de indicador no banco de dados: {e}") # Mantém este print
@@ -870,67 +2175,41 @@ def log_indicator_action(action, indicator_id, user_performed):
     return False
 
 # Logs de Usuários (Mantidas)
-def load_user_log():
+def load_user_log(limit=AUDIT_LOG_PAGE_SIZE, before_timestamp=None, before_id=None,
+                  user=None, action=None, username_affected=None):
     """
-    Carrega o log de usuários do banco de dados PostgreSQL.
-    Retorna uma lista de dicionários de entradas de log.
+    Carrega uma página do log de usuários do banco de dados PostgreSQL (mais recentes primeiro).
+    Retorna uma lista de dicionários de entradas de log. Ver _load_audit_log para a paginação.
     """
-    conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT timestamp, action, username_affected, user_performed FROM log_usuarios ORDER BY timestamp DESC;")
-            log_data = cur.fetchall()
-
-            log_entries = []
-            for row in log_data:
-                timestamp, action, username_affected, user_performed = row
-                log_entries.append({
-                    "timestamp": timestamp.isoformat() if timestamp else "",
-                    "action": action if action is not None else "",
-                    "username": username_affected if username_affected is not None else "",
-                    "user": user_performed if user_performed is not None else "System"
-                })
-            return log_entries
-        except psycopg2.Error as e:
-            print(f"Erro ao carregar log de usuários do banco de dados: {e}")
-            return []
-        finally:
-            cur.close()
-            conn.close()
-    return []
+    return _load_audit_log("log_usuarios", limit, before_timestamp, before_id, user, action, username_affected)
 
-def save_user_log(log_data):
+
+def log_user_action(action, username_affected, user_performed):
     """
-    Salva o log de usuários no banco de dados PostgreSQL.
-    Esta função limpa o log existente e reinseri as entradas fornecidas.
+    Registra uma ação de usuário no log do banco de dados.
     """
     conn = get_db_connection()
     if conn:
         cur = None
         try:
             cur = conn.cursor()
-            cur.execute("DELETE FROM log_usuarios;")
 
-            for entry in log_data:
-                timestamp_dt = datetime.fromisoformat(entry.get("timestamp")) if entry.get("timestamp") else None
-                action = entry.get("action")
-                username_affected = entry.get("username")
-                user_performed = entry.get("user", "System")
+            log_entry_user = user_performed if user_performed is not None else 'Sistema'
 
-                cur.execute("""
-                    INSERT INTO log_usuarios (timestamp, action, username_affected, user_performed)
-                    VALUES (COALESCE(%s, CURRENT_TIMESTAMP), %s, %s, COALESCE(%s, 'Sistema'));
-                """, (timestamp_dt, action, username_affected, user_performed))
+            cur.execute("""
+                INSERT INTO log_usuarios (action, username_affected, user_performed)
+                VALUES (%s, %s, %s);
+            """, (action, username_affected, log_entry_user))
 
             conn.commit()
+            invalidate_data_cache("log_usuarios")
             return True
         except psycopg2.Error as e:
-            print(f"Erro ao salvar o log de usuários no banco de dados: {e}") # Mantém este print
+            print(f"Erro ao registrar ação de usuário no banco de dados: {e}") # Mantém este print
             conn.rollback()
             return False
         except Exception as e:
-            print(f"Erro inesperado durante o salvamento do log de usuários: {e}") # Mantém este print
+            print(f"Erro inesperado ao registrar ação de usuário: {e}") # Mantém este print
             conn.rollback()
             return False
         finally:
@@ -938,38 +2217,376 @@ def save_user_log(log_data):
             if conn is not None: conn.close()
     return False
 
+# --- Snapshots em Cache (leituras usadas pelas páginas) ---
+# As páginas leem os dados por estas funções. Enquanto nenhuma escrita ocorrer (e o TTL não expirar),
+# os reruns do Streamlit causados por interação com widgets não acessam o banco.
+# Os valores retornados por st.cache_data são cópias, podendo ser alterados pelo chamador.
+# Uma leitura que falhou não é memorizada (ver _load_or_raise): o fallback vale só para o rerun atual.
 
-def log_user_action(action, username_affected, user_performed):
+class _UncachedResult(Exception):
+    """Levantada dentro de uma função _cached_* quando a leitura falhou; st.cache_data não memoriza exceções."""
+
+    def __init__(self, value):
+        super().__init__("Falha ao ler o banco de dados")
+        self.value = value
+
+
+def _load_or_raise(loader, *args):
+    """Chama o carregador; se ele registrou uma falha de banco (_note_db_error), levanta _UncachedResult com o fallback."""
+    errors = _db_error_count()
+    value = loader(*args)
+    if _db_error_count() != errors:
+        raise _UncachedResult(value)
+    return value
+
+
+def _snapshot(cached_loader, *args):
+    """Chama uma função _cached_*, devolvendo o fallback (não memorizado) quando a leitura falhou."""
+    try:
+        return cached_loader(*args)
+    except _UncachedResult as e:
+        return e.value
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_indicators(version):
+    return _load_or_raise(load_indicators)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_indicators_filtered(setores, status, search, version):
+    return _load_or_raise(load_indicators_filtered, list(setores) if setores is not None else None,
+                          list(status) if status is not None else None, search)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_indicator_sectors(version):
+    return _load_or_raise(load_indicator_sectors)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_status_counts(setores, version):
+    return _load_or_raise(count_indicators_by_status, list(setores) if setores is not None else None)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_results_for(indicator_ids, version):
+    return _load_or_raise(load_results_for, list(indicator_ids) if indicator_ids is not None else None)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_filled_periods(indicator_id, frequencia, version):
+    return _load_or_raise(filled_period_keys, indicator_id, frequencia)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_latest_results(indicator_ids, version):
+    return _load_or_raise(latest_result_per_indicator, list(indicator_ids) if indicator_ids is not None else None)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_indicator_summary(indicator_ids, version):
+    return _load_or_raise(load_indicator_summary, list(indicator_ids) if indicator_ids is not None else None)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_pending_periods(meses, setores, incluir_periodo_atual, mes_atual, version):
+    return _load_or_raise(load_pending_periods, meses, list(setores) if setores is not None else None, incluir_periodo_atual)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_config(version):
+    return _load_or_raise(load_config)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def _cached_users(version):
+    return _load_or_raise(load_users)
+
+
+def _ids_key(indicator_ids):
+    """Normaliza a lista de IDs (ou de setores/status) para uma chave de cache estável (tupla ordenada) ou None (todos)."""
+    return tuple(sorted(set(indicator_ids))) if indicator_ids is not None else None
+
+
+def get_indicators_snapshot():
+    """Retorna a lista de indicadores (cache invalidado por escritas em indicadores)."""
+    return _snapshot(_cached_indicators, get_data_version("indicadores"))
+
+
+def get_filtered_indicators_snapshot(setores=None, status=None, search=None):
+    """Retorna os indicadores filtrados no banco, como load_indicators_filtered() (cache por versão de indicadores/resumo)."""
+    return _snapshot(_cached_indicators_filtered, _ids_key(setores), _ids_key(status), (search or "").strip() or None,
+                     get_data_version("indicadores", "indicator_summary"))
+
+
+def get_indicator_sectors_snapshot():
+    """Retorna os setores responsáveis que possuem indicadores (cache por versão de indicadores)."""
+    return _snapshot(_cached_indicator_sectors, get_data_version("indicadores"))
+
+
+def get_status_counts_snapshot(setores=None):
+    """Retorna a contagem de indicadores por status dos setores informados (cache por versão de indicadores/resumo)."""
+    return _snapshot(_cached_status_counts, _ids_key(setores), get_data_version("indicadores", "indicator_summary"))
+
+
+def get_results_snapshot(indicator_ids=None):
+    """Retorna os resultados dos indicadores informados, como load_results_for() (cache por versão de resultados)."""
+    return _snapshot(_cached_results_for, _ids_key(indicator_ids), get_data_version("resultados"))
+
+
+def get_latest_results_snapshot(indicator_ids=None):
+    """Retorna o último resultado de cada indicador, como latest_result_per_indicator() (cache por versão de resultados)."""
+    return _snapshot(_cached_latest_results, _ids_key(indicator_ids), get_data_version("resultados"))
+
+
+def get_indicator_summary_snapshot(indicator_ids=None):
+    """Retorna o resumo por indicador, como load_indicator_summary() (cache por versão de indicator_summary)."""
+    return _snapshot(_cached_indicator_summary, _ids_key(indicator_ids), get_data_version("indicator_summary"))
+
+
+def get_filled_periods_snapshot(indicator_id, frequencia="Mensal"):
+    """Retorna as chaves dos períodos já preenchidos do indicador, como filled_period_keys() (cache por versão de resultados)."""
+    return _snapshot(_cached_filled_periods, indicator_id, frequencia, get_data_version("resultados"))
+
+
+def get_pending_periods_snapshot(meses=PENDING_WINDOW_MONTHS, setores=None, incluir_periodo_atual=False):
     """
-    Registra uma ação de usuário no log do banco de dados.
+    Retorna as pendências de preenchimento, como load_pending_periods() (cache por versão de indicadores/resultados;
+    o mês atual faz parte da chave, para que a janela avance na virada do mês).
+    """
+    return _snapshot(_cached_pending_periods, int(meses), _ids_key(setores), incluir_periodo_atual,
+                     datetime.now().strftime("%Y-%m"), get_data_version("indicadores", "resultados"))
+
+
+def get_config_snapshot():
+    """Retorna as configurações da aplicação (cache invalidado por save_config)."""
+    return _snapshot(_cached_config, get_data_version("configuracoes"))
+
+
+def get_users_snapshot():
+    """Retorna a lista de usuários com setores (cache invalidado por escritas em usuarios/usuario_setores)."""
+    return _snapshot(_cached_users, get_data_version("usuarios", "usuario_setores"))
+
+
+# --- Motor de Fórmulas ---
+# Cada fórmula é analisada (sympify) e compilada (lambdify/NumPy) uma única vez; o resultado, inclusive
+# um erro de sintaxe ou de variável desconhecida, fica em um cache LRU do processo, com chave
+# (id do indicador, hash da fórmula, variáveis permitidas). Avaliar é apenas chamar a função NumPy.
+
+# Variáveis são sequências de letras na fórmula (ex.: A+B/C)
+FORMULA_VARIABLE_PATTERN = re.compile(r'[a-zA-Z]+')
+FORMULA_CACHE_SIZE = int(os.environ.get("SCPC_FORMULA_CACHE_SIZE", "512"))
+
+
+class FormulaError(ValueError):
+    """Erro de sintaxe, de variável desconhecida/ausente ou de cálculo em uma fórmula de indicador."""
+
+
+def formula_variables(formula):
+    """Retorna a lista ordenada de variáveis (sequências de letras) da fórmula."""
+    return sorted(set(FORMULA_VARIABLE_PATTERN.findall(formula or "")))
+
+
+class CompiledFormula:
+    """
+    Fórmula validada e compilada para uma função NumPy.
+    `variables` (opcional) são as variáveis definidas para o indicador; variáveis da fórmula fora
+    dessa lista geram FormulaError na compilação.
+    """
+
+    def __init__(self, formula, variables=None):
+        self.formula = formula
+        self.variables = formula_variables(formula)
+        if variables is not None:
+            unknown = [var for var in self.variables if var not in variables]
+            if unknown:
+                raise FormulaError(f"Variáveis desconhecidas na fórmula: {', '.join(unknown)}")
+        var_symbols = [Symbol(var) for var in self.variables]
+        try:
+            expr = sympify(formula, locals=dict(zip(self.variables, var_symbols)))
+            self._func = lambdify(var_symbols, expr, modules="numpy")
+        except (SympifyError, TypeError, ValueError, SyntaxError) as e:
+            raise FormulaError(f"Erro na sintaxe da fórmula: {e}")
+
+    def evaluate(self, values):
+        """Avalia a fórmula para um dicionário {variável: valor}. Levanta FormulaError se o cálculo falhar."""
+        missing = [var for var in self.variables if values.get(var) in (None, "")]
+        if missing:
+            raise FormulaError(f"Valores ausentes para: {', '.join(missing)}")
+        try:
+            args = [float(values[var]) for var in self.variables]
+        except (TypeError, ValueError) as e:
+            raise FormulaError(f"Valor inválido para as variáveis: {e}")
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            try:
+                result = float(self._func(*args))
+            except (ZeroDivisionError, OverflowError):
+                result = float("nan")
+            except (TypeError, ValueError) as e:
+                raise FormulaError(f"Erro ao calcular a fórmula: {e}")
+        if not np.isfinite(result):
+            raise FormulaError("Divisão por zero ou resultado indefinido com os valores fornecidos.")
+        return result
+
+    def evaluate_batch(self, rows):
+        """
+        Avalia a fórmula para várias linhas de uma vez (uma única chamada vetorizada).
+        `rows` é uma lista de dicionários {variável: valor} ou um DataFrame com uma coluna por variável.
+        Retorna (resultados, erros): um array NumPy (NaN onde o cálculo falhou) e um dicionário
+        {posição da linha: mensagem de erro}.
+        """
+        frame = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(list(rows))
+        n = len(frame)
+        errors = {}
+        args = []
+        invalid = np.zeros(n, dtype=bool)
+        for var in self.variables:
+            raw = frame[var] if var in frame.columns else pd.Series([None] * n, index=frame.index)
+            column = pd.to_numeric(raw, errors="coerce").to_numpy(dtype=float)
+            bad = np.isnan(column)
+            for pos in np.flatnonzero(bad):
+                errors.setdefault(int(pos), f"Valor ausente ou inválido para '{var}'")
+            invalid |= bad
+            args.append(column)
+        if n == 0:
+            return np.empty(0), errors
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            try:
+                results = np.broadcast_to(np.asarray(self._func(*args), dtype=float), (n,)).copy()
+            except (TypeError, ValueError, ZeroDivisionError) as e:
+                return np.full(n, np.nan), {pos: f"Erro ao calcular a fórmula: {e}" for pos in range(n)}
+        results[invalid] = np.nan
+        for pos in np.flatnonzero(~np.isfinite(results) & ~invalid):
+            errors[int(pos)] = "Divisão por zero ou resultado indefinido"
+        return results, errors
+
+
+class FormulaCache:
+    """Cache LRU, compartilhado pelo processo, das fórmulas compiladas (ou do erro de compilação)."""
+
+    def __init__(self, max_size=FORMULA_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, formula, indicator_id=None, variables=None):
+        key = (indicator_id, hashlib.sha256((formula or "").encode()).hexdigest(),
+               tuple(sorted(variables)) if variables is not None else None)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            try:
+                entry = CompiledFormula(formula, variables)
+            except FormulaError as e:
+                entry = e
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = entry
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        if isinstance(entry, FormulaError):
+            raise entry
+        return entry
+
+
+@st.cache_resource(show_spinner=False)
+def get_formula_cache():
+    """Retorna o cache de fórmulas compiladas do processo."""
+    return FormulaCache()
+
+
+def compile_formula(formula, indicator_id=None, variables=None):
+    """
+    Retorna a fórmula compilada (CompiledFormula), usando o cache do processo.
+    Levanta FormulaError (sem nova análise, se o erro já estiver em cache) se a fórmula for inválida.
     """
+    if not formula:
+        raise FormulaError("A fórmula está vazia.")
+    return get_formula_cache().get(formula, indicator_id, variables)
+
+
+# --- Períodos de Referência ---
+# Um período é representado por um inteiro: ano * períodos_por_ano + posição do período no ano
+# (ex.: mensal, março/2024 = 2024 * 12 + 2). Os períodos preenchidos de um indicador são calculados no
+# PostgreSQL e devolvidos como um conjunto de inteiros; os períodos em aberto saem de um único range.
+
+# Frequências suportadas: nome -> quantidade de períodos por ano (divisores de 12)
+PERIOD_FREQUENCIES = {"Mensal": 12, "Bimestral": 6, "Trimestral": 4, "Semestral": 2, "Anual": 1}
+PERIOD_NAMES = {6: "Bimestre", 4: "Trimestre", 2: "Semestre"}
+# Quantos anos completos antes do ano atual podem ser preenchidos
+FILL_LOOKBACK_YEARS = int(os.environ.get("SCPC_FILL_LOOKBACK_YEARS", "5"))
+# Frequência dos períodos oferecidos no preenchimento de resultados
+FILL_FREQUENCY = os.environ.get("SCPC_FILL_FREQUENCY", "Mensal")
+
+
+def period_key(date, frequencia="Mensal"):
+    """Retorna a chave inteira do período que contém a data (datetime/date)."""
+    per_year = PERIOD_FREQUENCIES[frequencia]
+    return date.year * per_year + (date.month - 1) // (12 // per_year)
+
+
+def period_start(key, frequencia="Mensal"):
+    """Retorna o datetime do primeiro dia do período (a data_referencia gravada para ele)."""
+    per_year = PERIOD_FREQUENCIES[frequencia]
+    year, index = divmod(key, per_year)
+    return datetime(year, index * (12 // per_year) + 1, 1)
+
+
+def period_label(key, frequencia="Mensal"):
+    """Rótulo do período para exibição: 'Março/2024' (mensal), '2º Trimestre/2024', '2024' (anual)."""
+    per_year = PERIOD_FREQUENCIES[frequencia]
+    year, index = divmod(key, per_year)
+    if per_year == 12:
+        return period_start(key, frequencia).strftime('%B/%Y')
+    if per_year == 1:
+        return str(year)
+    return f"{index + 1}º {PERIOD_NAMES[per_year]}/{year}"
+
+
+def filled_period_keys(indicator_id, frequencia="Mensal"):
+    """
+    Retorna o conjunto das chaves de período que já têm resultado para o indicador, calculado no PostgreSQL
+    (apenas inteiros são transferidos). Retorna None em caso de erro no banco.
+    """
+    per_year = PERIOD_FREQUENCIES[frequencia]
     conn = get_db_connection()
     if conn:
         cur = None
         try:
             cur = conn.cursor()
-
-            log_entry_user = user_performed if user_performed is not None else 'Sistema'
-
             cur.execute("""
-                INSERT INTO log_usuarios (action, username_affected, user_performed)
-                VALUES (%s, %s, %s);
-            """, (action, username_affected, log_entry_user))
-
-            conn.commit()
-            return True
+                SELECT DISTINCT (EXTRACT(YEAR FROM data_referencia)::int * %s
+                                 + (EXTRACT(MONTH FROM data_referencia)::int - 1) / %s)
+                FROM resultados
+                WHERE indicator_id = %s;
+            """, (per_year, 12 // per_year, indicator_id))
+            return {row[0] for row in cur.fetchall()}
         except psycopg2.Error as e:
-            print(f"Erro ao registrar ação de usuário no banco de dados: {e}") # Mantém este print
-            conn.rollback()
-            return False
-        except Exception as e:
-            print(f"Erro inesperado ao registrar ação de usuário: {e}") # Mantém este print
-            conn.rollback()
-            return False
+            _note_db_error()
+            print(f"Erro ao carregar os períodos preenchidos do indicador: {e}")
+            return None
         finally:
             if cur is not None: cur.close()
             if conn is not None: conn.close()
-    return False
+    return None
+
+
+def missing_period_keys(filled, frequencia="Mensal", lookback_years=FILL_LOOKBACK_YEARS, today=None):
+    """
+    Retorna as chaves dos períodos sem resultado, do mais recente (período atual) para o mais antigo
+    (primeiro período de `lookback_years` anos antes do ano atual). `filled` é um conjunto de chaves.
+    """
+    today = today or datetime.now()
+    per_year = PERIOD_FREQUENCIES[frequencia]
+    first = (today.year - lookback_years) * per_year
+    return [key for key in range(period_key(today, frequencia), first - 1, -1) if key not in filled]
+
 
 # --- Funções Auxiliares e de UI (Adaptadas para o DB) ---
 
@@ -1088,6 +2705,7 @@ def define_menu_icons():
         "Criar Indicador": "➕",
         "Editar Indicador": "✏️",
         "Preencher Indicador": "📝",
+        "Importar Resultados": "📥",
         "Visão Geral": "📊",
         "Gerenciar Usuários": "👥",
         "Configurações": "⚙️"
@@ -1126,25 +2744,170 @@ def get_download_link(df, filename):
     # Adiciona estilo para o link parecer um botão Streamlit
     return f'<a href="data:application/octet-stream;base64,{b64}" download="{filename}" style="display: inline-block; padding: 0.5rem 1rem; background-color: #1E88E5; color: white; text-decoration: none; border-radius: 4px; font-weight: bold;">Baixar Excel</a>'
 
-def create_chart(indicator_id, chart_type, TEMA_PADRAO):
-    """Cria um gráfico com base no tipo especificado."""
-    results = load_results()
-    indicator_results = [r for r in results if r["indicator_id"] == indicator_id]
+def results_to_frame(results):
+    """Converte uma lista de resultados em DataFrame, com data_referencia já convertida para datetime."""
+    df = pd.DataFrame(results, columns=None if results else ["indicator_id", "data_referencia", "resultado"])
+    df["data_referencia"] = pd.to_datetime(df["data_referencia"])
+    return df
+
+def _prepare_chart_frame(results_df):
+    """Ordena os resultados por indicador/data e adiciona a coluna data_formatada (Mês/Ano) de forma vetorizada."""
+    df = results_df.sort_values(["indicator_id", "data_referencia"])
+    try:
+        df["data_formatada"] = df["data_referencia"].dt.strftime("%b/%Y")
+    except (ValueError, AttributeError):
+        # Fallback para o formatador escalar se a conversão vetorizada falhar
+        df["data_formatada"] = df["data_referencia"].apply(format_date_as_month_year)
+    return df
+
+# --- Cache de Figuras dos Gráficos ---
+# As figuras Plotly são guardadas serializadas (JSON) em um cache LRU do processo. A chave inclui o indicador,
+# o tipo de gráfico, o tema e a versão dos dados do indicador (data_atualizacao do indicador, maior
+# data_atualizacao e quantidade de resultados), de modo que qualquer escrita gera uma nova chave e os reruns
+# causados por outros widgets reaproveitam a figura sem reconstruí-la.
+
+CHART_CACHE_SIZE = int(os.environ.get("SCPC_CHART_CACHE_SIZE", "256"))
+
+
+class ChartFigureCache:
+    """Cache LRU, compartilhado pelo processo, das figuras dos gráficos serializadas em JSON."""
+
+    def __init__(self, max_size=CHART_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Retorna a figura em cache para a chave (reconstruída do JSON), ou None."""
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return pio.from_json(payload)
+
+    def put(self, key, fig):
+        payload = fig.to_json()
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entradas": len(self._entries),
+                "max": self.max_size,
+                "acertos": self.hits,
+                "falhas": self.misses,
+                "taxa_acerto": self.hits / total if total else 0.0,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_chart_cache():
+    """Retorna o cache de figuras dos gráficos do processo."""
+    return ChartFigureCache()
+
+
+def _theme_key(TEMA_PADRAO):
+    """Hash estável do tema, usado na chave do cache de figuras."""
+    return hashlib.sha256(json.dumps(TEMA_PADRAO, sort_keys=True, default=str).encode()).hexdigest()
 
-    if not indicator_results:
+
+def _chart_cache_key(indicator, chart_type, theme_key, ultima_atualizacao, num_resultados):
+    """Chave do cache de figuras; ultima_atualizacao/num_resultados identificam a versão dos resultados."""
+    return (indicator["id"], chart_type, theme_key, indicator.get("data_atualizacao", ""),
+            str(ultima_atualizacao), int(num_resultados))
+
+
+def _result_versions(results_df):
+    """Retorna {indicator_id: (maior data_atualizacao, quantidade de resultados)}, ou None sem data_atualizacao."""
+    if "data_atualizacao" not in results_df.columns:
         return None
+    grouped = results_df.groupby("indicator_id")["data_atualizacao"].agg(["max", "size"])
+    return {indicator_id: (row["max"], row["size"]) for indicator_id, row in grouped.iterrows()}
 
-    df = pd.DataFrame(indicator_results)
-    df["data_referencia"] = pd.to_datetime(df["data_referencia"])
-    df = df.sort_values("data_referencia")
-    df["data_formatada"] = df["data_referencia"].apply(format_date_as_month_year)
 
-    indicators = load_indicators()
-    indicator = next((ind for ind in indicators if ind["id"] == indicator_id), None)
+def create_chart(indicator_id, chart_type, TEMA_PADRAO, indicator=None, results_df=None):
+    """
+    Cria um gráfico com base no tipo especificado.
+    `indicator` (dicionário do indicador) e `results_df` (resultados apenas deste indicador) podem ser
+    passados já carregados; caso contrário são buscados no banco.
+    """
+    if results_df is None:
+        results_df = results_to_frame(get_results_snapshot([indicator_id]))
+
+    if results_df.empty:
+        return None
+
+    if indicator is None:
+        indicators = get_indicators_snapshot()
+        indicator = next((ind for ind in indicators if ind["id"] == indicator_id), None)
 
     if not indicator:
         return None
 
+    versions = _result_versions(results_df)
+    if versions is None:
+        return _build_chart_figure(indicator, _prepare_chart_frame(results_df), chart_type, TEMA_PADRAO)
+
+    cache = get_chart_cache()
+    key = _chart_cache_key(indicator, chart_type, _theme_key(TEMA_PADRAO), *versions.get(indicator_id, ("", len(results_df))))
+    fig = cache.get(key)
+    if fig is None:
+        fig = _build_chart_figure(indicator, _prepare_chart_frame(results_df), chart_type, TEMA_PADRAO)
+        if fig is not None:
+            cache.put(key, fig)
+    return fig
+
+def create_charts(indicators, results_df, TEMA_PADRAO):
+    """
+    Cria, em uma única passada, os gráficos de vários indicadores.
+    `results_df` contém os resultados de todos os indicadores. As figuras já em cache (mesma versão dos
+    dados) são reaproveitadas; os resultados dos demais são ordenados e formatados uma única vez e
+    agrupados por indicator_id. Retorna um dicionário {indicator_id: figura}.
+    """
+    if results_df is None or results_df.empty:
+        return {}
+    indicators_by_id = {ind["id"]: ind for ind in indicators}
+    results_df = results_df[results_df["indicator_id"].isin(indicators_by_id.keys())]
+
+    figures = {}
+    keys = {}
+    versions = _result_versions(results_df)
+    if versions is not None:
+        cache = get_chart_cache()
+        theme_key = _theme_key(TEMA_PADRAO)
+        for indicator_id, (ultima_atualizacao, num_resultados) in versions.items():
+            indicator = indicators_by_id[indicator_id]
+            keys[indicator_id] = _chart_cache_key(indicator, indicator.get("tipo_grafico", "Linha"), theme_key,
+                                                  ultima_atualizacao, num_resultados)
+            fig = cache.get(keys[indicator_id])
+            if fig is not None:
+                figures[indicator_id] = fig
+        results_df = results_df[~results_df["indicator_id"].isin(figures.keys())]
+        if results_df.empty:
+            return figures
+
+    df = _prepare_chart_frame(results_df)
+    for indicator_id, indicator_df in df.groupby("indicator_id", sort=False):
+        indicator = indicators_by_id[indicator_id]
+        fig = _build_chart_figure(indicator, indicator_df, indicator.get("tipo_grafico", "Linha"), TEMA_PADRAO)
+        if fig is not None:
+            figures[indicator_id] = fig
+            if indicator_id in keys:
+                cache.put(keys[indicator_id], fig)
+    return figures
+
+def _build_chart_figure(indicator, df, chart_type, TEMA_PADRAO):
+    """Monta a figura Plotly de um indicador a partir dos seus resultados já ordenados e formatados."""
     chart_colors = TEMA_PADRAO["chart_colors"]
     is_dark = TEMA_PADRAO["is_dark"]
     background_color = TEMA_PADRAO["background_color"]
@@ -1234,6 +2997,13 @@ def show_login_page():
         st.markdown("<hr style='height: 2px; background: #E0E0E0; border: none; margin: 20px 0;'>", unsafe_allow_html=True)
         st.markdown("<h3 style='font-size: 18px; color: #455A64; margin-bottom: 15px;'>Acesse sua conta</h3>", unsafe_allow_html=True)
 
+        # Relatório da restauração de backup que acabou de encerrar a sessão (linhas e tempo por tabela)
+        restore_report = st.session_state.get("restore_report")
+        if restore_report:
+            st.success("Backup restaurado com sucesso. Acesse novamente para continuar.")
+            with st.expander("Tempo de restauração por tabela"):
+                st.dataframe(pd.DataFrame(restore_report), use_container_width=True, hide_index=True)
+
         with st.form("login_form"):
             username = st.text_input("Nome de usuário", placeholder="Digite seu nome de usuário")
             password = st.text_input("Senha", type="password", placeholder="Digite sua senha")
@@ -1243,63 +3013,155 @@ def show_login_page():
                 if username and password:
                     with st.spinner("Verificando..."):
                         time.sleep(0.5)
-                        if verify_credentials(username, password):
-                            st.session_state.authenticated = True
-                            st.session_state.username = username
-                            # Carregar tipo e setores após login bem-sucedido
-                            users_data = load_users()
-                            user_info = users_data.get(username, {})
-                            st.session_state.user_type = user_info.get("tipo", "Visualizador")
-                            st.session_state.user_sectors = user_info.get("setores", []) # Carrega a lista de setores
-                            st.success("Login realizado com sucesso!")
-                            time.sleep(0.8)
-                            st.rerun()
+                        # A versão é lida antes da consulta, para que uma edição concorrente invalide o perfil
+                        profile_version = get_data_version(_user_cache_key(username), "usuarios:todos")
+                        try:
+                            profile = authenticate(username, password) # Senha, tipo e setores em uma única consulta
+                        except UserProfileUnavailable:
+                            st.error("Não foi possível acessar o banco de dados. Tente novamente em instantes.")
                         else:
-                            st.error("Usuário ou senha incorretos.")
+                            if profile:
+                                st.session_state.pop("restore_report", None) # Relatório já visto na página de login
+                                st.session_state.authenticated = True
+                                st.session_state.username = username
+                                _store_session_profile(profile, profile_version)
+                                st.success("Login realizado com sucesso!")
+                                time.sleep(0.8)
+                                st.rerun()
+                            else:
+                                st.error("Usuário ou senha incorretos.")
                 else:
                     st.error("Por favor, preencha todos os campos.")
         st.markdown("<p style='text-align: center; font-size: 12px; color: #78909C; margin-top: 30px;'>© 2025 Portal de Indicadores - Santa Casa</p>", unsafe_allow_html=True)
 
+# Perfil do usuário (tipo e setores) lido em uma única consulta, com os setores agregados em array
+USER_PROFILE_SQL = """
+    SELECT u.password_hash, u.tipo, u.nome_completo, u.email,
+           COALESCE(array_agg(s.setor ORDER BY s.setor) FILTER (WHERE s.setor IS NOT NULL), '{}') AS setores
+    FROM usuarios u
+    LEFT JOIN usuario_setores s ON s.username = u.username
+    WHERE u.username = %s
+    GROUP BY u.username;
+"""
+
+
+def _user_cache_key(username):
+    """Chave de versão usada para invalidar o perfil em cache de um único usuário."""
+    return f"usuario:{username}"
+
+
+class UserProfileUnavailable(Exception):
+    """Levantada quando o perfil do usuário não pôde ser lido (banco indisponível), para não confundir com usuário inexistente."""
+
+
+def _query_user_profile(username):
+    """
+    Retorna (password_hash, perfil) do usuário, ou (None, None) se ele não existir.
+    Levanta UserProfileUnavailable se não houver conexão ou a consulta falhar.
+    """
+    conn = get_db_connection()
+    if conn is None:
+        raise UserProfileUnavailable("Sem conexão com o banco de dados")
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute(USER_PROFILE_SQL, (username,))
+        row = cur.fetchone()
+        if not row:
+            return None, None
+        password_hash, tipo, nome_completo, email, setores = row
+        return password_hash, {
+            "username": username,
+            "tipo": tipo,
+            "nome_completo": nome_completo if nome_completo is not None else "",
+            "email": email if email is not None else "",
+            "setores": list(setores),
+        }
+    except psycopg2.Error as e:
+        print(f"Erro ao carregar o perfil do usuário: {e}")
+        raise UserProfileUnavailable(str(e)) from e
+    finally:
+        if cur is not None: cur.close()
+        conn.close()
+
+
+def authenticate(username, password):
+    """
+    Verifica as credenciais e retorna o perfil do usuário (username, tipo, nome_completo, email, setores)
+    em uma única consulta. Retorna None se o usuário não existir ou a senha estiver incorreta;
+    levanta UserProfileUnavailable se o banco estiver indisponível.
+    """
+    password_hash, profile = _query_user_profile(username)
+    if profile is None:
+        return None
+    input_hash = hashlib.sha256(password.encode()).hexdigest() # Considerar usar bcrypt/scrypt
+    if not hmac.compare_digest(password_hash or "", input_hash):
+        return None
+    return profile
+
+
+def load_user_profile(username):
+    """Retorna o perfil do usuário (sem a senha), ou None se ele não existir (UserProfileUnavailable em erro de banco)."""
+    return _query_user_profile(username)[1]
+
+
+def _store_session_profile(profile, version):
+    """Guarda o perfil do usuário logado na sessão, junto com a versão usada para invalidá-lo."""
+    st.session_state.user_profile = profile
+    st.session_state.user_profile_version = version
+    st.session_state.user_type = profile.get("tipo", "Visualizador")
+    st.session_state.user_sectors = profile.get("setores", [])
+
+
+def refresh_session_profile():
+    """
+    Retorna o perfil do usuário logado guardado na sessão, recarregando-o do banco apenas se o
+    usuário foi alterado desde a última leitura. Retorna None se o usuário não existir mais.
+    Se o banco estiver indisponível, mantém o perfil da sessão (a versão não é atualizada, então a
+    leitura é repetida no próximo rerun) e exibe um erro, em vez de encerrar a sessão.
+    """
+    username = st.session_state.get("username")
+    version = get_data_version(_user_cache_key(username), "usuarios:todos")
+    profile = st.session_state.get("user_profile")
+    if profile is not None and st.session_state.get("user_profile_version") == version:
+        return profile
+    try:
+        profile = load_user_profile(username)
+    except UserProfileUnavailable:
+        st.error("Não foi possível atualizar o perfil do usuário: banco de dados indisponível. Usando os dados da sessão.")
+        return st.session_state.get("user_profile")
+    if profile is not None:
+        _store_session_profile(profile, version)
+    return profile
+
+
 def verify_credentials(username, password):
     """Verifica as credenciais do usuário diretamente do banco de dados."""
-    conn = get_db_connection()
-    if conn:
-        cur = None
-        try:
-            cur = conn.cursor()
-            # A query agora só precisa da senha_hash e tipo da tabela usuarios
-            cur.execute("SELECT password_hash, tipo FROM usuarios WHERE username = %s;", (username,))
-            result = cur.fetchone()
-            if result:
-                stored_hash = result[0]
-                # tipo_usuario = result[1] # Não precisamos do tipo aqui, apenas para verificar credenciais
-                input_hash = hashlib.sha256(password.encode()).hexdigest() # Considerar usar bcrypt/scrypt
-                return stored_hash == input_hash
-            return False
-        except psycopg2.Error as e:
-            print(f"Erro ao verificar credenciais: {e}")
-            return False
-        finally:
-            if cur is not None: cur.close()
-            if conn is not None: conn.close()
-    return False
+    try:
+        return authenticate(username, password) is not None
+    except UserProfileUnavailable:
+        return False
 
 def get_user_type(username):
     """Obtém o tipo de usuário."""
-    # Esta função agora carrega todos os usuários para encontrar o tipo
-    users = load_users()
-    if username in users:
-        return users[username].get("tipo", "Visualizador")
-    return "Visualizador"
+    profile = st.session_state.get("user_profile")
+    if profile is None or profile.get("username") != username:
+        try:
+            profile = load_user_profile(username)
+        except UserProfileUnavailable:
+            profile = None
+    return profile.get("tipo", "Visualizador") if profile else "Visualizador"
 
 def get_user_sectors(username):
     """Obtém a lista de setores do usuário."""
-     # Esta função agora carrega todos os usuários para encontrar os setores
-    users = load_users()
-    if username in users:
-        return users[username].get("setores", [])
+    profile = st.session_state.get("user_profile")
+    if profile is None or profile.get("username") != username:
+        try:
+            profile = load_user_profile(username)
+        except UserProfileUnavailable:
+            profile = None
     # Se o usuário não for encontrado, retorna uma lista vazia
-    return []
+    return profile.get("setores", []) if profile else []
 
 
 def create_indicator(SETORES, TIPOS_GRAFICOS):
@@ -1332,7 +3194,7 @@ def create_indicator(SETORES, TIPOS_GRAFICOS):
         formula_value = st.session_state.get(f"{form_prefix}formula_input", "")
         if formula_value:
             # Detecta variáveis (letras) na fórmula
-            current_detected_vars = sorted(list(set(re.findall(r'[a-zA-Z]+', formula_value))))
+            current_detected_vars = formula_variables(formula_value)
             st.session_state[f'{form_prefix}current_formula_vars'] = current_detected_vars
 
             # Mantém descrições existentes para variáveis que ainda estão na fórmula
@@ -1413,43 +3275,13 @@ def create_indicator(SETORES, TIPOS_GRAFICOS):
                      if not formula_str:
                          st.warning("⚠️ Por favor, insira uma fórmula para testar.")
                          st.session_state[f'{form_prefix}test_result'] = None
-                     elif not variable_values and formula_str:
-                          # Caso da fórmula sem variáveis
-                          try:
-                              calculated_result = float(sympify(formula_str))
-                              st.session_state[f'{form_prefix}test_result'] = calculated_result
-                          except (SympifyError, ValueError) as e:
-                              st.error(f"❌ Erro ao calcular a fórmula: Verifique a sintaxe. Detalhes: {e}")
-                              st.session_state[f'{form_prefix}test_result'] = None
-                          except Exception as e:
-                              st.error(f"❌ Erro inesperado ao calcular a fórmula: {e}")
-                              st.session_state[f'{form_prefix}test_result'] = None
-                     elif variable_values:
-                          # Caso da fórmula com variáveis
+                     else:
+                          # Compila a fórmula (uma vez, com cache) e avalia com os valores de teste
                           try:
-                              # Cria símbolos para as variáveis
-                              var_symbols = symbols(list(variable_values.keys()))
-                              # Analisa a string da fórmula em uma expressão simbólica
-                              expr = sympify(formula_str, locals=dict(zip(variable_values.keys(), var_symbols)))
-                              # Cria um dicionário de substituição com os valores de teste
-                              # Garante que os valores são float
-                              subs_dict = {symbols(var): float(value) for var, value in variable_values.items()}
-                              # Avalia a expressão com os valores de teste
-                              calculated_result = float(expr.subs(subs_dict))
-                              st.session_state[f'{form_prefix}test_result'] = calculated_result
-                          except SympifyError as e:
-                              st.error(f"❌ Erro ao calcular a fórmula: Verifique a sintaxe. Detalhes: {e}")
+                              st.session_state[f'{form_prefix}test_result'] = compile_formula(formula_str).evaluate(variable_values)
+                          except FormulaError as e:
+                              st.error(f"❌ Erro ao calcular a fórmula: {e}")
                               st.session_state[f'{form_prefix}test_result'] = None
-                          except ZeroDivisionError:
-                              st.error("❌ Erro ao calcular a fórmula: Divisão por zero com os valores de teste fornecidos.")
-                              st.session_state[f'{form_prefix}test_result'] = None
-                          except Exception as e:
-                               # Tratamento específico para erro comum de variáveis não mapeadas
-                               if "cannot create 'dict_keys' instances" in str(e):
-                                   st.error("❌ Erro interno ao processar as variáveis da fórmula. Verifique se as variáveis na fórmula correspondem às variáveis definidas para o indicador.")
-                               else:
-                                   st.error(f"❌ Erro inesperado ao calcular a fórmula: {e}")
-                               st.session_state[f'{form_prefix}test_result'] = None
                 # Exibe o resultado do teste se disponível
                 if st.session_state.get(f'{form_prefix}test_result') is not None:
                      unidade_value = st.session_state.get(f"{form_prefix}unidade_input", "")
@@ -1503,15 +3335,9 @@ def create_indicator(SETORES, TIPOS_GRAFICOS):
                 # Validação da fórmula usando sympy
                 if formula_submitted:
                     try:
-                        # Cria símbolos apenas para as variáveis detectadas na fórmula submetida
-                        vars_in_submitted_formula = sorted(list(set(re.findall(r'[a-zA-Z]+', formula_submitted))))
-                        var_symbols = symbols(vars_in_submitted_formula)
-                        # Tenta analisar a fórmula
-                        sympify(formula_submitted, locals=dict(zip(vars_in_submitted_formula, var_symbols)))
-                    except (SympifyError, ValueError, TypeError) as e:
-                         st.error(f"❌ Erro na sintaxe da fórmula: {e}"); return # Impede a criação se a fórmula for inválida
-                    except Exception as e:
-                         st.error(f"❌ Erro inesperado ao validar a fórmula: {e}"); return # Impede a criação
+                        compile_formula(formula_submitted) # Valida (e deixa em cache) a fórmula compilada
+                    except FormulaError as e:
+                         st.error(f"❌ {e}"); return # Impede a criação se a fórmula for inválida
 
                 with st.spinner("Criando indicador..."):
                     time.sleep(0.5) # Pequeno delay para simular processamento
@@ -1572,7 +3398,7 @@ def edit_indicator(SETORES, TIPOS_GRAFICOS):
 
     # Garante que a lista de indicadores no estado da sessão esteja atualizada
     if "indicators" not in st.session_state or not st.session_state["indicators"]:
-         st.session_state["indicators"] = load_indicators()
+         st.session_state["indicators"] = get_indicators_snapshot()
     indicators = st.session_state["indicators"]
 
 
@@ -1610,7 +3436,7 @@ def edit_indicator(SETORES, TIPOS_GRAFICOS):
              st.session_state.editing_indicator_id = selected_indicator["id"]
              # Carrega as variáveis da fórmula e descrições existentes para o estado da sessão
              existing_formula = selected_indicator.get("formula", "")
-             st.session_state.current_formula_vars = sorted(list(set(re.findall(r'[a-zA-Z]+', existing_formula))))
+             st.session_state.current_formula_vars = formula_variables(existing_formula)
              st.session_state.current_var_descriptions = selected_indicator.get("variaveis", {})
              # Garante que todas as variáveis detectadas na fórmula tenham uma entrada na descrição (mesmo que vazia)
              for var in st.session_state.current_formula_vars:
@@ -1638,7 +3464,7 @@ def edit_indicator(SETORES, TIPOS_GRAFICOS):
             unidade = st.text_input("Unidade do Resultado", value=selected_indicator.get("unidade", ""), placeholder="Ex: %", key=f"edit_unidade_input_{selected_indicator['id']}")
             formula = st.text_input("Fórmula de Cálculo (Use letras para variáveis, ex: A+B/C)", value=selected_indicator.get("formula", ""), placeholder="Ex: (DEMISSOES / TOTAL_FUNCIONARIOS) * 100", key=f"edit_formula_input_{selected_indicator['id']}")
             # Verifica se as variáveis na fórmula mudaram e atualiza o estado da sessão
-            current_detected_vars = sorted(list(set(re.findall(r'[a-zA-Z]+', formula))))
+            current_detected_vars = formula_variables(formula)
             if st.session_state.current_formula_vars != current_detected_vars:
                  st.session_state.current_formula_vars = current_detected_vars
                  # Mantém descrições existentes para variáveis que ainda estão na nova fórmula
@@ -1684,6 +3510,10 @@ def edit_indicator(SETORES, TIPOS_GRAFICOS):
             comparacao = st.selectbox("Comparação", ["Maior é melhor", "Menor é melhor"], index=0 if selected_indicator.get("comparacao", "Maior é melhor") == "Maior é melhor" else 1)
             tipo_grafico = st.selectbox("Tipo de Gráfico Padrão", TIPOS_GRAFICOS, index=TIPOS_GRAFICOS.index(selected_indicator.get("tipo_grafico", "Linha")) if selected_indicator.get("tipo_grafico", "Linha") in TIPOS_GRAFICOS else 0)
             responsavel = st.selectbox("Setor Responsável", SETORES, index=SETORES.index(selected_indicator.get("responsavel", SETORES[0])) if selected_indicator.get("responsavel", SETORES[0]) in SETORES else 0) # Indicador ainda é responsável por um único setor
+            # Recalcula os resultados já lançados a partir dos valores das variáveis salvos
+            recalcular_historico = st.checkbox("Recalcular histórico de resultados com a fórmula salva",
+                                               value=False, key=f"recalc_history_{selected_indicator['id']}",
+                                               help="Recalcula todos os resultados deste indicador a partir dos valores das variáveis informados em cada período.")
 
             # Botões Salvar e Excluir
             col1, col2, col3 = st.columns([1, 3, 1])
@@ -1698,15 +3528,9 @@ def edit_indicator(SETORES, TIPOS_GRAFICOS):
                 # Validação da fórmula antes de salvar
                 if formula:
                     try:
-                        # Cria símbolos para as variáveis detectadas na fórmula submetida
-                        vars_in_submitted_formula = sorted(list(set(re.findall(r'[a-zA-Z]+', formula))))
-                        var_symbols = symbols(vars_in_submitted_formula)
-                        # Tenta analisar a fórmula
-                        sympify(formula, locals=dict(zip(vars_in_submitted_formula, var_symbols)))
-                    except SympifyError as e:
-                         st.error(f"❌ Erro na sintaxe da fórmula: {e}"); return # Impede salvar se a fórmula for inválida
-                    except Exception as e:
-                         st.error(f"❌ Erro inesperado ao validar a fórmula: {e}"); return # Impede salvar
+                        compile_formula(formula, indicator_id=selected_indicator["id"]) # Valida (e deixa em cache) a fórmula compilada
+                    except FormulaError as e:
+                         st.error(f"❌ {e}"); return # Impede salvar se a fórmula for inválida
 
                 # Validação dos campos obrigatórios
                 if nome and objetivo and formula: # Fórmula ainda é considerada obrigatória
@@ -1732,11 +3556,16 @@ def edit_indicator(SETORES, TIPOS_GRAFICOS):
 
                         # *** CORREÇÃO AQUI: Verificar o resultado de save_indicators ***
                         if save_indicators(indicators): # Salva a lista atualizada no banco de dados e verifica
-                             st.session_state["indicators"] = load_indicators() # Recarrega do DB para garantir consistência
+                             st.session_state["indicators"] = get_indicators_snapshot() # Recarrega do DB para garantir consistência
                              log_indicator_action("Indicador atualizado", selected_indicator["id"], st.session_state.username) # Log
 
                              with st.spinner("Atualizando indicador..."):
                                  st.success(f"✅ Indicador '{nome}' atualizado com sucesso!")
+                                 if recalcular_historico:
+                                     report = recalculate_indicator_history(selected_indicator["id"], st.session_state.username)
+                                     show_recalculation_report(report)
+                                     if report and report["invalidos"]:
+                                         time.sleep(3) # Tempo extra para ler o relatório antes do rerun
                                  time.sleep(2) # Aguarda um pouco
 
                              # Limpa o estado da sessão relacionado à edição para voltar à seleção
@@ -1795,7 +3624,7 @@ def edit_indicator(SETORES, TIPOS_GRAFICOS):
 
                  # --- CORREÇÃO APLICADA AQUI ---
                  # Recarrega a lista de indicadores no estado da sessão após exclusão bem-sucedida
-                 st.session_state["indicators"] = load_indicators()
+                 st.session_state["indicators"] = get_indicators_snapshot()
                  # --- FIM DA CORREÇÃO ---
 
                  scroll_to_top()
@@ -1816,6 +3645,7 @@ def delete_indicator(indicator_id, user_performed):
             # pois a chave estrangeira em 'resultados' tem ON DELETE CASCADE
             cur.execute("DELETE FROM indicadores WHERE id = %s;", (indicator_id,))
             conn.commit()
+            invalidate_data_cache("indicadores", "resultados", "indicator_summary")
             log_indicator_action("Indicador excluído", indicator_id, user_performed) # Log
             # Recarrega a lista de usuários no estado da sessão após exclusão bem-sucedida
             # Note: users = load_users() dentro show_user_management será chamado no próximo rerun
@@ -1841,9 +3671,8 @@ def fill_indicator(SETORES, TEMA_PADRAO):
     """Mostra a página de preenchimento de indicador com calculadora dinâmica."""
     st.markdown('<div class="dashboard-card">', unsafe_allow_html=True)
     st.header("Preencher Indicador")
-    # Carrega indicadores e resultados
-    indicators = load_indicators()
-    results = load_results()
+    # Carrega indicadores (os resultados são carregados apenas para o indicador selecionado)
+    indicators = get_indicators_snapshot()
 
     if not indicators:
         st.info("Nenhum indicador cadastrado. Utilize a opção 'Criar Indicador' para começar.")
@@ -1907,34 +3736,16 @@ def fill_indicator(SETORES, TEMA_PADRAO):
         st.markdown("---")
 
         # Obter resultados existentes para este indicador
-        indicator_results = [r for r in results if r["indicator_id"] == selected_indicator["id"]]
+        indicator_results = get_results_snapshot([selected_indicator["id"]])
 
-        # Identificar períodos já preenchidos
-        filled_periods = set()
-        for result in indicator_results:
-            if "data_referencia" in result:
-                try:
-                    # Converte para Period para comparar apenas Mês/Ano
-                    date_ref = pd.to_datetime(result["data_referencia"]).to_period('M')
-                    filled_periods.add(date_ref)
-                except:
-                    # Ignora resultados com data inválida
-                    pass
-
-        # Gerar lista de períodos disponíveis (últimos 5 anos + ano atual, até o mês atual)
-        current_date = datetime.now()
-        available_periods = []
-        # Loop pelos anos
-        for year in range(current_date.year - 5, current_date.year + 1):
-            # Loop pelos meses
-            for month in range(1, 13):
-                period = pd.Period(year=year, month=month, freq='M')
-                # Ignora períodos futuros
-                if period > pd.Period(current_date, freq='M'):
-                    continue
-                # Adiciona o período se ainda não foi preenchido
-                if period not in filled_periods:
-                    available_periods.append(period)
+        # Períodos em aberto (últimos FILL_LOOKBACK_YEARS anos + ano atual, até o período atual), do mais recente
+        # para o mais antigo; os períodos já preenchidos vêm do banco como um conjunto de chaves inteiras
+        filled_periods = get_filled_periods_snapshot(selected_indicator["id"], FILL_FREQUENCY)
+        if filled_periods is None:
+            st.error("Erro ao carregar os períodos já preenchidos deste indicador. Verifique o console.")
+            st.markdown('</div>', unsafe_allow_html=True)
+            return
+        available_periods = missing_period_keys(filled_periods, FILL_FREQUENCY)
 
         # Se não há períodos disponíveis para preencher
         if not available_periods:
@@ -1944,16 +3755,13 @@ def fill_indicator(SETORES, TEMA_PADRAO):
             # Formulário para adicionar um novo resultado
             with st.form(key=f"add_result_form_{selected_indicator['id']}"): # Chave única para o formulário
 
-                # Ordena os períodos disponíveis do mais recente para o mais antigo
-                available_periods.sort(reverse=True)
-                # Cria as opções para o selectbox
-                period_options = [f"{p.strftime('%B/%Y')}" for p in available_periods]
-                # Seleciona o período
-                selected_period_str = st.selectbox("Selecione o período para preenchimento:", period_options)
-                # Encontra o objeto Period selecionado
-                selected_period = next((p for p in available_periods if p.strftime('%B/%Y') == selected_period_str), None)
-                # Extrai mês e ano
-                selected_month, selected_year = selected_period.month, selected_period.year if selected_period else (None, None)
+                # Seleciona o período (as opções são as chaves; o rótulo só é usado na exibição)
+                selected_period = st.selectbox("Selecione o período para preenchimento:", available_periods,
+                                               format_func=lambda key: period_label(key, FILL_FREQUENCY))
+                selected_period_str = period_label(selected_period, FILL_FREQUENCY)
+                # Extrai mês e ano (primeiro mês do período)
+                selected_period_start = period_start(selected_period, FILL_FREQUENCY)
+                selected_month, selected_year = selected_period_start.month, selected_period_start.year
 
                 calculated_result = None
                 # Verifica se o indicador tem fórmula e variáveis para o cálculo
@@ -2097,41 +3905,14 @@ def fill_indicator(SETORES, TEMA_PADRAO):
                 if not formula_str:
                     st.warning("⚠️ Por favor, insira uma fórmula para testar.")
                     st.session_state[calculated_result_state_key] = None
-                elif not variable_values and formula_str:
-                    # Caso da fórmula sem variáveis
-                    try:
-                        calculated_result = float(sympify(formula_str))
-                        st.session_state[calculated_result_state_key] = calculated_result
-                    except (SympifyError, ValueError) as e:
-                        st.error(f"❌ Erro ao calcular a fórmula: Verifique a sintaxe. Detalhes: {e}")
-                        st.session_state[calculated_result_state_key] = None
-                    except Exception as e:
-                        st.error(f"❌ Erro inesperado ao calcular a fórmula: {e}")
-                        st.session_state[calculated_result_state_key] = None
-                elif variable_values:
-                    # Caso da fórmula com variáveis
+                else:
+                    # Usa a fórmula compilada em cache (analisada uma única vez por indicador/fórmula)
                     try:
-                        # Cria símbolos para as variáveis
-                        var_symbols = symbols(list(variable_values.keys()))
-                        # Analisa a string da fórmula em uma expressão simbólica
-                        expr = sympify(formula_str, locals=dict(zip(variable_values.keys(), var_symbols)))
-                        # Cria um dicionário de substituição com os valores de teste
-                        # Garante que os valores são float
-                        subs_dict = {symbols(var): float(value) for var, value in variable_values.items()}
-                        # Avalia a expressão com os valores de teste
-                        calculated_result = float(expr.subs(subs_dict))
-                        st.session_state[calculated_result_state_key] = calculated_result
-                    except SympifyError as e:
-                        st.error(f"❌ Erro ao calcular a fórmula: Verifique a sintaxe. Detalhes: {e}")
-                        st.session_state[calculated_result_state_key] = None
-                    except ZeroDivisionError:
-                        st.error("❌ Erro ao calcular a fórmula: Divisão por zero com os valores de teste fornecidos.")
-                        st.session_state[calculated_result_state_key] = None
-                    except Exception as e:
-                        if "cannot create 'dict_keys' instances" in str(e):
-                            st.error("❌ Erro interno ao processar as variáveis da fórmula. Verifique se as variáveis na fórmula correspondem às variáveis definidas para o indicador.")
-                        else:
-                            st.error(f"❌ Erro inesperado ao calcular a fórmula: {e}")
+                        compiled = compile_formula(formula_str, indicator_id=selected_indicator["id"],
+                                                   variables=list(selected_indicator.get("variaveis", {}).keys()) or None)
+                        st.session_state[calculated_result_state_key] = compiled.evaluate(variable_values)
+                    except FormulaError as e:
+                        st.error(f"❌ Erro ao calcular a fórmula: {e}")
                         st.session_state[calculated_result_state_key] = None
                 
                 # FORÇA UM NOVO RERUN PARA QUE A UI SE ATUALIZE COM O RESULTADO CALCULADO NO SESSION_STATE
@@ -2173,27 +3954,17 @@ def fill_indicator(SETORES, TEMA_PADRAO):
                     status_analise = get_analise_status(analise_critica)
                     analise_critica["status_preenchimento"] = status_analise # Salva o status na análise
 
-                    # Cria o objeto do novo resultado
-                    new_result = {
-                        "indicator_id": selected_indicator["id"],
-                        "data_referencia": data_referencia_iso,
-                        "resultado": final_result_to_save,
-                        "valores_variaveis": values_to_save, # Salva os valores das variáveis
-                        "observacao": observacoes,
-                        "analise_critica": analise_critica, # Salva a análise crítica completa
-                        "data_criacao": datetime.now().isoformat(),
-                        "data_atualizacao": datetime.now().isoformat(), # Usa data atual para atualização
-                        "usuario": user_name, # Salva o nome do usuário que preencheu
-                        "status_analise": status_analise # Salva o status da análise
-                    }
-
-                    # Carrega todos os resultados, remove o resultado existente para o período (se houver) e adiciona o novo/atualizado
-                    all_results = load_results()
-                    all_results = [r for r in all_results if not (r["indicator_id"] == new_result["indicator_id"] and r["data_referencia"] == new_result["data_referencia"])]
-                    all_results.append(new_result)
-
-                    # *** CORREÇÃO AQUI: Verificar o resultado de save_results ***
-                    if save_results(all_results): # Salva a lista atualizada de resultados no DB e verifica
+                    # Grava apenas o resultado deste período (INSERT ... ON CONFLICT), sem reescrever a tabela
+                    if upsert_result(
+                        selected_indicator["id"],
+                        data_referencia_iso,
+                        final_result_to_save,
+                        valores_variaveis=values_to_save, # Salva os valores das variáveis
+                        observacao=observacoes,
+                        analise_critica=analise_critica, # Salva a análise crítica completa
+                        usuario=user_name, # Salva o nome do usuário que preencheu
+                        status_analise=status_analise # Salva o status da análise
+                    ):
                          with st.spinner("Salvando resultado..."):
                             st.success(f"✅ Resultado adicionado/atualizado com sucesso para {datetime(selected_year, selected_month, 1).strftime('%B/%Y')}!")
                             time.sleep(2) # Pequeno delay
@@ -2305,8 +4076,10 @@ def fill_indicator(SETORES, TEMA_PADRAO):
                              # Adiciona uma chave única para cada botão de exclusão
                             if st.button("🗑️", key=f"delete_result_{result.get('data_referencia')}_{selected_indicator['id']}_fill"):
                                 # Chama a função para deletar o resultado
-                                delete_result(selected_indicator['id'], data_referencia, st.session_state.username)
-                                # O delete_result já chama st.rerun() se for bem-sucedido
+                                if delete_result(selected_indicator['id'], data_referencia, st.session_state.username):
+                                    st.rerun()
+                                else:
+                                    st.error("❌ Erro ao excluir o resultado. Verifique o console para detalhes do erro.")
 
                     else:
                          # Mensagem de aviso se o resultado não tiver data de referência
@@ -2371,8 +4144,10 @@ def fill_indicator(SETORES, TEMA_PADRAO):
                              # Adiciona uma chave única para cada botão de exclusão
                             if st.button("🗑️", key=f"delete_result_{result.get('data_referencia')}_{selected_indicator['id']}_fill"):
                                 # Chama a função para deletar o resultado
-                                delete_result(selected_indicator['id'], data_referencia, st.session_state.username)
-                                # O delete_result já chama st.rerun() se for bem-sucedido
+                                if delete_result(selected_indicator['id'], data_referencia, st.session_state.username):
+                                    st.rerun()
+                                else:
+                                    st.error("❌ Erro ao excluir o resultado. Verifique o console para detalhes do erro.")
 
                     else:
                          # Mensagem de aviso se o resultado não tiver data de referência
@@ -2383,11 +4158,9 @@ def fill_indicator(SETORES, TEMA_PADRAO):
 
         st.markdown("---")
         # Expander para o log de preenchimentos
-        # Carrega os logs de resultados especificamente para este indicador
-        all_results_log = load_results()
-        log_results = [r for r in all_results_log if r.get("indicator_id") == selected_indicator["id"]]
+        # Reutiliza os resultados já carregados para este indicador
         # Ordena os logs pela data de atualização
-        log_results = sorted(log_results, key=lambda x: x.get("data_atualizacao", x.get("data_criacao", "")), reverse=True) # Usa data_criacao como fallback
+        log_results = sorted(indicator_results, key=lambda x: x.get("data_atualizacao", x.get("data_criacao", "")), reverse=True) # Usa data_criacao como fallback
         with st.expander("📜 Log de Preenchimentos (clique para visualizar)", expanded=False):
             if log_results:
                 log_data_list = []
@@ -2420,16 +4193,88 @@ def fill_indicator(SETORES, TEMA_PADRAO):
                     }
                     log_data_list.append(log_entry) # Adiciona à lista de logs
 
-                # Cria um DataFrame e exibe na tabela
-                log_df = pd.DataFrame(log_data_list)
-                # Define a ordem das colunas
-                cols_order = ["Período", "Resultado Salvo", "Valores Variáveis", "Usuário", "Status Análise Crítica", "Data/Hora Preenchimento"]
-                log_df = log_df[cols_order]
-                st.dataframe(log_df, use_container_width=True)
-            else:
-                st.info("Nenhum registro de preenchimento encontrado para este indicador.") # Mensagem se não houver logs
+                # Cria um DataFrame e exibe na tabela
+                log_df = pd.DataFrame(log_data_list)
+                # Define a ordem das colunas
+                cols_order = ["Período", "Resultado Salvo", "Valores Variáveis", "Usuário", "Status Análise Crítica", "Data/Hora Preenchimento"]
+                log_df = log_df[cols_order]
+                st.dataframe(log_df, use_container_width=True)
+            else:
+                st.info("Nenhum registro de preenchimento encontrado para este indicador.") # Mensagem se não houver logs
+    st.markdown('</div>', unsafe_allow_html=True)
+    
+
+def show_import_results():
+    """Mostra a página de importação em lote de resultados a partir de uma planilha (.xlsx/.csv)."""
+    st.markdown('<div class="dashboard-card">', unsafe_allow_html=True)
+    st.header("Importar Resultados")
+
+    user_type = st.session_state.user_type
+    user_sectors = st.session_state.user_sectors # Lista de setores
+    user_name = st.session_state.get("username", "Usuário não identificado")
+    # Operadores só importam resultados dos indicadores dos seus setores
+    allowed_sectors = user_sectors if user_type == "Operador" else None
+
+    indicators = get_indicators_snapshot()
+    if allowed_sectors is not None:
+        indicators = [ind for ind in indicators if ind["responsavel"] in allowed_sectors]
+    if not indicators:
+        st.info("Não há indicadores disponíveis para importação.")
+        st.markdown('</div>', unsafe_allow_html=True)
+        return
+
+    st.markdown("""
+A planilha deve ter uma linha por indicador e período, com as colunas:
+- **indicador**: nome ou ID do indicador
+- **periodo**: mês de referência (ex.: `03/2024` ou `2024-03`)
+- **resultado**: resultado, para indicadores sem fórmula
+- uma coluna para **cada variável** da fórmula (ex.: `A`, `B`), para indicadores com fórmula
+- **observacao** (opcional)
+""")
+    # Modelo com uma linha por indicador e todas as colunas de variáveis
+    variables = sorted({var for ind in indicators for var in (ind.get("variaveis") or {})})
+    template = pd.DataFrame([{"indicador": ind["nome"], "periodo": datetime.now().strftime("%m/%Y"), "resultado": "",
+                              **{var: "" for var in variables}, "observacao": ""} for ind in indicators])
+    st.markdown(get_download_link(template, "modelo_importacao_resultados.xlsx"), unsafe_allow_html=True)
+
+    uploaded_file = st.file_uploader("Planilha de resultados", type=["xlsx", "csv"], key="import_results_file")
+    sobrescrever = st.checkbox("Sobrescrever períodos já preenchidos", key="import_results_overwrite")
+    if uploaded_file is None:
+        st.markdown('</div>', unsafe_allow_html=True)
+        return
+
+    try:
+        df = read_import_file(uploaded_file)
+    except Exception as e:
+        st.error(f"❌ Não foi possível ler a planilha: {e}")
+        st.markdown('</div>', unsafe_allow_html=True)
+        return
+
+    # Validação (sem gravar) para mostrar o relatório antes da importação
+    preview = import_results(df, user_name, allowed_sectors, sobrescrever, dry_run=True)
+    st.info(f"{len(df)} linha(s) lida(s): {preview['validos']} válida(s), {len(preview['erros'])} com erro.")
+    show_import_report(preview)
+
+    if preview["validos"] and st.button(f"📥 Importar {preview['validos']} linha(s) válida(s)", key="import_results_button"):
+        with st.spinner("Importando resultados..."):
+            report = import_results(df, user_name, allowed_sectors, sobrescrever)
+        if report["importados"] is None:
+            st.error("❌ Erro ao gravar os resultados importados. Nenhuma linha foi gravada.")
+            show_import_report(report)
+        else:
+            st.success(f"✅ {report['importados']} resultado(s) importado(s) com sucesso!")
+
     st.markdown('</div>', unsafe_allow_html=True)
-    
+
+
+def show_import_report(report):
+    """Exibe as linhas rejeitadas por import_results, com o motivo de cada uma."""
+    if report["erros"]:
+        st.warning(f"⚠️ {len(report['erros'])} linha(s) não serão importadas:")
+        st.dataframe(pd.DataFrame([{"Linha": linha if linha is not None else "-", "Motivo": message}
+                                   for linha, message in report["erros"]]), use_container_width=True, hide_index=True)
+
+
 # Função auxiliar para obter o status de preenchimento da análise crítica
 def get_analise_status(analise_dict):
     """Função auxiliar para verificar o status de preenchimento da análise crítica."""
@@ -2470,15 +4315,110 @@ def calculate_status(result, meta, comparacao):
         return "N/A"
 
 
+def compute_status(resultados, metas, comparacoes):
+    """
+    Versão vetorizada de calculate_status: recebe Series/arrays (ou escalares) de resultados, metas e
+    comparações e retorna um array com 'Acima da Meta', 'Abaixo da Meta' ou 'N/A' para cada posição.
+    """
+    resultados = pd.to_numeric(pd.Series(resultados), errors="coerce").to_numpy(dtype=float)
+    metas = np.broadcast_to(pd.to_numeric(pd.Series(metas), errors="coerce").fillna(0.0).to_numpy(dtype=float), resultados.shape)
+    comparacoes = np.broadcast_to(pd.Series(comparacoes).to_numpy(dtype=object), resultados.shape)
+    maior = comparacoes == "Maior é melhor"
+    menor = comparacoes == "Menor é melhor"
+    acima = (maior & (resultados >= metas)) | (menor & (resultados <= metas))
+    return np.select([np.isnan(resultados) | ~(maior | menor), acima], ["N/A", "Acima da Meta"], "Abaixo da Meta")
+
+
+def compute_indicator_analytics(indicators_df, results_df):
+    """
+    Calcula, para todos os indicadores de uma vez (groupby/merge e comparações vetorizadas):
+    último resultado e sua data, resultado anterior, quantidade de resultados, status em relação à meta
+    (respeitando `comparacao`), variação percentual vs meta e tendência dos 3 últimos resultados numéricos.
+    `indicators_df` precisa das colunas id, meta e comparacao; `results_df` das colunas indicator_id,
+    data_referencia (datetime) e resultado.
+    Retorna um DataFrame indexado pelo id do indicador com as colunas ultimo_resultado, data_referencia,
+    data_formatada, resultado_anterior, num_resultados, status, variacao e tendencia.
+    """
+    out = indicators_df.set_index("id")[["meta", "comparacao"]].copy()
+    out["meta"] = pd.to_numeric(out["meta"], errors="coerce").fillna(0.0)
+    out["comparacao"] = out["comparacao"].fillna("Maior é melhor")
+
+    res = results_df.reindex(columns=["indicator_id", "data_referencia", "resultado"]).copy()
+    res["resultado"] = pd.to_numeric(res["resultado"], errors="coerce")
+    res = res.sort_values(["indicator_id", "data_referencia"], ascending=[True, False])
+    res["posicao"] = res.groupby("indicator_id").cumcount()
+
+    latest = res[res["posicao"] == 0].set_index("indicator_id")
+    out["ultimo_resultado"] = latest["resultado"]
+    out["data_referencia"] = latest["data_referencia"]
+    out["resultado_anterior"] = res[res["posicao"] == 1].set_index("indicator_id")["resultado"]
+    out["num_resultados"] = res.groupby("indicator_id").size().reindex(out.index, fill_value=0)
+
+    # Status: sem resultados, N/A (não numérico) ou comparação com a meta
+    out["status"] = compute_status(out["ultimo_resultado"], out["meta"], out["comparacao"])
+    out.loc[out["num_resultados"] == 0, "status"] = "Sem Resultados"
+
+    # Variação vs meta (%); com meta zero, ±infinito conforme o sinal do resultado
+    r = out["ultimo_resultado"].to_numpy(dtype=float)
+    meta = out["meta"].to_numpy(dtype=float)
+    menor = (out["comparacao"] == "Menor é melhor").to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relativa = (r / meta - 1) * 100
+    relativa = np.where(menor, -relativa, relativa)
+    sem_meta = np.where(r > 0, np.inf, np.where(r < 0, -np.inf, 0.0))
+    out["variacao"] = np.nan_to_num(np.where(meta != 0, relativa, sem_meta), nan=0.0, posinf=np.inf, neginf=-np.inf)
+
+    # Tendência dos 3 últimos resultados numéricos (t0 = mais recente)
+    numeric = res[res["resultado"].notna()].copy()
+    numeric["posicao"] = numeric.groupby("indicator_id").cumcount()
+    ultimos = numeric[numeric["posicao"] < 3].pivot(index="indicator_id", columns="posicao", values="resultado")
+    ultimos = ultimos.reindex(index=out.index, columns=[0, 1, 2])
+    t0, t1, t2 = (ultimos[c].to_numpy(dtype=float) for c in (0, 1, 2))
+    subindo = (t0 > t1) & (t1 > t2)
+    descendo = (t0 < t1) & (t1 < t2)
+    # Para "Menor é melhor", resultados em queda são considerados tendência "crescente" (de melhora)
+    crescente = np.where(menor, descendo, subindo)
+    decrescente = np.where(menor, subindo, descendo)
+    tendencia = np.select([crescente, decrescente], ["crescente", "decrescente"], "estável").astype(object)
+    tendencia[np.isnan(t2)] = None
+    out["tendencia"] = pd.Series(tendencia, index=out.index, dtype=object) # object: mantém None (pandas 3 inferiria str/NaN)
+
+    out["data_referencia"] = pd.to_datetime(out["data_referencia"])
+    out["data_formatada"] = out["data_referencia"].dt.strftime("%b/%Y").fillna("N/A")
+    return out
+
+
+def format_variacao(variacao):
+    """Formata a variação vs meta para exibição/exportação (tratando infinitos)."""
+    if variacao == float('inf'): return "+Inf"
+    if variacao == float('-inf'): return "-Inf"
+    if isinstance(variacao, (int, float)): return f"{variacao:.2f}%"
+    return "N/A"
+
+
+# Quantidade de cards de indicadores exibidos por página no dashboard
+DASHBOARD_PAGE_SIZE = int(os.environ.get("SCPC_DASHBOARD_PAGE_SIZE", "10"))
+
+
+def resolve_sector_filter(setor_filtro, user_type, user_sectors):
+    """
+    Converte o filtro de setor da tela na lista de setores consultada no banco (None: todos os setores).
+    Operadores ficam sempre restritos aos seus próprios setores, mesmo com "Todos" selecionado no filtro.
+    """
+    setores = None if not setor_filtro or "Todos" in setor_filtro else list(setor_filtro)
+    if user_type == "Operador" and user_sectors and "Todos" not in user_sectors:
+        setores = [s for s in (setores if setores is not None else user_sectors) if s in user_sectors]
+    return setores
+
+
 def show_dashboard(SETORES, TEMA_PADRAO):
     """Mostra o dashboard de indicadores."""
     st.markdown('<div class="dashboard-card">', unsafe_allow_html=True)
     st.header("Dashboard de Indicadores")
-    # Carrega indicadores e resultados
-    indicators = load_indicators()
-    results = load_results()
+    # Carrega apenas os setores; os indicadores são filtrados no banco depois
+    setores_disponiveis = get_indicator_sectors_snapshot()
 
-    if not indicators:
+    if not setores_disponiveis:
         st.info("Nenhum indicador cadastrado. Utilize a opção 'Criar Indicador' para começar.")
         st.markdown('</div>', unsafe_allow_html=True)
         return
@@ -2490,7 +4430,6 @@ def show_dashboard(SETORES, TEMA_PADRAO):
     col1, col2 = st.columns(2)
     with col1:
         # Filtro de setor agora para dashboard
-        setores_disponiveis = sorted(list(set([ind["responsavel"] for ind in indicators])))
         filter_options = ["Todos"] + setores_disponiveis
 
         # Adapta as opções de filtro para Operadores
@@ -2521,49 +4460,28 @@ def show_dashboard(SETORES, TEMA_PADRAO):
         status_options = ["Todos", "Acima da Meta", "Abaixo da Meta", "Sem Resultados", "N/A"] # Includes N/A
         status_filtro = st.multiselect("Filtrar por Status:", status_options, default=["Todos"], key="dashboard_status_filter")
 
-    # Aplica o filtro por setor
-    filtered_indicators = indicators
-    if setor_filtro and "Todos" not in setor_filtro:
-        filtered_indicators = [ind for ind in indicators if ind["responsavel"] in setor_filtro]
-    # Se user é Operador, aplica filtro adicional baseado nos setores DO USUÁRIO, *depois* do filtro de setor selecionado na UI
-    # Isso garante que um Operador só veja indicadores dos SEUS setores, mesmo que selecione "Todos" no filtro da UI
-    # E se selecionar setores específicos na UI, veja apenas a intersecção entre seus setores e os selecionados.
-    if user_type == "Operador" and user_sectors and "Todos" not in user_sectors:
-         filtered_indicators = [ind for ind in filtered_indicators if ind["responsavel"] in user_sectors]
-
+    # Setores consultados no banco (Operadores ficam restritos aos SEUS setores, mesmo com "Todos" selecionado)
+    setores_consulta = resolve_sector_filter(setor_filtro, user_type, user_sectors)
+    # Contagem por status de todos os indicadores dos setores (antes do filtro de status), feita no banco
+    status_counts = get_status_counts_snapshot(setores_consulta)
+    total_indicators = sum(status_counts.values())
 
-    if not filtered_indicators:
+    if total_indicators == 0:
         selected_setor_display = ", ".join(setor_filtro) if setor_filtro else "selecionado(s)"
         st.warning(f"Nenhum indicador encontrado para o(s) setor(es) {selected_setor_display}.")
         st.markdown('</div>', unsafe_allow_html=True)
         return
 
-    st.subheader("Resumo dos Indicadores")
-    total_indicators = len(filtered_indicators)
-    indicators_with_results = 0
-    indicators_above_target = 0
-    indicators_below_target = 0
-    indicators_na_status = 0 # Counter for N/A status
-
-    # Calcula os resumos
-    for ind in filtered_indicators:
-        ind_results = [r for r in results if r["indicator_id"] == ind["id"]]
-        if ind_results:
-            indicators_with_results += 1
-            # Find the latest result
-            df_results = pd.DataFrame(ind_results)
-            df_results["data_referencia"] = pd.to_datetime(df_results["data_referencia"])
-            df_results = df_results.sort_values("data_referencia", ascending=False)
-            last_result_obj = df_results.iloc[0]
-            last_result = last_result_obj["resultado"]
-            meta = float(ind.get("meta", 0.0)) # Ensures meta is float
-
-            # Use the new function to calculate the status of the last result
-            status_meta = calculate_status(last_result, meta, ind.get("comparacao", "Maior é melhor"))
+    # Indicadores exibidos nos cards: filtros de setor e status aplicados no banco
+    status_consulta = None if not status_filtro or "Todos" in status_filtro else list(status_filtro)
+    filtered_indicators = get_filtered_indicators_snapshot(setores_consulta, status_consulta)
 
-            if status_meta == "Acima da Meta": indicators_above_target += 1
-            elif status_meta == "Abaixo da Meta": indicators_below_target += 1
-            elif status_meta == "N/A": indicators_na_status += 1 # Count N/A results for summary
+    st.subheader("Resumo dos Indicadores")
+    # Cards de resumo e gráfico de status usam a contagem por status de indicator_summary (todos os setores filtrados)
+    indicators_with_results = total_indicators - int(status_counts.get("Sem Resultados", 0))
+    indicators_above_target = int(status_counts.get("Acima da Meta", 0))
+    indicators_below_target = int(status_counts.get("Abaixo da Meta", 0))
+    indicators_na_status = int(status_counts.get("N/A", 0)) # Counter for N/A status
 
 
     # Display summary cards
@@ -2591,79 +4509,75 @@ def show_dashboard(SETORES, TEMA_PADRAO):
          st.info("Não há dados de status para exibir o gráfico.")
 
 
-    st.subheader("Indicadores")
-    indicator_data = [] # List to store display data for each indicator
-
-    # Prepare data for detailed display of each indicator
-    for ind in filtered_indicators:
-        ind_results = [r for r in results if r["indicator_id"] == ind["id"]]
-        unidade_display = ind.get('unidade', '') # Indicator unit
-
-        last_result = "N/A"
-        data_formatada = "N/A"
-        status = "Sem Resultados" # Default status
-        variacao = 0 # Variation vs Meta (numeric)
-        last_result_float = None # Float result for automatic analysis
-
-        if ind_results:
-            # Find the latest result for status and variation calculation
-            df_results = pd.DataFrame(ind_results)
-            df_results["data_referencia"] = pd.to_datetime(df_results["data_referencia"])
-            df_results = df_results.sort_values("data_referencia", ascending=False)
-            last_result_obj = df_results.iloc[0]
-            last_result = last_result_obj["resultado"]
-            last_date = last_result_obj["data_referencia"]
-
-            # Use the new function to calculate the status of the last result
-            status = calculate_status(last_result, ind.get("meta"), ind.get("comparacao", "Maior é melhor"))
-
-            try:
-                # Calculate variation if the last result is numeric
-                meta = float(ind.get("meta", 0.0)) # Ensures meta is float
-                last_result_float = float(last_result) # Try converting result to float
-
-                if meta != 0:
-                    variacao = ((last_result_float / meta) - 1) * 100
-                    # If smaller is better, positive variation is bad (below target) and vice-versa
-                    if ind["comparacao"] == "Menor é melhor": variacao = -variacao # Invert the sign of the variation
-                else:
-                    # Handle zero meta for variation
-                    if last_result_float > 0: variacao = float('inf') # Positive infinity
-                    elif last_result_float < 0: variacao = float('-inf') # Negative infinity
-                    else: variacao = 0 # Zero if result and meta are zero
-
-            except (TypeError, ValueError):
-                 # If the result is not numeric, variation is 0 or N/A
-                 variacao = 0 # Reset numeric variation
-                 last_result_float = None # Reset float result
-
-
-            # Format the date of the last result
-            data_formatada = format_date_as_month_year(last_date)
-
-        # Add the prepared data to the list
-        indicator_data.append({
-            "indicator": ind,
-            "last_result": last_result,
-            "last_result_float": last_result_float, # Store float for automatic analysis
-            "data_formatada": data_formatada,
-            "status": status, # Status calculated by the new function
-            "variacao": variacao, # Keep numeric value (can be inf)
-            "results": ind_results # Include all results to display history
-        })
+    # Pending report: periods (of FILL_FREQUENCY) without results for the filtered sectors (one cached SQL query)
+    with st.expander("Pendências de Preenchimento"):
+        col1, col2 = st.columns(2)
+        with col1:
+            window_options = sorted({3, 6, 12, 24, PENDING_WINDOW_MONTHS})
+            meses_pendencias = st.selectbox("Janela (meses)", window_options, index=window_options.index(PENDING_WINDOW_MONTHS), key="dashboard_pending_window")
+        with col2:
+            incluir_periodo_atual = st.checkbox("Incluir o período atual", key="dashboard_pending_current_month")
+        pending = get_pending_periods_snapshot(meses_pendencias, setores_consulta, incluir_periodo_atual)
+        if pending is None:
+            st.error("Erro ao calcular as pendências de preenchimento. Verifique o console.")
+        elif not pending:
+            st.success("Nenhum indicador com períodos pendentes na janela selecionada.")
+        else:
+            df_pending = pending_periods_frame(pending)
+            st.warning(f"{len(pending)} indicador(es) com {int(df_pending['Períodos Pendentes'].sum())} período(s) sem resultado.")
+            st.dataframe(df_pending, use_container_width=True, hide_index=True)
+            st.markdown(get_download_link(df_pending, "pendencias_indicadores.xlsx"), unsafe_allow_html=True)
 
-    # Apply status filter, if selected (except "Todos")
-    if status_filtro and "Todos" not in status_filtro:
-        indicator_data = [d for d in indicator_data if d["status"] in status_filtro]
+    st.subheader("Indicadores")
 
     # Display message if no indicators are found after filters
-    if not indicator_data:
+    if not filtered_indicators:
         st.warning("Nenhum indicador encontrado com os filtros selecionados.")
         st.markdown('</div>', unsafe_allow_html=True)
         return
 
-    # Display details of each filtered indicator
-    for i, data in enumerate(indicator_data):
+    # Paginate the indicators first: results, analytics, charts and cards are built only for the current page
+    total_pages = max(1, -(-len(filtered_indicators) // DASHBOARD_PAGE_SIZE))
+    if st.session_state.get("dashboard_page", 1) > total_pages:
+        st.session_state.dashboard_page = 1 # Filters changed and the page no longer exists
+    if total_pages > 1:
+        page = st.selectbox("Página", list(range(1, total_pages + 1)), key="dashboard_page")
+    else:
+        page = 1
+    page_start = (page - 1) * DASHBOARD_PAGE_SIZE
+    page_indicators = filtered_indicators[page_start:page_start + DASHBOARD_PAGE_SIZE]
+    st.caption(f"Exibindo {page_start + 1}–{page_start + len(page_indicators)} de {len(filtered_indicators)} indicadores")
+
+    # Carrega, em uma única consulta, os resultados dos indicadores da página, agrupados por indicador
+    results = get_results_snapshot([ind["id"] for ind in page_indicators])
+    results_by_indicator = {}
+    for r in results:
+        results_by_indicator.setdefault(r["indicator_id"], []).append(r)
+
+    # Último resultado, status, variação e tendência dos indicadores da página, calculados de uma vez
+    results_df = results_to_frame(results)
+    analytics = compute_indicator_analytics(pd.DataFrame(page_indicators), results_df)
+
+    page_data = [] # Display data for each indicator of the current page
+    for ind in page_indicators:
+        row = analytics.loc[ind["id"]]
+        has_numeric_result = row["num_resultados"] > 0 and pd.notna(row["ultimo_resultado"])
+        page_data.append({
+            "indicator": ind,
+            "last_result": float(row["ultimo_resultado"]) if has_numeric_result else "N/A",
+            "last_result_float": float(row["ultimo_resultado"]) if has_numeric_result else None, # Float for automatic analysis
+            "data_formatada": row["data_formatada"],
+            "status": row["status"],
+            "variacao": float(row["variacao"]), # Keep numeric value (can be inf)
+            "tendencia": row["tendencia"], # None if there are fewer than 3 numeric results
+            "results": results_by_indicator.get(ind["id"], []) # Include all results to display history
+        })
+
+    # Build the charts of the current page in a single pass from the results already in memory
+    figures = create_charts([d["indicator"] for d in page_data if d["results"]], results_df, TEMA_PADRAO)
+
+    # Display details of each indicator of the current page
+    for i, data in enumerate(page_data):
         ind = data["indicator"]
         unidade_display = ind.get('unidade', '')
 
@@ -2677,7 +4591,7 @@ def show_dashboard(SETORES, TEMA_PADRAO):
 
         # Display chart if results exist
         if data["results"]:
-            fig = create_chart(ind["id"], ind["tipo_grafico"], TEMA_PADRAO)
+            fig = figures.get(ind["id"])
             if fig: # Ensures the chart was created successfully
                  st.plotly_chart(fig, use_container_width=True) # Display the chart
 
@@ -2702,19 +4616,16 @@ def show_dashboard(SETORES, TEMA_PADRAO):
                 else: variacao_text = "N/A" # Variation N/A if calculation failed
                 st.markdown(f"""<div style="background-color:white; padding:10px; border-radius:5px; text-align:center; border:1px solid #e0e0e0;"><p style="margin:0; font-size:12px; color:#666;">Variação vs Meta</p><p style="margin:0; font-weight:bold; font-size:18px; color:{variacao_color};">{variacao_text}</p></div>""", unsafe_allow_html=True)
 
-            # Expander for historical series and critical analysis
-            with st.expander("Ver Série Histórica e Análise Crítica"):
+            # Historical series and critical analysis, built only when opened
+            if st.checkbox("Ver Série Histórica e Análise Crítica", key=f"dashboard_hist_{ind['id']}"):
                 if data["results"]:
                     # Prepara DataFrame para a série histórica
                     df_hist = pd.DataFrame(data["results"])
                     df_hist["data_referencia"] = pd.to_datetime(df_hist["data_referencia"])
                     df_hist = df_hist.sort_values("data_referencia", ascending=False)
 
-                    # Calculate status for each result in the historical series using the new function
-                    df_hist["status"] = df_hist.apply(lambda row:
-                         calculate_status(row["resultado"], ind.get("meta"), ind.get("comparacao", "Maior é melhor")),
-                         axis=1
-                    )
+                    # Calculate status for each result in the historical series (vectorized)
+                    df_hist["status"] = compute_status(df_hist["resultado"], ind.get("meta"), ind.get("comparacao", "Maior é melhor"))
 
 
                     # Select and format columns for display in the table
@@ -2739,67 +4650,52 @@ def show_dashboard(SETORES, TEMA_PADRAO):
 
                     st.dataframe(df_display, use_container_width=True) # Display the historical series table
 
-                    # Análise de Tendência (requer at least 3 NUMERIC results)
-                    # Filter results that are numeric for trend analysis
-                    numeric_results = df_hist[pd.to_numeric(df_hist['resultado'], errors='coerce').notna()].copy()
-                    numeric_results['resultado'] = pd.to_numeric(numeric_results['resultado']) # Convert to numeric
-
-                    if len(numeric_results) >= 3:
-                        # Get the last 3 numeric results and convert to list
-                        ultimos_resultados = numeric_results.sort_values("data_referencia")["resultado"].tolist()
-
-                        if len(ultimos_resultados) >= 3: # Ensure we got at least 3 numeric values
-                            # Compare the last 3 results to determine the trend
-                            if ind.get("comparacao", "Maior é melhor") == "Maior é melhor":
-                                tendencia = "crescente" if ultimos_resultados[-1] > ultimos_resultados[-2] > ultimos_resultados[-3] else ("decrescente" if ultimos_resultados[-1] < ultimos_resultados[-2] < ultimos_resultados[-3] else "estável")
-                            else: # Smaller is better
-                                tendencia = "crescente" if ultimos_resultados[-1] < ultimos_resultados[-2] < ultimos_resultados[-3] else ("decrescente" if ultimos_resultados[-1] > ultimos_resultados[-2] > ultimos_resultados[-3] else "estável")
-
-                            # Define color for the trend
-                            tendencia_color = "#26A69A" if (tendencia == "crescente" and ind.get("comparacao", "Maior é melhor") == "Maior é melhor") or (tendencia == "decrescente" and ind.get("comparacao", "Maior é melhor") == "Menor é melhor") else "#FF5252" if (tendencia == "decrescente" and ind.get("comparacao", "Maior é melhor") == "Maior é melhor") or (tendencia == "crescente" and ind.get("comparacao", "Maior é melhor") == "Menor é melhor") else "#FFC107"
-
-                            st.markdown(f"""<div style="margin-top:15px;"><h4>Análise de Tendência</h4><p>Este indicador apresenta uma tendência <span style="color:{tendencia_color}; font-weight:bold;">{tendencia}</span> nos últimos 3 períodos com resultados numéricos.</p></div>""", unsafe_allow_html=True)
-
-                            # Automatic Performance Analysis (based on trend and meta)
-                            st.markdown("<h4>Análise Automática</h4>", unsafe_allow_html=True)
-                            meta_float = float(ind.get("meta", 0.0)) # Ensures meta is float
-
-                            if data['last_result_float'] is not None: # Only perform automatic analysis if the last result is numeric and valid
-                                if tendencia == "crescente":
-                                    if ind.get("comparacao", "Maior é melhor") == "Maior é melhor":
-                                        st.success("O indicador apresenta evolução positiva, com resultados crescentes nos últimos períodos com resultados numéricos.")
-                                        if data['last_result_float'] >= meta_float:
-                                            st.success("O resultado atual está acima da meta estabelecida, demonstrando bom desempenho.")
-                                        else:
-                                            st.warning("Apesar da evolução positiva, o resultado ainda está abaixo da meta estabelecida. Continue acompanhando a tendência.")
-                                    else: # Smaller is better
-                                        st.error("O indicador apresenta tendência de aumento, o que é negativo para este tipo de métrica.")
-                                        if data['last_result_float'] <= meta_float:
-                                            st.warning("Embora o resultado atual ainda esteja dentro da meta, a tendência de aumento requer atenção imediata.")
-                                        else:
-                                            st.error("O resultado está acima da meta e com tendência de aumento, exigindo ações corretivas urgentes.")
-                                elif tendencia == "decrescente":
-                                    if ind.get("comparacao", "Maior é melhor") == "Maior é melhor":
-                                        st.error("O indicador apresenta tendência de queda, o que é preocupante para este tipo de métrica.")
-                                        if data['last_result_float'] >= meta_float:
-                                            st.warning("Embora o resultado atual ainda esteja acima da meta, a tendência de queda requer atenção.")
-                                        else:
-                                            st.error("O resultado está abaixo da meta e com tendência de queda, exigindo ações corretivas urgentes.")
-                                    else: # Smaller is better
-                                        st.success("O indicador apresenta evolução positiva, com resultados decrescentes nos últimos períodos com resultados numéricos.")
-                                        if data['last_result_float'] <= meta_float:
-                                            st.success("O resultado atual está dentro da meta estabelecida, demonstrando bom desempenho.")
-                                        else:
-                                            st.warning("Apesar da evolução positiva, o resultado ainda está acima da meta estabelecida. A tendência de queda é favorável, mas ainda há trabalho a ser feito para atingir a meta.")
-                                else: # Stable
-                                    if (data['last_result_float'] >= meta_float and ind.get("comparacao", "Maior é melhor") == "Maior é melhor") or (data['last_result_float'] <= meta_float and ind.get("comparacao", "Maior é melhor") == "Menor é melhor"):
-                                        st.info("O indicador apresenta estabilidade e está dentro da meta estabelecida. Monitore para garantir a manutenção do desempenho.")
+                    # Análise de Tendência (requires at least 3 NUMERIC results; computed in compute_indicator_analytics)
+                    tendencia = data["tendencia"]
+                    if pd.notna(tendencia):
+                        # Define color for the trend
+                        tendencia_color = "#26A69A" if (tendencia == "crescente" and ind.get("comparacao", "Maior é melhor") == "Maior é melhor") or (tendencia == "decrescente" and ind.get("comparacao", "Maior é melhor") == "Menor é melhor") else "#FF5252" if (tendencia == "decrescente" and ind.get("comparacao", "Maior é melhor") == "Maior é melhor") or (tendencia == "crescente" and ind.get("comparacao", "Maior é melhor") == "Menor é melhor") else "#FFC107"
+
+                        st.markdown(f"""<div style="margin-top:15px;"><h4>Análise de Tendência</h4><p>Este indicador apresenta uma tendência <span style="color:{tendencia_color}; font-weight:bold;">{tendencia}</span> nos últimos 3 períodos com resultados numéricos.</p></div>""", unsafe_allow_html=True)
+
+                        # Automatic Performance Analysis (based on trend and meta)
+                        st.markdown("<h4>Análise Automática</h4>", unsafe_allow_html=True)
+                        meta_float = float(ind.get("meta", 0.0)) # Ensures meta is float
+
+                        if data['last_result_float'] is not None: # Only perform automatic analysis if the last result is numeric and valid
+                            if tendencia == "crescente":
+                                if ind.get("comparacao", "Maior é melhor") == "Maior é melhor":
+                                    st.success("O indicador apresenta evolução positiva, com resultados crescentes nos últimos períodos com resultados numéricos.")
+                                    if data['last_result_float'] >= meta_float:
+                                        st.success("O resultado atual está acima da meta estabelecida, demonstrando bom desempenho.")
                                     else:
-                                        st.warning("O indicador apresenta estabilidade, porém está fora da meta estabelecida. É necessário investigar as causas dessa estabilidade fora da meta.")
-                            else:
-                                st.info("Não foi possível realizar a análise automática de desempenho para o último resultado (Não numérico ou inválido).")
+                                        st.warning("Apesar da evolução positiva, o resultado ainda está abaixo da meta estabelecida. Continue acompanhando a tendência.")
+                                else: # Smaller is better
+                                    st.error("O indicador apresenta tendência de aumento, o que é negativo para este tipo de métrica.")
+                                    if data['last_result_float'] <= meta_float:
+                                        st.warning("Embora o resultado atual ainda esteja dentro da meta, a tendência de aumento requer atenção imediata.")
+                                    else:
+                                        st.error("O resultado está acima da meta e com tendência de aumento, exigindo ações corretivas urgentes.")
+                            elif tendencia == "decrescente":
+                                if ind.get("comparacao", "Maior é melhor") == "Maior é melhor":
+                                    st.error("O indicador apresenta tendência de queda, o que é preocupante para este tipo de métrica.")
+                                    if data['last_result_float'] >= meta_float:
+                                        st.warning("Embora o resultado atual ainda esteja acima da meta, a tendência de queda requer atenção.")
+                                    else:
+                                        st.error("O resultado está abaixo da meta e com tendência de queda, exigindo ações corretivas urgentes.")
+                                else: # Smaller is better
+                                    st.success("O indicador apresenta evolução positiva, com resultados decrescentes nos últimos períodos com resultados numéricos.")
+                                    if data['last_result_float'] <= meta_float:
+                                        st.success("O resultado atual está dentro da meta estabelecida, demonstrando bom desempenho.")
+                                    else:
+                                        st.warning("Apesar da evolução positiva, o resultado ainda está acima da meta estabelecida. A tendência de queda é favorável, mas ainda há trabalho a ser feito para atingir a meta.")
+                            else: # Stable
+                                if (data['last_result_float'] >= meta_float and ind.get("comparacao", "Maior é melhor") == "Maior é melhor") or (data['last_result_float'] <= meta_float and ind.get("comparacao", "Maior é melhor") == "Menor é melhor"):
+                                    st.info("O indicador apresenta estabilidade e está dentro da meta estabelecida. Monitore para garantir a manutenção do desempenho.")
+                                else:
+                                    st.warning("O indicador apresenta estabilidade, porém está fora da meta estabelecida. É necessário investigar as causas dessa estabilidade fora da meta.")
                         else:
-                            st.info("Não há resultados numéricos suficientes para análise de tendência (mínimo de 3 períodos com resultados numéricos necessários).")
+                            st.info("Não foi possível realizar a análise automática de desempenho para o último resultado (Não numérico ou inválido).")
                     else: st.info("Não há dados históricos numéricos suficientes para análise de tendência (mínimo de 3 períodos necessários).")
 
                     # Critical Analysis 5W2H of the latest result
@@ -2852,31 +4748,25 @@ Esta metodologia ajuda a garantir que todos os aspectos importantes sejam consid
         st.markdown("<hr style='margin: 30px 0; border-color: #e0e0e0;'>", unsafe_allow_html=True)
 
 
-    # Button to export all displayed indicators
+    # Button to export all filtered indicators (every page), read from indicator_summary as in show_overview
     if st.button("📤 Exportar Tudo", key="dashboard_export_button"):
+        summary = get_indicator_summary_snapshot([ind["id"] for ind in filtered_indicators])
         export_data = []
-        for data in indicator_data:
-            ind = data["indicator"]
+        for ind in filtered_indicators:
+            row = summary.get(ind["id"])
             unidade_export = ind.get('unidade', '')
-            # Format latest result for export
-            last_result_export = f"{float(data['last_result']):.2f}{unidade_export}" if isinstance(data['last_result'], (int, float)) else "N/A"
-            # Format meta for export
-            meta_export = f"{float(ind.get('meta', 0.0)):.2f}{unidade_export}"
-            # Format variation for export (handle infinities)
-            if data['variacao'] == float('inf'): variacao_export = "+Inf"
-            elif data['variacao'] == float('-inf'): variacao_export = "-Inf"
-            elif isinstance(data['variacao'], (int, float)): variacao_export = f"{data['variacao']:.2f}%"
-            else: variacao_export = "N/A"
+            has_result = row is not None and row["num_resultados"] > 0
+            has_numeric_result = has_result and row["ultimo_resultado"] is not None
 
             # Add the prepared data to the export list
             export_data.append({
                 "Nome": ind["nome"],
                 "Setor": ind["responsavel"],
-                "Meta": meta_export,
-                "Último Resultado": last_result_export,
-                "Período": data["data_formatada"],
-                "Status": data["status"],
-                "Variação": variacao_export
+                "Meta": f"{float(ind.get('meta', 0.0)):.2f}{unidade_export}",
+                "Último Resultado": f"{row['ultimo_resultado']:.2f}{unidade_export}" if has_numeric_result else "N/A",
+                "Período": format_date_as_month_year(datetime.fromisoformat(row["data_referencia"])) if has_result else "N/A",
+                "Status": row["status"] if row is not None else "Sem Resultados",
+                "Variação": format_variacao(row["variacao"]) if has_result else "N/A"
             })
         # Create DataFrame and generate download link
         df_export = pd.DataFrame(export_data)
@@ -2891,11 +4781,10 @@ def show_overview():
     """Mostra a visão geral dos indicadores."""
     st.markdown('<div class="dashboard-card">', unsafe_allow_html=True)
     st.header("Visão Geral dos Indicadores")
-    # Carrega indicadores e resultados
-    indicators = load_indicators()
-    results = load_results()
+    # Carrega apenas os setores; os indicadores são filtrados no banco (a visão geral só precisa do resumo de cada um)
+    setores_disponiveis = get_indicator_sectors_snapshot()
 
-    if not indicators:
+    if not setores_disponiveis:
         st.info("Nenhum indicador cadastrado. Utilize a opção 'Criar Indicador' para começar.")
         st.markdown('</div>', unsafe_allow_html=True)
         return
@@ -2904,7 +4793,6 @@ def show_overview():
     col1, col2 = st.columns(2)
     with col1:
         # Filtro multi-seleção por setor (inclui "Todos")
-        setores_disponiveis = sorted(list(set([ind["responsavel"] for ind in indicators])))
         setor_filtro = st.multiselect("Filtrar por Setor", options=["Todos"] + setores_disponiveis, default=["Todos"], key="overview_setor_filter")
     with col2:
         # Filtro multi-seleção por status (inclui "Todos")
@@ -2913,92 +4801,33 @@ def show_overview():
     # Campo de busca por texto
     search_query = st.text_input("Buscar indicador por nome ou setor", placeholder="Digite para buscar...", key="overview_search")
 
-    # Aplica o filtro de setor
-    filtered_indicators = indicators
-    if setor_filtro and "Todos" not in setor_filtro:
-        filtered_indicators = [ind for ind in indicators if ind["responsavel"] in setor_filtro]
+    # Filtros de setor (Operadores restritos aos seus setores), status e busca aplicados no banco
+    setores_consulta = resolve_sector_filter(setor_filtro, st.session_state.user_type, st.session_state.user_sectors)
+    status_consulta = None if not status_filtro or "Todos" in status_filtro else list(status_filtro)
+    filtered_indicators = get_filtered_indicators_snapshot(setores_consulta, status_consulta, search_query)
 
     overview_data = [] # Lista para armazenar os dados da tabela de visão geral
+    # Último resultado, status e variação de cada indicador filtrado, lidos de indicator_summary
+    summary = get_indicator_summary_snapshot([ind["id"] for ind in filtered_indicators])
 
     # Prepara os dados para a tabela de visão geral
     for ind in filtered_indicators:
-        ind_results = [r for r in results if r["indicator_id"] == ind["id"]]
+        row = summary.get(ind["id"])
         unidade_display = ind.get('unidade', '')
-
-        last_result = "N/A"
-        data_formatada = "N/A"
-        status = "Sem Resultados"
-        variacao = 0 # Variação vs Meta (numérico)
-
-        if ind_results:
-            # Pega o último resultado
-            df_results = pd.DataFrame(ind_results)
-            df_results["data_referencia"] = pd.to_datetime(df_results["data_referencia"])
-            df_results = df_results.sort_values("data_referencia", ascending=False)
-            last_result_obj = df_results.iloc[0]
-            last_result = last_result_obj["resultado"]
-            last_date = last_result_obj["data_referencia"]
-
-            # Calcula status usando a função auxiliar
-            status = calculate_status(last_result, ind.get("meta"), ind.get("comparacao", "Maior é melhor"))
-
-            try:
-                # Calcula variação se o último resultado for numérico
-                meta = float(ind.get("meta", 0.0))
-                resultado = float(last_result)
-
-                if meta != 0.0:
-                    variacao = ((resultado / meta) - 1) * 100
-                    if ind["comparacao"] == "Menor é melhor": variacao = -variacao
-                else:
-                    if resultado > 0: variacao = float('inf')
-                    elif resultado < 0: variacao = float('-inf')
-                    else: variacao = 0
-            except (TypeError, ValueError):
-                 status = "N/A" # Set status to N/A if result is not numeric
-                 variacao = 0 # Reseta variação
-
-
-            # Formata os valores para exibição na tabela
-            data_formatada = format_date_as_month_year(last_date)
-            last_result_formatted = f"{float(last_result):.2f}{unidade_display}" if isinstance(last_result, (int, float)) else "N/A"
-            meta_formatted = f"{float(ind.get('meta', 0.0)):.2f}{unidade_display}"
-            # Formata a variação, tratando infinitos
-            if variacao == float('inf'): variacao_formatted = "+Inf"
-            elif variacao == float('-inf'): variacao_formatted = "-Inf"
-            elif isinstance(variacao, (int, float)): variacao_formatted = f"{variacao:.2f}%"
-            else: variacao_formatted = "N/A"
-
-        else:
-            # Valores para indicadores sem resultados
-            last_result_formatted = "N/A"
-            data_formatada = "N/A"
-            status = "Sem Resultados"
-            variacao_formatted = "N/A" # Variação N/A se não há resultado
-            meta_formatted = f"{float(ind.get('meta', 0.0)):.2f}{unidade_display}"
-
+        has_result = row is not None and row["num_resultados"] > 0
+        has_numeric_result = has_result and row["ultimo_resultado"] is not None
 
         # Adiciona a linha à lista de dados
         overview_data.append({
             "Nome": ind["nome"],
             "Setor": ind["responsavel"],
-            "Meta": meta_formatted,
-            "Último Resultado": last_result_formatted,
-            "Período": data_formatada,
-            "Status": status,
-            "Variação": variacao_formatted
+            "Meta": f"{float(ind.get('meta', 0.0)):.2f}{unidade_display}",
+            "Último Resultado": f"{row['ultimo_resultado']:.2f}{unidade_display}" if has_numeric_result else "N/A",
+            "Período": format_date_as_month_year(datetime.fromisoformat(row["data_referencia"])) if has_result else "N/A",
+            "Status": row["status"] if row is not None else "Sem Resultados",
+            "Variação": format_variacao(row["variacao"]) if has_result else "N/A"
         })
 
-    # Aplica o filtro de status
-    if status_filtro and "Todos" not in status_filtro:
-        overview_data = [d for d in overview_data if d["Status"] in status_filtro]
-
-    # Aplica o filtro de busca por texto (nome ou setor)
-    if search_query:
-        search_query_lower = search_query.lower()
-        overview_data = [d for d in overview_data if search_query_lower in d["Nome"].lower() or search_query_lower in d["Setor"].lower()]
-
-
     df_overview = pd.DataFrame(overview_data) # Cria o DataFrame final para exibição
     if not df_overview.empty:
         # Renomeia a coluna Variação para clareza na tabela
@@ -3043,7 +4872,7 @@ def show_settings():
     st.markdown('<div class="dashboard-card">', unsafe_allow_html=True)
     st.header("Configurações")
 
-    config = load_config() # Carrega configurações do DB
+    config = get_config_snapshot() # Carrega configurações do DB
 
     st.subheader("Informações do Sistema")
 
@@ -3064,6 +4893,24 @@ def show_settings():
         st.markdown("Email: beborges@outlook.com.br") # Contato hardcoded
         st.markdown("Telefone: (35) 93300-1414") # Contato hardcoded
 
+    # Estatísticas do pool de conexões (úteis para dimensionar SCPC_DB_POOL_MIN/MAX)
+    with st.expander("Pool de Conexões do Banco de Dados"):
+        pool_stats = get_db_pool_stats()
+        col1, col2, col3, col4 = st.columns(4)
+        with col1: st.metric("Em uso", f"{pool_stats['em_uso']} / {pool_stats['max']}")
+        with col2: st.metric("Ociosas", pool_stats["ociosas"])
+        with col3: st.metric("Espera média", f"{pool_stats['espera_media_ms']:.1f} ms")
+        with col4: st.metric("Latência de empréstimo", f"{pool_stats['latencia_emprestimo_media_ms']:.1f} ms")
+        st.dataframe(pd.DataFrame([pool_stats]).T.rename(columns={0: "Valor"}), use_container_width=True)
+
+    # Estatísticas do cache de figuras dos gráficos (úteis para dimensionar SCPC_CHART_CACHE_SIZE)
+    with st.expander("Cache de Gráficos"):
+        chart_stats = get_chart_cache().stats()
+        col1, col2, col3, col4 = st.columns(4)
+        with col1: st.metric("Entradas", f"{chart_stats['entradas']} / {chart_stats['max']}")
+        with col2: st.metric("Acertos", chart_stats["acertos"])
+        with col3: st.metric("Falhas", chart_stats["falhas"])
+        with col4: st.metric("Taxa de acerto", f"{chart_stats['taxa_acerto']:.0%}")
 
     st.subheader("Backup Automático")
     # Carrega o horário de backup configurado
@@ -3089,6 +4936,20 @@ def show_settings():
              st.error("Falha ao atualizar o horário de backup. Verifique o console.")
 
 
+    # Backups incrementais: só as alterações desde o último backup (aplicados em cadeia na restauração)
+    incremental_interval = int(config.get("backup_incremental_interval", "0") or 0)
+    new_incremental_interval = st.selectbox(
+        "Backup incremental", list(BACKUP_INCREMENTAL_INTERVALS),
+        index=list(BACKUP_INCREMENTAL_INTERVALS).index(incremental_interval) if incremental_interval in BACKUP_INCREMENTAL_INTERVALS else 0,
+        format_func=BACKUP_INCREMENTAL_INTERVALS.get,
+        help="Entre os backups completos diários, grava apenas as linhas alteradas. Vale após reiniciar a aplicação.")
+    if new_incremental_interval != incremental_interval:
+        config["backup_incremental_interval"] = str(new_incremental_interval)
+        if save_config(config):
+             st.success("Intervalo do backup incremental atualizado com sucesso!")
+        else:
+             st.error("Falha ao atualizar o intervalo do backup incremental. Verifique o console.")
+
     # Exibe a data do último backup automático
     if "last_backup_date" in config and config["last_backup_date"]: # Verifica se a chave existe e não está vazia
         st.markdown(f"**Último backup automático:** {config['last_backup_date']}")
@@ -3121,6 +4982,18 @@ def show_settings():
     if backup_files:
         # Selectbox para selecionar o arquivo de backup a restaurar
         selected_backup = st.selectbox("Selecione o backup para restaurar", backup_files)
+        header_cipher = initialize_cipher(KEY_FILE)
+        header = read_backup_header(os.path.join("backups", selected_backup), header_cipher) if header_cipher else None
+        if header is None:
+            st.caption("⚠️ Não foi possível ler o cabeçalho deste backup (arquivo corrompido ou chave diferente).")
+        elif header.get("formato", 0) < 2:
+            st.caption(f"Backup no formato {header.get('formato', 0)} (sem contagem de linhas no cabeçalho).")
+        else:
+            criado_em = datetime.fromisoformat(header["criado_em"]).strftime("%d/%m/%Y %H:%M")
+            tipo = (f"incremental nº {header.get('sequencia')} sobre {header.get('anterior')}"
+                    if header.get("tipo") == "incremental" else "completo")
+            st.caption(f"Formato {header['formato']} · {tipo} · compressão {header['compressao']} · criado em {criado_em} · "
+                       + ", ".join(f"{tabela}: {n}" for tabela, n in header.get("linhas", {}).items()))
 
         # Botão para iniciar a restauração
         if st.button("⚙️ Restaurar arquivo de backup ️", help="Restaura os dados do sistema a partir de um arquivo de backup. Criará um backup de segurança antes da restauração."):
@@ -3146,12 +5019,18 @@ def show_settings():
                         generate_key(KEY_FILE)
                         cipher = initialize_cipher(KEY_FILE)
                         # restore_data já exibe erro se falhar
-                        if restore_data(os.path.join("backups", selected_backup), cipher):
+                        restore_report = {}
+                        if restore_data(os.path.join("backups", selected_backup), cipher, report=restore_report):
                             st.success("Backup restaurado com sucesso! A aplicação será reiniciada.")
-                            # Limpa o estado da sessão para forçar recarregamento dos dados
+                            # Limpa o estado da sessão para forçar recarregamento dos dados; o relatório de tempos
+                            # por tabela sobrevive ao rerun e é exibido na página de login (ver show_login_page)
                             for key in list(st.session_state.keys()):
                                 del st.session_state[key]
-                            time.sleep(2) # Pequeno delay
+                            st.session_state.restore_report = [{
+                                "Tabela": table,
+                                "Linhas": entry["linhas"],
+                                "Tempo (s)": round(entry["segundos"], 2),
+                            } for table, entry in restore_report.items()]
                             st.rerun() # Reinicia a aplicação
                         else:
                             # Mensagem de erro já é exibida por restore_data
@@ -3162,9 +5041,57 @@ def show_settings():
         st.info("Nenhum arquivo de backup encontrado no diretório 'backups'.")
 
 
+    # Logs de auditoria: leitura paginada (mais recentes primeiro) e retenção
+    if st.session_state.get("user_type") == "Administrador":
+        st.subheader("Logs de Auditoria")
+        log_labels = {"log_indicadores": "Indicadores", "log_usuarios": "Usuários", "log_backup": "Backup"}
+        log_table = st.selectbox("Log", options=list(log_labels), format_func=log_labels.get, key="audit_log_table")
+        col1, col2, col3 = st.columns(3)
+        with col1: log_user = st.text_input("Usuário", key="audit_log_user").strip()
+        with col2: log_action = st.text_input("Ação", key="audit_log_action").strip()
+        with col3: log_target = st.text_input("Objeto (indicador, usuário ou arquivo)", key="audit_log_target").strip()
+
+        # As páginas já carregadas ficam na sessão; mudar o log ou os filtros recomeça do início
+        filters = (log_table, log_user, log_action, log_target)
+        if st.session_state.get("audit_log_filters") != filters:
+            st.session_state.audit_log_filters = filters
+            st.session_state.audit_log_entries = _load_audit_log(log_table, user=log_user, action=log_action, target=log_target)
+        entries = st.session_state.audit_log_entries
+
+        if entries:
+            st.dataframe(pd.DataFrame(entries).drop(columns=["id"]), use_container_width=True, hide_index=True)
+            if len(entries) % AUDIT_LOG_PAGE_SIZE == 0 and st.button("Carregar mais", key="audit_log_more"):
+                last = entries[-1]
+                st.session_state.audit_log_entries = entries + _load_audit_log(
+                    log_table, before_timestamp=last["timestamp"], before_id=last["id"],
+                    user=log_user, action=log_action, target=log_target)
+                st.rerun()
+        else:
+            st.info("Nenhuma entrada de log encontrada.")
+
+        with st.expander("Retenção dos Logs"):
+            retention_days = st.number_input("Arquivar entradas com mais de (dias)", min_value=30, value=365, step=30, key="audit_log_retention_days")
+            if st.button("🗄️ Arquivar logs antigos", help="Move as entradas antigas dos três logs para um arquivo compactado em 'backups' e as remove do banco."):
+                with st.spinner("Arquivando logs antigos..."):
+                    archive_path, counts = archive_audit_logs(retention_days)
+                if archive_path:
+                    st.success(f"{sum(counts.values())} entradas arquivadas em {archive_path}.")
+                    st.session_state.pop("audit_log_filters", None) # Recarrega a listagem
+                elif counts:
+                    st.info("Nenhuma entrada anterior ao período informado.")
+                else:
+                    st.error("Falha ao arquivar os logs. Verifique o console.")
+
+
     # Opções de administração (apenas para o usuário 'admin')
     if st.session_state.username == "admin":
         st.subheader("Administração do Sistema")
+        with st.expander("Recalcular Histórico de Resultados"):
+            st.info("Recalcula todos os resultados lançados a partir dos valores das variáveis salvos, usando a fórmula atual de cada indicador.")
+            if st.button("🔁 Recalcular histórico de todos os indicadores", key="recalc_all_histories"):
+                with st.spinner("Recalculando resultados..."):
+                    report = recalculate_histories(user_performed=st.session_state.username)
+                show_recalculation_report(report)
         with st.expander("Opções Avançadas de Limpeza"):
             st.warning("⚠️ Estas opções podem causar perda de dados permanente. Use com extremo cuidado.")
             # Botão para limpar resultados (requer confirmação)
@@ -3192,7 +5119,9 @@ def show_settings():
                                  try:
                                      cur = conn.cursor()
                                      cur.execute("DELETE FROM resultados;") # Deleta todos os resultados
+                                     refresh_indicator_summary(cur) # Todos os indicadores passam a "Sem Resultados"
                                      conn.commit()
+                                     invalidate_data_cache("resultados", "indicator_summary")
                                      st.success("Resultados excluídos com sucesso!")
                                      # Limpa a lista de resultados no estado da sessão
                                      if 'results' in st.session_state: del st.session_state.results
@@ -3235,6 +5164,7 @@ def show_settings():
                                      # Deleta todos os indicadores (resultados serão excluídos via ON DELETE CASCADE)
                                      cur.execute("DELETE FROM indicadores;")
                                      conn.commit()
+                                     invalidate_data_cache("indicadores", "resultados", "indicator_summary")
                                      st.success("Indicadores e resultados excluídos com sucesso!")
                                      # Limpa as listas no estado da sessão
                                      if 'indicators' in st.session_state: del st.session_state.indicators
@@ -3257,7 +5187,7 @@ def show_user_management(SETORES):
     """Mostra a página de gerenciamento de usuários."""
     st.markdown('<div class="dashboard-card">', unsafe_allow_html=True)
     st.header("Gerenciamento de Usuários")
-    users = load_users() # Carrega a lista de usuários com setores (lista)
+    users = get_users_snapshot() # Carrega a lista de usuários com setores (lista)
 
     # --- Contagem de usuários por tipo ---
     total_users = len(users)
@@ -3329,29 +5259,16 @@ def show_user_management(SETORES):
         elif email and "@" not in email: # Validação simples de formato de email
              st.error("❌ Formato de email inválido.")
         else:
-            # Adiciona o novo usuário ao dicionário em memória
-            users[login] = {
-                "password": hashlib.sha256(new_password.encode()).hexdigest(), # Hashing da senha
-                "tipo": user_type_new,
-                "nome_completo": nome_completo,
-                "email": email,
-                "setores": user_sectors_new, # Salva a lista de setores
-                "data_criacao": datetime.now().isoformat() # Data de criação
-            }
-
-            # Verificar o resultado de save_users
-            if save_users(users): # Chama a função de salvamento e verifica se foi bem-sucedida
+            # Insere apenas o novo usuário e seus setores
+            if create_user(login, hashlib.sha256(new_password.encode()).hexdigest(), user_type_new,
+                           nome_completo=nome_completo, email=email, setores=user_sectors_new):
                 log_user_action("Usuário criado", login, st.session_state.username) # Log
                 st.success(f"✅ Usuário '{nome_completo}' (login: {login}) adicionado com sucesso como {user_type_new}!")
                 time.sleep(1) # Pequeno delay
                 st.rerun() # Reinicia a aplicação para atualizar a lista de usuários exibida
             else:
-                # Se save_users retornou False, significa que houve um erro no banco
+                # create_user já lida com o rollback e imprime o erro no console
                 st.error(f"❌ Erro ao salvar o usuário '{nome_completo}' no banco de dados. Verifique o console para detalhes do erro.")
-                # O save_users já lida com o rollback e imprime o erro no console.
-                # Não precisamos remover do dicionário local aqui, pois a página será recarregada pelo rerun ou o usuário verá o erro.
-                # Se save_users falha, o dicionário 'users' no próximo load_users não terá o novo usuário.
-                pass # A mensagem de erro já foi exibida
 
 
     st.subheader("Usuários Cadastrados")
@@ -3542,21 +5459,10 @@ def show_user_management(SETORES):
                                 if new_password != confirm_password:
                                      st.error("❌ As senhas não coincidem."); return
 
-                            # Atualiza os dados do usuário no dicionário em memória
-                            # Copia os dados originais para não perder chaves como 'data_criacao'
-                            updated_user_data = users[login].copy()
-                            updated_user_data["tipo"] = new_type
-                            updated_user_data["setores"] = new_sectors # Atualiza a lista de setores
-                            updated_user_data["nome_completo"] = new_nome
-                            updated_user_data["email"] = new_email
-
-                            if reset_password:
-                                 updated_user_data["password"] = hashlib.sha256(new_password.encode()).hexdigest() # Hashing da nova senha
-
-                            users[login] = updated_user_data # Atualiza no dicionário principal
-
-                            # Verificar o resultado de save_users
-                            if save_users(users): # Chama a função de salvamento e verifica
+                            # Atualiza apenas este usuário (e somente os setores que mudaram)
+                            new_password_hash = hashlib.sha256(new_password.encode()).hexdigest() if reset_password else None
+                            if update_user(login, tipo=new_type, nome_completo=new_nome, email=new_email,
+                                           password_hash=new_password_hash, setores=new_sectors):
                                 st.success(f"✅ Usuário '{new_nome}' atualizado com sucesso!")
                                 log_user_action("Usuário atualizado", login, st.session_state.username) # Log
 
@@ -3566,7 +5472,7 @@ def show_user_management(SETORES):
                                 time.sleep(1)
                                 st.rerun()
                             else:
-                                # Se save_users retornou False, significa que houve um erro no banco
+                                # Se update_user retornou False, significa que houve um erro no banco
                                 st.error(f"❌ Erro ao atualizar o usuário '{new_nome}' no banco de dados. Verifique o console para detalhes do erro.")
                                 # Não limpa o estado de edição para que o formulário persista com os valores (ou remova se preferir que limpe)
                                 pass
@@ -3650,37 +5556,6 @@ def show_user_management(SETORES):
 
     st.markdown('</div>', unsafe_allow_html=True)
 
-def delete_user(username, user_performed):
-    """Exclui um usuário do banco de dados."""
-    conn = get_db_connection()
-    if conn:
-        cur = None
-        try:
-            cur = conn.cursor()
-            # A exclusão na tabela usuarios deve ser suficiente,
-            # pois a chave estrangeira em 'usuario_setores' tem ON DELETE CASCADE
-            cur.execute("DELETE FROM usuarios WHERE username = %s;", (username,))
-            conn.commit()
-            log_user_action("Usuário excluído", username, user_performed) # Log
-            # Recarrega a lista de usuários no estado da sessão após exclusão bem-sucedida
-            # Note: users = load_users() dentro show_user_management será chamado no próximo rerun
-            return True
-        except psycopg2.Error as e:
-            print(f"Erro ao excluir usuário do banco de dados: {e}") # Mantém este print
-            st.error(f"Erro ao excluir usuário: {e}") # Exibe erro no Streamlit
-            conn.rollback()
-            return False
-        except Exception as e:
-             print(f"Erro inesperado ao excluir usuário: {e}") # Mantém este print
-             st.error(f"Erro inesperado ao excluir usuário: {e}") # Exibe erro no Streamlit
-             conn.rollback()
-             return False
-        finally:
-            if cur is not None: cur.close()
-            if conn is not None: conn.close()
-    return False
-
-
 def logout():
     """Realiza o logout do usuário."""
     # Limpa todo o estado da sessão
@@ -3730,65 +5605,693 @@ def initialize_cipher(key_file):
     return None # Retorna None se a chave não pôde ser carregada/gerada
 
 
-def backup_data(cipher, tipo_backup="user"):
-    """Cria um arquivo de backup criptografado com todos os dados do DB."""
-    if not cipher:
-        print("Objeto de criptografia não inicializado. Backup cancelado.") # Mantém este print
-        return None
+# --- Formato de backup em fluxo ---
+# Arquivo .bkp (formato 2):
+#   BACKUP_MAGIC; um quadro de cabeçalho; os quadros de dados. Quadro = [4 bytes big-endian: tamanho do token][token Fernet].
+#   O cabeçalho é um JSON (completado com espaços até BACKUP_HEADER_SIZE bytes) com o formato, o codec de
+#   compressão, a lista de tabelas, o número de linhas e o SHA-256 das linhas de cada tabela. Como o tamanho
+#   é fixo, ele é gravado vazio no início e reescrito no lugar ao final, quando contagens e somas são conhecidas.
+#   Cada quadro de dados cifra e autentica até BACKUP_CHUNK_SIZE bytes do fluxo, prefixados com o número de
+#   sequência do quadro e um marcador de último quadro: quadros removidos, trocados de ordem ou um
+#   arquivo truncado são detectados na leitura.
+#   O fluxo decifrado é comprimido (zstd se o pacote zstandard estiver instalado, senão gzip) e contém linhas
+#   JSON: para cada tabela, uma linha {"tabela", "colunas"}, as linhas da tabela como listas e uma linha {"fim", "linhas"}.
+#   Cada tabela é comprimida separadamente (exportação paralela), então o fluxo é uma sequência de membros gzip
+#   ou quadros zstd, lidos como um único fluxo.
+#   Backups incrementais (cabeçalho com "tipo": "incremental") apontam para o backup anterior da cadeia ("anterior")
+#   e também têm seções {"tabela", "modo": "excluidos" | "alterados"}; ver BACKUP_INCREMENTAL_TABLES.
+# O formato anterior (0: um único token Fernet com o JSON completo) continua restaurável.
+BACKUP_MAGIC = b"SCPCBKP\x02"
+BACKUP_FORMAT_VERSION = 2
+BACKUP_HEADER_SIZE = 4096
+BACKUP_CHUNK_SIZE = int(os.environ.get("SCPC_BACKUP_CHUNK_SIZE", 1024 * 1024))
+BACKUP_FETCH_SIZE = int(os.environ.get("SCPC_BACKUP_FETCH_SIZE", 5000))
+BACKUP_WORKERS = int(os.environ.get("SCPC_BACKUP_WORKERS", 4)) # Conexões exportando tabelas em paralelo
+BACKUP_CODECS = ("zstd", "gzip")
+BACKUP_CODEC = os.environ.get("SCPC_BACKUP_CODEC", "zstd" if zstandard is not None else "gzip")
+BACKUP_ZSTD_LEVEL = int(os.environ.get("SCPC_BACKUP_ZSTD_LEVEL", 3))
+_BACKUP_FRAME_LENGTH = struct.Struct(">I")
+_BACKUP_CHUNK_HEADER = struct.Struct(">Q?")
+
+# Tabelas do backup, na ordem de restauração (tabelas referenciadas antes das dependentes)
+BACKUP_TABLES = OrderedDict([
+    ("usuarios", ("username", "password_hash", "tipo", "nome_completo", "email", "data_criacao")),
+    ("usuario_setores", ("username", "setor")),
+    ("indicadores", ("id", "nome", "objetivo", "formula", "variaveis", "unidade", "meta", "comparacao",
+                     "tipo_grafico", "responsavel", "data_criacao", "data_atualizacao")),
+    ("resultados", ("indicator_id", "data_referencia", "resultado", "valores_variaveis", "observacao",
+                    "analise_critica", "data_criacao", "data_atualizacao", "usuario", "status_analise")),
+    ("configuracoes", ("key", "value")),
+    ("log_backup", ("id", "timestamp", "action", "file_name", "user_performed")),
+    ("log_indicadores", ("id", "timestamp", "action", "indicator_id", "user_performed")),
+    ("log_usuarios", ("id", "timestamp", "action", "username_affected", "user_performed")),
+])
+BACKUP_JSONB_COLUMNS = {"variaveis", "valores_variaveis", "analise_critica"}
+
+# Backups incrementais (ver backup_data): tabela -> (coluna de data de alteração, chave primária).
+# Só vão as chaves das linhas excluídas (registradas em backup_exclusoes por gatilhos, inclusive as exclusões em
+# cascata e as de archive_audit_logs) e as linhas alteradas desde a fotografia do backup anterior: o tamanho de um
+# incremental acompanha o volume de alterações, não o das tabelas. As demais tabelas, pequenas, vão completas.
+BACKUP_INCREMENTAL_TABLES = {
+    "indicadores": ("data_atualizacao", ("id",)),
+    "resultados": ("data_atualizacao", ("indicator_id", "data_referencia")),
+    "log_backup": ("timestamp", ("id",)),
+    "log_indicadores": ("timestamp", ("id",)),
+    "log_usuarios": ("timestamp", ("id",)),
+}
+# data_atualizacao é o início da transação que gravou a linha: a margem cobre transações que começaram antes
+# da fotografia anterior mas só foram confirmadas depois dela (reaplicar uma linha não tem efeito colateral)
+BACKUP_INCREMENTAL_OVERLAP = timedelta(minutes=int(os.environ.get("SCPC_BACKUP_INCREMENTAL_OVERLAP_MIN", 10)))
+BACKUP_CHAIN_MAX = int(os.environ.get("SCPC_BACKUP_CHAIN_MAX", 48)) # Incrementais seguidos antes de forçar um completo
+BACKUP_INCREMENTAL_INTERVALS = {0: "Desativado", 1: "A cada hora", 2: "A cada 2 horas", 4: "A cada 4 horas",
+                                6: "A cada 6 horas", 12: "A cada 12 horas"}
+
+
+class BackupFormatError(ValueError):
+    """Arquivo de backup inválido, corrompido, truncado ou cifrado com outra chave."""
+
+
+class _EncryptedChunkWriter:
+    """Objeto-arquivo só de escrita que cifra o que recebe em quadros de até `chunk_size` bytes."""
+
+    def __init__(self, fileobj, cipher, chunk_size=BACKUP_CHUNK_SIZE):
+        self._file = fileobj
+        self._cipher = cipher
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._sequence = 0
+        self.closed = False
+
+    def writable(self):
+        return True
 
-    # Carrega dados de TODAS as tabelas
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) > self._chunk_size:
+            self._emit(bytes(self._buffer[:self._chunk_size]), final=False)
+            del self._buffer[:self._chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Grava o restante do buffer como último quadro. Sem ele, o leitor considera o arquivo truncado."""
+        if self.closed:
+            return
+        self._emit(bytes(self._buffer), final=True)
+        self._buffer.clear()
+        self.closed = True
+
+    def _emit(self, data, final):
+        token = self._cipher.encrypt(_BACKUP_CHUNK_HEADER.pack(self._sequence, final) + data)
+        self._file.write(_BACKUP_FRAME_LENGTH.pack(len(token)))
+        self._file.write(token)
+        self._sequence += 1
+
+
+class _EncryptedChunkReader(RawIOBase):
+    """Leitor dos quadros gravados por _EncryptedChunkWriter; decifra e valida um quadro por vez."""
+
+    def __init__(self, fileobj, cipher):
+        super().__init__()
+        self._file = fileobj
+        self._cipher = cipher
+        self._pending = memoryview(b"")
+        self._sequence = 0
+        self._finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            if self._finished:
+                return 0
+            self._next_frame()
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def _next_frame(self):
+        prefix = self._file.read(_BACKUP_FRAME_LENGTH.size)
+        if len(prefix) < _BACKUP_FRAME_LENGTH.size:
+            raise BackupFormatError("Backup truncado: o último bloco não foi encontrado.")
+        (length,) = _BACKUP_FRAME_LENGTH.unpack(prefix)
+        token = self._file.read(length)
+        if len(token) < length:
+            raise BackupFormatError(f"Backup truncado no bloco {self._sequence}.")
+        try:
+            plain = self._cipher.decrypt(token)
+        except InvalidToken:
+            raise BackupFormatError(f"O bloco {self._sequence} não pôde ser autenticado "
+                                    "(arquivo corrompido ou chave de criptografia incorreta).") from None
+        sequence, final = _BACKUP_CHUNK_HEADER.unpack_from(plain)
+        if sequence != self._sequence:
+            raise BackupFormatError(f"Bloco fora de ordem: esperado {self._sequence}, encontrado {sequence}.")
+        self._sequence += 1
+        self._finished = final
+        self._pending = memoryview(plain)[_BACKUP_CHUNK_HEADER.size:]
+        if final and self._file.read(1):
+            raise BackupFormatError("Dados inesperados após o último bloco do backup.")
+
+
+def _backup_json_default(value):
+    """Serializa os tipos do psycopg2 que o json não conhece (TIMESTAMP e NUMERIC)."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Tipo não serializável no backup: {type(value).__name__}")
+
+
+def _backup_line(item):
+    return (json.dumps(item, default=_backup_json_default, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def _backup_codec():
+    """Codec de compressão dos novos backups: BACKUP_CODEC, com gzip quando zstd não está disponível."""
+    if BACKUP_CODEC == "zstd" and zstandard is not None:
+        return "zstd"
+    return "gzip"
+
+
+def _backup_compressor(codec, fileobj):
+    """Objeto-arquivo que comprime o que recebe e grava em `fileobj`; fechá-lo não fecha `fileobj`."""
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=BACKUP_ZSTD_LEVEL).stream_writer(fileobj, closefd=False)
+    return gzip.GzipFile(fileobj=fileobj, mode="wb")
+
+
+def _backup_decompressor(codec, fileobj):
+    """Objeto-arquivo de leitura (iterável por linhas) que descomprime `fileobj`."""
+    if codec == "zstd":
+        if zstandard is None:
+            raise BackupFormatError("O backup usa compressão zstd, mas o pacote zstandard não está instalado.")
+        return BufferedReader(zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True))
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    raise BackupFormatError(f"Codec de compressão desconhecido no backup: {codec}.")
+
+
+def _backup_header_frame(cipher, header):
+    """Quadro cifrado do cabeçalho; sempre do mesmo tamanho, para poder ser reescrito no lugar."""
+    data = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    if len(data) > BACKUP_HEADER_SIZE:
+        raise ValueError("Cabeçalho de backup maior que BACKUP_HEADER_SIZE.")
+    token = cipher.encrypt(data.ljust(BACKUP_HEADER_SIZE))
+    return _BACKUP_FRAME_LENGTH.pack(len(token)) + token
+
+
+def _read_backup_header(raw, cipher):
+    """Lê e decifra o quadro de cabeçalho de um backup do formato 2 (logo após BACKUP_MAGIC)."""
+    prefix = raw.read(_BACKUP_FRAME_LENGTH.size)
+    token = raw.read(_BACKUP_FRAME_LENGTH.unpack(prefix)[0]) if len(prefix) == _BACKUP_FRAME_LENGTH.size else b""
     try:
-        all_data = {
-            "users": load_users(), # Agora inclui setores como lista
-            "indicators": load_indicators(),
-            "results": load_results(),
-            "config": load_config(),
-            "backup_log": load_backup_log(),
-            "indicator_log": load_indicator_log(),
-            "user_log": load_user_log()
-        }
-    except Exception as e:
-         print(f"Erro ao carregar dados do DB para backup: {e}") # Mantém este print
-         return None
+        header = json.loads(cipher.decrypt(token))
+    except (InvalidToken, ValueError):
+        raise BackupFormatError("O cabeçalho do backup não pôde ser lido "
+                                "(arquivo corrompido ou chave de criptografia incorreta).") from None
+    if not isinstance(header, dict) or header.get("formato") != BACKUP_FORMAT_VERSION:
+        raise BackupFormatError("Cabeçalho de backup inválido ou de versão desconhecida.")
+    return header
+
 
+def _backup_section_id(table, mode):
+    """Nome de uma seção do fluxo no cabeçalho: a própria tabela para seções completas, "tabela:modo" nas demais."""
+    return table if mode == "completo" else f"{table}:{mode}"
 
+
+def _open_backup_snapshot(conn):
+    """
+    Abre na conexão a transação REPEATABLE READ somente leitura do backup (uma fotografia consistente do banco)
+    e a exporta com pg_export_snapshot, para que as conexões dos workers (_export_backup_section) leiam a mesma
+    fotografia. A transação deve ficar aberta até todos os workers terem importado a fotografia.
+    Retorna (instante da fotografia, usado como início do próximo incremental; identificador da fotografia).
+    """
+    cur = conn.cursor()
     try:
-        # Serializa os dados para JSON (com indentação para legibilidade no arquivo, default=str para datas/objetos não JSON serializáveis)
-        all_data_str = json.dumps(all_data, indent=4, default=str).encode('utf-8') # Codifica para bytes
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+        cur.execute("SELECT LOCALTIMESTAMP, pg_export_snapshot();")
+        return cur.fetchone()
+    finally:
+        cur.close()
 
-        encrypted_data = cipher.encrypt(all_data_str) # Criptografa os bytes
-    except Exception as e:
-         print(f"Erro ao serializar ou criptografar dados para backup: {e}") # Mantém este print
-         return None
 
+def _backup_sections(desde=None):
+    """
+    Seções do fluxo de um backup: (tabela, modo, colunas, consulta, parâmetros), na ordem do arquivo.
+    Com `desde` (backup incremental), as tabelas de BACKUP_INCREMENTAL_TABLES levam só as chaves das linhas excluídas
+    e as linhas alteradas a partir de `desde` - BACKUP_INCREMENTAL_OVERLAP, nessa ordem: uma linha excluída e depois
+    recriada volta na seção "alterados", aplicada depois das exclusões.
+    """
+    sections = []
+    for table, columns in BACKUP_TABLES.items():
+        select = sql.SQL("SELECT {} FROM {}").format(sql.SQL(", ").join(map(sql.Identifier, columns)), sql.Identifier(table))
+        if desde is None or table not in BACKUP_INCREMENTAL_TABLES:
+            sections.append((table, "completo", columns, select, None))
+            continue
+        changed_column, key_columns = BACKUP_INCREMENTAL_TABLES[table]
+        # As chaves vêm do JSON com os tipos da própria tabela (jsonb_populate_record)
+        sections.append((table, "excluidos", key_columns, sql.SQL("""
+            SELECT {keys} FROM backup_exclusoes e CROSS JOIN LATERAL jsonb_populate_record(NULL::{table}, e.chave) AS r
+            WHERE e.tabela = %s AND e.excluido_em >= %s
+        """).format(keys=sql.SQL(", ").join(sql.SQL("r.{}").format(sql.Identifier(column)) for column in key_columns),
+                    table=sql.Identifier(table)), (table, desde - BACKUP_INCREMENTAL_OVERLAP)))
+        sections.append((table, "alterados", columns,
+                         select + sql.SQL(" WHERE {} >= %s").format(sql.Identifier(changed_column)),
+                         (desde - BACKUP_INCREMENTAL_OVERLAP,)))
+    return sections
+
+
+def _prune_backup_exclusions(conn, ate):
+    """
+    Depois de um backup com fotografia em `ate`: remove de backup_exclusoes as exclusões que nenhum incremental
+    futuro vai exportar (o próximo parte deste backup, a partir de `ate` - BACKUP_INCREMENTAL_OVERLAP).
+    """
+    cur = None
+    try:
+        conn.rollback() # Encerra a transação somente leitura da fotografia
+        cur = conn.cursor()
+        cur.execute("DELETE FROM backup_exclusoes WHERE excluido_em < %s;", (ate - BACKUP_INCREMENTAL_OVERLAP,))
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Erro ao limpar as exclusões registradas para os backups incrementais: {e}") # Mantém este print
+    finally:
+        if cur is not None: cur.close()
 
-    # Define o nome do arquivo de backup baseado no tipo (user/seguranca) e timestamp
-    if tipo_backup == "user":
-        BACKUP_FILE = os.path.join("backups", f"backup_user_{datetime.now().strftime('%Y%m%d_%H%M%S')}.bkp")
-    else: # tipo_backup == "seguranca"
-        BACKUP_FILE = os.path.join("backups", f"backup_seguranca_{datetime.now().strftime('%Y%m%d_%H%M%S')}.bkp")
 
-    # Cria o diretório de backups se não existir
-    if not os.path.exists("backups"):
-        os.makedirs("backups")
+def _export_backup_section(snapshot_id, section, codec, spool_dir):
+    """
+    Worker do backup: numa conexão própria, importa a fotografia `snapshot_id` e grava a seção (linhas JSON
+    comprimidas, um membro gzip/quadro zstd completo) num arquivo temporário anônimo em `spool_dir`.
+    Retorna (arquivo temporário, linhas, SHA-256 das linhas).
+    """
+    table, mode, columns, query, params = section
+    conn = get_db_connection()
+    if conn is None:
+        raise psycopg2.OperationalError(f"Sem conexão com o banco para exportar {table}.")
+    spool = tempfile.TemporaryFile(dir=spool_dir)
+    try:
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+        cur.execute("SET TRANSACTION SNAPSHOT %s;", (snapshot_id,))
+        cur.close()
+        table_cur = conn.cursor(name=f"backup_{table}_{mode}")
+        table_cur.itersize = BACKUP_FETCH_SIZE
+        digest = hashlib.sha256()
+        count = 0
+        with _backup_compressor(codec, spool) as payload:
+            payload.write(_backup_line({"tabela": table, "modo": mode, "colunas": list(columns)}))
+            table_cur.execute(query, params)
+            for row in table_cur:
+                line = _backup_line(row)
+                digest.update(line)
+                payload.write(line)
+                count += 1
+            table_cur.close()
+            payload.write(_backup_line({"fim": _backup_section_id(table, mode), "linhas": count}))
+        return spool, count, digest.hexdigest()
+    except Exception:
+        spool.close()
+        raise
+    finally:
+        conn.close()
+
+
+def _backup_table_sizes(conn):
+    """Número estimado de linhas de cada tabela do backup (pg_class.reltuples), usado para ordenar as exportações."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r' AND relname = ANY(%s);", (list(BACKUP_TABLES),))
+        return dict(cur.fetchall())
+    finally:
+        cur.close()
+
+
+def _write_backup_stream(snapshot_id, stream, codec, desde=None, table_sizes=None, spool_dir="backups"):
+    """
+    Grava em `stream` (binário, já cifrado por quadros) as seções do backup, exportadas em paralelo por até
+    BACKUP_WORKERS conexões que compartilham a fotografia `snapshot_id` (ver _open_backup_snapshot).
+    Cada worker comprime sua seção num arquivo temporário; as seções são então copiadas em ordem, já comprimidas,
+    de modo que o fluxo é a concatenação de um membro gzip/quadro zstd por seção. As seções das maiores tabelas
+    (table_sizes) são iniciadas primeiro; o tempo total fica próximo do da exportação da maior tabela.
+    Retorna os campos do cabeçalho calculados na gravação: {"tabelas": [...], "linhas": {...}, "sha256": {...}}.
+    """
+    sections = _backup_sections(desde)
+    table_sizes = table_sizes or {}
+    order = sorted(range(len(sections)), key=lambda i: table_sizes.get(sections[i][0], 0), reverse=True)
+    workers = max(1, min(BACKUP_WORKERS, DB_POOL_CONFIG["maxconn"] - 1, len(sections)))
+    futures = [None] * len(sections)
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backup") as executor:
+            for i in order:
+                futures[i] = executor.submit(_export_backup_section, snapshot_id, sections[i], codec, spool_dir)
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    for pending in futures: pending.cancel() # Interrompe as seções que ainda não começaram
+                    raise future.exception()
+
+        counts, checksums = {}, {}
+        for (table, mode, *_), future in zip(sections, futures):
+            spool, count, checksum = future.result()
+            spool.seek(0)
+            shutil.copyfileobj(spool, stream, BACKUP_CHUNK_SIZE)
+            section = _backup_section_id(table, mode)
+            counts[section] = count
+            checksums[section] = checksum
+        return {"tabelas": list(counts), "linhas": counts, "sha256": checksums}
+    finally:
+        for future in futures:
+            if future is not None and future.done() and not future.cancelled() and future.exception() is None:
+                future.result()[0].close()
+
+
+def iter_backup(backup_file_path, cipher):
+    """
+    Lê um arquivo de backup em fluxo, sem carregá-lo inteiro na memória.
+    O primeiro item produzido é o cabeçalho (dict); os seguintes são (tabela, colunas, linhas, modo), com até
+    BACKUP_FETCH_SIZE linhas por item; modo é "completo", "excluidos" ou "alterados" (ver _backup_sections).
+    A contagem e o SHA-256 de cada seção são conferidos com o cabeçalho ao fim da seção.
+    Backups do formato 0 são convertidos para a mesma forma.
+    Arquivos inválidos levantam BackupFormatError (possivelmente só no meio da leitura).
+    """
+    with open(backup_file_path, "rb") as raw:
+        magic = raw.read(len(BACKUP_MAGIC))
+        if magic != BACKUP_MAGIC:
+            raw.seek(0)
+            yield from _iter_legacy_backup(raw.read(), cipher)
+            return
+        header = _read_backup_header(raw, cipher)
+        lines = iter(_backup_decompressor(header.get("compressao"), BufferedReader(_EncryptedChunkReader(raw, cipher))))
+        yield header
+
+        expected_counts, expected_checksums = header.get("linhas", {}), header.get("sha256", {})
+        table, columns, mode, section, batch, count, digest, finished = None, None, None, None, [], 0, None, []
+        for line in lines:
+            item = json.loads(line)
+            if isinstance(item, list):
+                if table is None:
+                    raise BackupFormatError("Linha de dados fora de uma tabela.")
+                digest.update(line)
+                batch.append(item)
+                count += 1
+                if len(batch) >= BACKUP_FETCH_SIZE:
+                    yield table, columns, batch, mode
+                    batch = []
+            elif "tabela" in item:
+                table, columns, mode = item["tabela"], item["colunas"], item.get("modo", "completo")
+                section, count, digest = _backup_section_id(table, mode), 0, hashlib.sha256()
+            elif "fim" in item:
+                if item["fim"] != section or item["linhas"] != count or expected_counts.get(section, count) != count:
+                    raise BackupFormatError(f"Contagem de linhas inconsistente na seção {item['fim']}.")
+                if expected_checksums.get(section, digest.hexdigest()) != digest.hexdigest():
+                    raise BackupFormatError(f"Soma de verificação (SHA-256) divergente na seção {section}.")
+                if batch:
+                    yield table, columns, batch, mode
+                    batch = []
+                finished.append(section)
+                table = None
+        if table is not None or finished != header.get("tabelas"):
+            raise BackupFormatError("Backup incompleto: nem todas as tabelas foram encontradas.")
+
+
+def read_backup_header(backup_file_path, cipher):
+    """Cabeçalho de um arquivo de backup (ver iter_backup), sem ler os dados; None se o arquivo for inválido."""
+    batches = iter_backup(backup_file_path, cipher)
+    try:
+        return next(batches)
+    except (BackupFormatError, OSError, ValueError, StopIteration):
+        return None
+    finally:
+        batches.close()
+
+
+def _iter_legacy_backup(encrypted_data, cipher):
+    """Converte um backup do formato 0 (JSON de load_users/load_indicators/...) para a forma de iter_backup."""
+    try:
+        data = json.loads(cipher.decrypt(encrypted_data).decode("utf-8"))
+    except InvalidToken:
+        raise BackupFormatError("O backup não pôde ser descriptografado "
+                                "(arquivo corrompido ou chave de criptografia incorreta).") from None
+    yield {"formato": 0, "tabelas": list(BACKUP_TABLES)}
+
+    agora = datetime.now() # Datas ausentes no formato antigo eram preenchidas com CURRENT_TIMESTAMP
+    users = data.get("users", {})
+    yield "usuarios", BACKUP_TABLES["usuarios"], [
+        (u, d.get("password", ""), d.get("tipo", "Visualizador"), d.get("nome_completo") or None,
+         d.get("email") or None, d.get("data_criacao") or agora)
+        for u, d in users.items()
+    ], "completo"
+    yield "usuario_setores", BACKUP_TABLES["usuario_setores"], [
+        (u, setor) for u, d in users.items() for setor in d.get("setores", [])
+    ], "completo"
+    yield "indicadores", BACKUP_TABLES["indicadores"], [
+        (i.get("id"), i.get("nome"), i.get("objetivo"), i.get("formula"), i.get("variaveis") or {},
+         i.get("unidade"), i.get("meta"), i.get("comparacao"), i.get("tipo_grafico"), i.get("responsavel"),
+         i.get("data_criacao") or agora, i.get("data_atualizacao") or agora)
+        for i in data.get("indicators", [])
+    ], "completo"
+    results = []
+    for r in data.get("results", []):
+        if not r.get("data_referencia"):
+            continue # Ignora resultados sem data de referência
+        try:
+            results.append(_result_upsert_params(
+                r.get("indicator_id"), r.get("data_referencia"), r.get("resultado"),
+                valores_variaveis=r.get("valores_variaveis", {}),
+                observacao=r.get("observacao", ""),
+                analise_critica=r.get("analise_critica", {}),
+                usuario=r.get("usuario") if r.get("usuario") is not None else 'Sistema Restaurado',
+                status_analise=r.get("status_analise") if r.get("status_analise") is not None else 'N/A',
+                data_criacao=r.get("data_criacao") or agora,
+                data_atualizacao=r.get("data_atualizacao") or agora,
+            ))
+        except (ValueError, TypeError):
+            print(f"Resultado com data inválida ignorado na restauração: {r.get('data_referencia')}")
+    yield "resultados", BACKUP_TABLES["resultados"], results, "completo"
+    yield "configuracoes", BACKUP_TABLES["configuracoes"], list(data.get("config", {}).items()), "completo"
+    # Nem todo backup antigo tem o id das entradas de log: elas são renumeradas, da mais antiga para a mais recente.
+    # As chaves do objeto afetado são as gravadas pelas funções de log antigas (o usuário afetado era "username").
+    for table, key, target_key in (("log_backup", "backup_log", "file_name"), ("log_indicadores", "indicator_log", "indicator_id"),
+                                   ("log_usuarios", "user_log", "username")):
+        yield table, BACKUP_TABLES[table][1:], [
+            (e.get("timestamp") or None, e.get("action") or None, e.get(target_key) or None, e.get("user"))
+            for e in reversed(data.get(key, []))
+        ], "completo"
+
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_value(value, is_json=False):
+    """Valor no formato texto do COPY: NULL como \\N, JSONB como texto JSON, demais tipos via str()."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, Json):
+        value = value.adapted
+    if is_json:
+        value = json.dumps(value, ensure_ascii=False)
+    elif isinstance(value, datetime):
+        value = value.isoformat()
+    elif isinstance(value, bool):
+        return "t" if value else "f"
+    else:
+        value = str(value)
+    return value.translate(_COPY_ESCAPES)
+
+
+def _copy_backup_rows(cur, table, columns, rows, target=None):
+    """
+    Carrega um lote de linhas lidas por iter_backup com COPY ... FROM STDIN (uma única ida ao banco).
+    target: sql.Identifier da tabela de destino, quando não é a própria tabela (tabelas temporárias da restauração).
+    """
+    if table not in BACKUP_TABLES or not set(columns) <= set(BACKUP_TABLES[table]):
+        raise BackupFormatError(f"Tabela ou colunas desconhecidas no backup: {table}.")
+    if not rows:
+        return
+    is_json = [column in BACKUP_JSONB_COLUMNS for column in columns]
+    data = StringIO("".join("\t".join(_copy_value(v, j) for v, j in zip(row, is_json)) + "\n" for row in rows))
+    cur.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN;").format(
+        target or sql.Identifier(table), sql.SQL(", ").join(map(sql.Identifier, columns))).as_string(cur), data)
+
+
+def _upsert_backup_rows(cur, table, columns, rows):
+    """Aplica um lote da seção "alterados" de um incremental: COPY para uma tabela temporária e INSERT ... ON CONFLICT."""
+    if table not in BACKUP_INCREMENTAL_TABLES:
+        raise BackupFormatError(f"Tabela sem backup incremental: {table}.")
+    key_columns = BACKUP_INCREMENTAL_TABLES[table][1]
+    staging = sql.Identifier(f"restauracao_{table}")
+    cur.execute(sql.SQL("CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {}) ON COMMIT DROP; TRUNCATE {};").format(
+        staging, sql.Identifier(table), staging))
+    _copy_backup_rows(cur, table, columns, rows, target=staging)
+    column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+    cur.execute(sql.SQL("""
+        INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging}
+        ON CONFLICT ({keys}) DO UPDATE SET {updates};
+    """).format(
+        table=sql.Identifier(table), columns=column_list, staging=staging,
+        keys=sql.SQL(", ").join(map(sql.Identifier, key_columns)),
+        updates=sql.SQL(", ").join(sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column))
+                                   for column in columns if column not in key_columns)))
+
+
+def _delete_backup_keys(cur, table, columns, rows):
+    """Aplica um lote da seção "excluidos" de um incremental: COPY das chaves para uma tabela temporária e DELETE ... USING."""
+    if table not in BACKUP_INCREMENTAL_TABLES:
+        raise BackupFormatError(f"Tabela sem backup incremental: {table}.")
+    staging = sql.Identifier(f"restauracao_{table}_excluidos")
+    cur.execute(sql.SQL("""
+        CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DROP AS SELECT {keys} FROM {table} WITH NO DATA;
+        TRUNCATE {staging};
+    """).format(staging=staging, table=sql.Identifier(table), keys=sql.SQL(", ").join(map(sql.Identifier, columns))))
+    _copy_backup_rows(cur, table, columns, rows, target=staging)
+    cur.execute(sql.SQL("DELETE FROM {table} AS t USING {staging} AS k WHERE {match};").format(
+        table=sql.Identifier(table), staging=staging,
+        match=sql.SQL(" AND ").join(sql.SQL("k.{0} = t.{0}").format(sql.Identifier(column)) for column in columns)))
+
+
+def _prepare_incremental_restore(cur, header):
+    """
+    Antes de aplicar um incremental: esvazia as tabelas que vieram completas nele. Usa o cabeçalho, pois seções
+    vazias não produzem lotes.
+    """
+    for section in header.get("tabelas", []):
+        table, _, mode = section.partition(":")
+        if table not in BACKUP_TABLES:
+            raise BackupFormatError(f"Tabela desconhecida no backup: {table}.")
+        if not mode:
+            cur.execute(sql.SQL("DELETE FROM {};").format(sql.Identifier(table)))
+
+
+def _incremental_parent(cur, cipher, backup_dir="backups"):
+    """
+    Backup sobre o qual um novo incremental é construído: o mais recente de `backup_dir` pelo instante da
+    fotografia ("ate" no cabeçalho). Retorna (caminho, cabeçalho), ou None quando é preciso um backup completo:
+    não há backup do formato 2 com fotografia, a cadeia já tem BACKUP_CHAIN_MAX incrementais ou houve uma
+    restauração depois dele (os dados restaurados mantêm as datas de alteração antigas).
+    """
+    candidates = []
+    for name in os.listdir(backup_dir):
+        path = os.path.join(backup_dir, name)
+        if not (name.startswith("backup_") and name.endswith(".bkp")):
+            continue
+        with open(path, "rb") as raw:
+            if raw.read(len(BACKUP_MAGIC)) != BACKUP_MAGIC:
+                continue # Formatos anteriores não registram a fotografia
+        header = read_backup_header(path, cipher)
+        if header and header.get("ate"):
+            candidates.append((header["ate"], path, header))
+    if not candidates:
+        return None
+    ate, path, header = max(candidates, key=lambda candidate: candidate[:2])
+    if header.get("sequencia", 0) >= BACKUP_CHAIN_MAX:
+        return None
+    cur.execute("SELECT 1 FROM log_backup WHERE action = 'Backup restaurado' AND timestamp >= %s LIMIT 1;",
+                (datetime.fromisoformat(ate),))
+    if cur.fetchone():
+        return None
+    return path, header
+
+
+def resolve_backup_chain(backup_file_path, cipher):
+    """
+    Cadeia de arquivos necessária para restaurar `backup_file_path`: o backup completo em que ela se apoia
+    seguido dos incrementais, em ordem. Levanta BackupFormatError se algum elo estiver ausente ou ilegível.
+    """
+    chain = [backup_file_path]
+    while True:
+        header = read_backup_header(chain[-1], cipher)
+        if header is None:
+            raise BackupFormatError(f"Backup inválido ou ilegível: {os.path.basename(chain[-1])}.")
+        if header.get("tipo", "completo") != "incremental":
+            return list(reversed(chain))
+        previous = os.path.join(os.path.dirname(chain[-1]), header["anterior"])
+        previous_header = read_backup_header(previous, cipher) if os.path.exists(previous) else None
+        if previous_header is None or previous_header.get("ate") != header.get("desde"):
+            raise BackupFormatError(f"O backup anterior da cadeia ({header['anterior']}) não foi encontrado ou não corresponde.")
+        if len(chain) > BACKUP_CHAIN_MAX:
+            raise BackupFormatError("Cadeia de backups incrementais longa demais.")
+        chain.append(previous)
 
 
+def backup_data(cipher, tipo_backup="user"):
+    """
+    Cria um arquivo de backup criptografado com todas as tabelas do DB (formato em fluxo, ver BACKUP_MAGIC).
+    As tabelas são exportadas em paralelo sobre uma mesma fotografia do banco (ver _write_backup_stream);
+    as linhas são serializadas e compactadas à medida que chegam, de modo que o uso de memória não depende
+    do tamanho das tabelas. O arquivo é gravado com a extensão .parcial e só recebe o nome final quando está completo.
+    tipo_backup: "user" ou "seguranca" (completos) ou "incremental": só as alterações desde o backup mais recente
+    (ver _incremental_parent); sem um backup anterior utilizável, é feito um backup completo de segurança.
+    """
+    if not cipher:
+        print("Objeto de criptografia não inicializado. Backup cancelado.") # Mantém este print
+        return None
+
+    os.makedirs("backups", exist_ok=True)
+    conn = get_db_connection()
+    if conn is None:
+        print("Não foi possível conectar ao banco de dados para o backup.") # Mantém este print
+        return None
+    partial_file = None
     try:
-        with open(BACKUP_FILE, "wb") as backup_file:
-            backup_file.write(encrypted_data) # Escreve os dados criptografados no arquivo
-        # Log da ação de backup (usa st.session_state.username, que só existe na sessão Streamlit)
-        # Esta logagem pode falhar se o backup for agendado em um thread sem contexto de sessão.
-        # Considerar passar o username como argumento para a função agendada ou usar um placeholder.
-        user_performing_backup = getattr(st.session_state, 'username', 'Sistema Agendado') # Pega username se disponível, senão usa 'Sistema Agendado'
-        log_backup_action("Backup criado", os.path.basename(BACKUP_FILE), user_performing_backup) # Registra no log
-        return BACKUP_FILE # Retorna o caminho do arquivo criado
+        header = {"formato": BACKUP_FORMAT_VERSION, "compressao": _backup_codec(),
+                  "criado_em": datetime.now().isoformat(), "tabelas": list(BACKUP_TABLES),
+                  "tipo": "completo"}
+        ate, snapshot_id = _open_backup_snapshot(conn)
+        header["ate"] = ate.isoformat()
+        desde = None
+        if tipo_backup == "incremental":
+            cur = conn.cursor()
+            parent = _incremental_parent(cur, cipher)
+            cur.close()
+            if parent is None:
+                print("Nenhum backup anterior utilizável para o incremental; criando backup completo.") # Mantém este print
+                tipo_backup = "seguranca"
+            else:
+                parent_path, parent_header = parent
+                desde = datetime.fromisoformat(parent_header["ate"])
+                header.update(tipo="incremental", anterior=os.path.basename(parent_path), desde=parent_header["ate"],
+                              sequencia=parent_header.get("sequencia", 0) + 1)
+
+        # Define o nome do arquivo de backup baseado no tipo (user/seguranca/incremental) e timestamp
+        BACKUP_FILE = os.path.join("backups", f"backup_{tipo_backup}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.bkp")
+        partial_file = BACKUP_FILE + ".parcial"
+        with open(partial_file, "wb") as backup_file:
+            backup_file.write(BACKUP_MAGIC)
+            backup_file.write(_backup_header_frame(cipher, header)) # Reservado; reescrito abaixo
+            chunks = _EncryptedChunkWriter(backup_file, cipher)
+            header.update(_write_backup_stream(snapshot_id, chunks, header["compressao"], desde=desde,
+                                               table_sizes=_backup_table_sizes(conn)))
+            chunks.close()
+            backup_file.seek(len(BACKUP_MAGIC))
+            backup_file.write(_backup_header_frame(cipher, header))
+        os.replace(partial_file, BACKUP_FILE)
+        _prune_backup_exclusions(conn, ate)
     except Exception as e:
-        print(f"Erro ao salvar o arquivo de backup: {e}") # Mantém este print
-        return None # Retorna None em caso de error
+        print(f"Erro ao gerar o arquivo de backup: {e}") # Mantém este print
+        if partial_file and os.path.exists(partial_file): os.remove(partial_file)
+        return None
+    finally:
+        conn.close()
 
+    # Log da ação de backup (st.session_state.username só existe na sessão Streamlit; o backup agendado usa o fallback)
+    user_performing_backup = getattr(st.session_state, 'username', 'Sistema Agendado')
+    log_backup_action("Backup criado", os.path.basename(BACKUP_FILE), user_performing_backup) # Registra no log
+    return BACKUP_FILE # Retorna o caminho do arquivo criado
 
-def restore_data(backup_file_path, cipher):
-    """Restaura os dados a partir de um arquivo de backup criptografado para o DB."""
+
+def restore_data(backup_file_path, cipher, report=None):
+    """
+    Restaura os dados (incluindo os logs de auditoria) a partir de um arquivo de backup criptografado para o DB.
+    Um backup incremental é restaurado com toda a sua cadeia (resolve_backup_chain): o backup completo de base
+    e, em ordem, cada incremental. Os arquivos são lidos em fluxo (iter_backup) e carregados em lotes com COPY;
+    tudo ocorre numa única transação, desfeita se algum bloco de algum arquivo estiver corrompido.
+    report: dicionário opcional preenchido com {tabela: {"linhas": n, "segundos": s}} (tempo de leitura + carga).
+    """
+    report = {} if report is None else report
     if not cipher:
         print("Objeto de criptografia não inicializado. Restauração cancelada.") # Mantém este print
         return False
@@ -3797,15 +6300,11 @@ def restore_data(backup_file_path, cipher):
          print(f"Arquivo de backup não encontrado: {backup_file_path}") # Mantém este print
          return False
 
+    # Valida os cabeçalhos de toda a cadeia antes de apagar os dados atuais
     try:
-        with open(backup_file_path, "rb") as file:
-            encrypted_data = file.read() # Lê os dados criptografados do arquivo
-
-        decrypted_data_str = cipher.decrypt(encrypted_data).decode('utf-8') # Descriptografa e decodifica para string
-        restored_data = json.loads(decrypted_data_str) # Carrega os dados do JSON
-
+        chain = resolve_backup_chain(backup_file_path, cipher)
     except Exception as e:
-        print(f"Erro ao ler, descriptografar ou carregar dados do backup '{backup_file_path}': {e}") # Mantém este print
+        print(f"Erro ao ler ou descriptografar o backup '{backup_file_path}': {e}") # Mantém este print
         st.error(f"Erro ao processar o arquivo de backup: {e}. Verifique se o arquivo não está corrompido e se a chave de criptografia está correta.") # Mantém este print
         return False
 
@@ -3824,151 +6323,49 @@ def restore_data(backup_file_path, cipher):
 
         # Limpa as tabelas existentes ANTES de inserir os dados restaurados
         # CUIDADO: Isso apaga TODOS os dados atuais!
-        # Começa pelas tabelas dependentes
-        cur.execute("DELETE FROM usuario_setores;")
-        cur.execute("DELETE FROM resultados;")
-        cur.execute("DELETE FROM indicadores;")
-        cur.execute("DELETE FROM usuarios;")
-        cur.execute("DELETE FROM configuracoes;")
-        cur.execute("DELETE FROM log_backup;")
-        cur.execute("DELETE FROM log_indicadores;")
-        cur.execute("DELETE FROM log_usuarios;")
-
-
-        # --- Inserir dados de usuários ---
-        users_to_insert = restored_data.get("users", {})
-        if users_to_insert:
-            # Cria lista de tuplas para inserção na tabela usuarios
-            user_records = []
-            for u, d in users_to_insert.items():
-                 # Ajusta para lidar com valores None na data_criacao e garantir None para campos vazios
-                 data_criacao_str = d.get("data_criacao")
-                 data_criacao_dt = datetime.fromisoformat(data_criacao_str) if data_criacao_str else None
-                 nome_completo = d.get("nome_completo", "")
-                 email = d.get("email", "")
-
-                 user_records.append((
-                     u, d.get("password", ""), d.get("tipo", "Visualizador"),
-                     nome_completo if nome_completo else None, # Insere None se string vazia
-                     email if email else None, # Insere None se string vazia
-                     data_criacao_dt # datetime object ou None
-                 ))
-
-            if user_records: # Verifica se há registros para inserir
-                 sql_insert_users = """
-                    INSERT INTO usuarios (username, password_hash, tipo, nome_completo, email, data_criacao)
-                    VALUES (%s, %s, %s, %s, %s, COALESCE(%s, CURRENT_TIMESTAMP));
-                """
-                 cur.executemany(sql_insert_users, user_records)
-
-            # Cria lista de tuplas para inserção na tabela usuario_setores
-            sector_records = []
-            for username, data in users_to_insert.items():
-                 sectors_list = data.get("setores", [])
-                 for sector in sectors_list:
-                      sector_records.append((username, sector))
-
-            if sector_records:
-                sql_insert_sectors = "INSERT INTO usuario_setores (username, setor) VALUES (%s, %s);"
-                cur.executemany(sql_insert_sectors, sector_records)
-
-
-        # --- Inserir dados de indicadores ---
-        indicators_to_insert = restored_data.get("indicators", [])
-        if indicators_to_insert:
-            indicator_records = []
-            for i in indicators_to_insert:
-                 # Ajusta para lidar com valores None na data_criacao/atualizacao e garantir None para campos vazios
-                 data_criacao_str = i.get("data_criacao")
-                 data_criacao_dt = datetime.fromisoformat(data_criacao_str) if data_criacao_str else None
-                 data_atualizacao_str = i.get("data_atualizacao")
-                 data_atualizacao_dt = datetime.fromisoformat(data_atualizacao_str) if data_atualizacao_str else None
-
-                 indicator_records.append((
-                     i.get("id"), i.get("nome"), i.get("objetivo"), i.get("formula"),
-                     Json(i.get("variaveis", {})), i.get("unidade", "") if i.get("unidade") is not None else None, # Garante None se string vazia para permitir NULL
-                     i.get("meta"),
-                     i.get("comparacao"), i.get("tipo_grafico"),
-                     i.get("responsavel", "") if i.get("responsavel") is not None else None, # Garante None se string vazia
-                     data_criacao_dt, data_atualizacao_dt
-                 ))
-
-            if indicator_records: # Verifica se há registros para inserir
-                 sql_insert_indicators = """
-                    INSERT INTO indicadores (id, nome, objetivo, formula, variaveis, unidade, meta, comparacao, tipo_grafico, responsavel, data_criacao, data_atualizacao)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                            COALESCE(%s, CURRENT_TIMESTAMP), COALESCE(%s, CURRENT_TIMESTAMP));
-                """
-                 cur.executemany(sql_insert_indicators, indicator_records)
-
-
-        # --- Inserir dados de resultados ---
-        results_to_insert = restored_data.get("results", [])
-        if results_to_insert:
-            result_records = []
-            for r in results_to_insert:
-                 # Converte data_referencia de string para datetime
-                 try: data_referencia_str = r.get("data_referencia")
-                 except (ValueError, TypeError): data_referencia_str = None # Ignora se data inválida
-
-                 data_referencia_dt = datetime.fromisoformat(data_referencia_str) if data_referencia_str else None
-
-                 if data_referencia_dt: # Só adiciona se a data for válida
-                     # Ajusta para lidar com valores None nas datas de criação/atualização e usuário/status
-                     data_criacao_str = r.get("data_criacao")
-                     data_criacao_dt = datetime.fromisoformat(data_criacao_str) if data_criacao_str else None
-                     data_atualizacao_str = r.get("data_atualizacao")
-                     data_atualizacao_dt = datetime.fromisoformat(data_atualizacao_str) if data_atualizacao_str else None
-                     observacao = r.get("observacao", "")
-
-
-                     result_records.append((
-                         r.get("indicator_id"),
-                         data_referencia_dt, # datetime object
-                         r.get("resultado"),
-                         Json(r.get("valores_variaveis", {})),
-                         observacao if observacao else None, # Insere None se string vazia
-                         Json(r.get("analise_critica", {})),
-                         data_criacao_dt, # datetime object ou None
-                         data_atualizacao_dt, # datetime object ou None
-                         r.get("usuario", "Sistema Restaurado") if r.get("usuario") is not None else 'Sistema Restaurado', # Garante default se None
-                         r.get("status_analise", "N/A") if r.get("status_analise") is not None else 'N/A' # Garante default se None
-                     ))
-
-            if result_records: # Verifica se há registros para inserir
-                 sql_insert_results = """
-                    INSERT INTO resultados (indicator_id, data_referencia, resultado, valores_variaveis, observacao, analise_critica, data_criacao, data_atualizacao, usuario, status_analise)
-                    VALUES (%s, %s, %s, %s, %s, %s,
-                            COALESCE(%s, CURRENT_TIMESTAMP), COALESCE(%s, CURRENT_TIMESTAMP),
-                            %s, %s);
-                """
-                 cur.executemany(sql_insert_results, result_records)
-
-
-        # --- Inserir dados de configurações ---
-        config_to_insert = restored_data.get("config", {})
-        if config_to_insert:
-             config_records = [(k, v) for k, v in config_to_insert.items()]
-             if config_records:
-                 sql_insert_config = "INSERT INTO configuracoes (key, value) VALUES (%s, %s);"
-                 cur.executemany(sql_insert_config, config_records) # Usando INSERT simples, pois a tabela foi limpa
-
-
-        # --- Inserir dados de logs ---
-        # Decidimos limpar logs durante a restauração e apenas logar a restauração em si.
-        # Se quiser restaurar logs antigos, insira-os aqui de forma semelhante às outras tabelas.
-        # log_backup_to_insert = restored_data.get("backup_log", [])
-        # if log_backup_to_insert:
-        #      log_records = [(datetime.fromisoformat(e["timestamp"]), e["action"], e["file_name"], e["user"]) for e in log_backup_to_insert]
-        #      sql_insert_log = "INSERT INTO log_backup (timestamp, action, file_name, user_performed) VALUES (%s, %s, %s, %s);"
-        #      cur.executemany(sql_insert_log, log_records)
-        # ... repetir para log_indicadores e log_usuarios ...
+        # TRUNCATE de todas as tabelas num único comando (as chaves estrangeiras exigem que as dependentes estejam juntas)
+        cur.execute(sql.SQL("TRUNCATE {};").format(
+            sql.SQL(", ").join(map(sql.Identifier, ["indicator_summary", *BACKUP_TABLES]))))
 
+        last = time.perf_counter()
+        for path in chain:
+            batches = iter_backup(path, cipher)
+            try:
+                header = next(batches)
+                incremental = header.get("tipo") == "incremental"
+                if incremental:
+                    _prepare_incremental_restore(cur, header)
+                for table, columns, rows, mode in batches:
+                    if mode == "alterados":
+                        _upsert_backup_rows(cur, table, columns, rows)
+                    elif mode == "excluidos":
+                        _delete_backup_keys(cur, table, columns, rows)
+                    else:
+                        _copy_backup_rows(cur, table, columns, rows)
+                    now = time.perf_counter()
+                    entry = report.setdefault(table, {"linhas": 0, "segundos": 0.0})
+                    entry["linhas"] += len(rows)
+                    entry["segundos"] += now - last
+                    last = now
+            finally:
+                batches.close()
+
+        # Os ids dos logs vêm do backup: as sequências continuam a partir do maior id restaurado
+        for table in AUDIT_LOG_TABLES:
+            cur.execute(sql.SQL("SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {};")
+                        .format(sql.Identifier(table)), (table,))
+
+        # Recalcula o resumo de todos os indicadores restaurados
+        refresh_indicator_summary(cur)
+        report["indicator_summary"] = {"linhas": cur.rowcount, "segundos": time.perf_counter() - last}
 
         # Habilita novamente as verificações de chave estrangeira
         cur.execute("SET session_replication_role = 'origin';")
 
         conn.commit() # Confirma todas as operações no DB
+        invalidate_data_cache(*DATA_TABLES, "usuarios:todos")
+        print("Restauração concluída: " + ", ".join(
+            f"{table} {entry['segundos']:.2f}s" for table, entry in report.items())) # Mantém este print
 
         # Log da ação de restauração (usando o usuário logado na sessão)
         user_performing_restore = getattr(st.session_state, 'username', 'Sistema Restaurado')
@@ -4009,6 +6406,10 @@ def agendar_backup(cipher):
     # Agenda o job de backup para rodar diariamente no horário configurado
     # Passa o cipher como argumento, pois o thread não tem acesso direto ao estado global Streamlit
     schedule.every().day.at(backup_hour).do(backup_job, cipher, tipo_backup="seguranca")
+    # Backups incrementais entre os completos diários, se configurados (0 = desativado)
+    incremental_hours = int(config.get("backup_incremental_interval", "0") or 0)
+    if incremental_hours > 0:
+        schedule.every(incremental_hours).hours.do(backup_job, cipher, tipo_backup="incremental")
 
     # Loop infinito para rodar o agendador
     # Este loop rodará no thread separado.
@@ -4043,7 +6444,10 @@ def backup_job(cipher, tipo_backup):
 
 
 def keep_last_backups(BACKUP_DIR, num_backups):
-    """Mantém apenas os últimos 'num_backups' arquivos no diretório de backups."""
+    """
+    Mantém apenas os últimos 'num_backups' backups completos no diretório de backups, além dos incrementais
+    mais novos que o mais antigo deles (a base de cada incremental mantido é, portanto, sempre mantida).
+    """
     if not os.path.exists(BACKUP_DIR):
         os.makedirs(BACKUP_DIR) # Cria o diretório se não existir
 
@@ -4053,10 +6457,13 @@ def keep_last_backups(BACKUP_DIR, num_backups):
     # Ordena os arquivos pela data de modificação (do mais recente para o mais antigo)
     # Isso garante que os backups mais recentes sejam mantidos
     backups.sort(key=os.path.getmtime, reverse=True)
+    full_backups = [b for b in backups if not os.path.basename(b).startswith("backup_incremental_")]
 
     # Remove os arquivos mais antigos se houver mais do que o número especificado para manter
-    if len(backups) > num_backups:
-        for backup_to_remove in backups[num_backups:]:
+    if len(full_backups) > num_backups:
+        oldest_kept = os.path.getmtime(full_backups[num_backups - 1])
+        for backup_to_remove in full_backups[num_backups:] + [
+                b for b in backups if b not in full_backups and os.path.getmtime(b) < oldest_kept]:
             try:
                 os.remove(backup_to_remove)
                 print(f"Backup removido por política de retenção: {backup_to_remove}") # Mantém este print
@@ -4064,6 +6471,242 @@ def keep_last_backups(BACKUP_DIR, num_backups):
                 print(f"Erro ao remover backup antigo: {backup_to_remove} - {e}") # Mantém este print
 
 
+# --- Diagnóstico de Planos de Consulta ---
+# "python indicadores_scpc.py explain [--seed N]" executa EXPLAIN ANALYZE nas consultas canônicas da
+# aplicação e aponta as que usam varredura sequencial. Com --seed, gera dados sintéticos antes, dentro
+# de uma transação que é desfeita ao final (nada é gravado no banco).
+# Os parâmetros das consultas são nomes de amostras obtidas do próprio banco (ver _explain_samples).
+
+CANONICAL_QUERIES = [
+    {
+        "nome": "Indicadores por setor responsável",
+        "sql": """
+            SELECT id, nome, objetivo, formula, variaveis, unidade, meta, comparacao,
+                   tipo_grafico, responsavel, data_criacao, data_atualizacao
+            FROM indicadores WHERE responsavel = ANY(%s);
+        """,
+        "params": ("setores",),
+    },
+    {
+        "nome": "Resultados de um indicador (load_results_for)",
+        "sql": f"""
+            SELECT {RESULT_COLUMNS} FROM resultados
+            WHERE indicator_id = ANY(%s)
+            ORDER BY indicator_id, data_referencia DESC;
+        """,
+        "params": ("indicator_ids",),
+    },
+    {
+        "nome": "Último resultado por indicador (latest_result_per_indicator)",
+        "sql": f"""
+            SELECT DISTINCT ON (indicator_id) {RESULT_COLUMNS} FROM resultados
+            WHERE indicator_id = ANY(%s)
+            ORDER BY indicator_id, data_referencia DESC;
+        """,
+        "params": ("indicator_ids",),
+    },
+    {
+        "nome": "Indicadores filtrados por setor, status e busca (load_indicators_filtered)",
+        "sql": f"""
+            SELECT {INDICATOR_COLUMNS}
+            FROM indicadores i
+            LEFT JOIN indicator_summary s ON s.indicator_id = i.id
+            WHERE i.responsavel = ANY(%s) AND COALESCE(s.status, 'Sem Resultados') = ANY(%s)
+              AND (i.nome ILIKE %s OR i.responsavel ILIKE %s)
+            ORDER BY i.nome;
+        """,
+        "params": ("setores", "status", "busca", "busca"),
+    },
+    {
+        "nome": "Resumo por indicador (load_indicator_summary)",
+        "sql": """
+            SELECT indicator_id, ultimo_resultado, data_referencia, resultado_anterior,
+                   num_resultados, status, variacao, atualizado_em
+            FROM indicator_summary WHERE indicator_id = ANY(%s);
+        """,
+        "params": ("indicator_ids",),
+    },
+    {
+        "nome": "Log de backup (mais recentes)",
+        "sql": "SELECT timestamp, action, file_name, user_performed FROM log_backup ORDER BY timestamp DESC, id DESC LIMIT 100;",
+        "params": (),
+    },
+    {
+        "nome": "Log de backup (página seguinte, keyset)",
+        "sql": "SELECT id, timestamp, action, file_name, user_performed FROM log_backup WHERE (timestamp, id) < (%s, %s) ORDER BY timestamp DESC, id DESC LIMIT 100;",
+        "params": ("log_backup_cursor_timestamp", "log_backup_cursor_id"),
+    },
+    {
+        "nome": "Log de indicadores (mais recentes)",
+        "sql": "SELECT timestamp, action, indicator_id, user_performed FROM log_indicadores ORDER BY timestamp DESC, id DESC LIMIT 100;",
+        "params": (),
+    },
+    {
+        "nome": "Log de indicadores (página seguinte, keyset)",
+        "sql": "SELECT id, timestamp, action, indicator_id, user_performed FROM log_indicadores WHERE (timestamp, id) < (%s, %s) ORDER BY timestamp DESC, id DESC LIMIT 100;",
+        "params": ("log_indicadores_cursor_timestamp", "log_indicadores_cursor_id"),
+    },
+    {
+        "nome": "Log de usuários (mais recentes)",
+        "sql": "SELECT timestamp, action, username_affected, user_performed FROM log_usuarios ORDER BY timestamp DESC, id DESC LIMIT 100;",
+        "params": (),
+    },
+    {
+        "nome": "Log de usuários (página seguinte, keyset)",
+        "sql": "SELECT id, timestamp, action, username_affected, user_performed FROM log_usuarios WHERE (timestamp, id) < (%s, %s) ORDER BY timestamp DESC, id DESC LIMIT 100;",
+        "params": ("log_usuarios_cursor_timestamp", "log_usuarios_cursor_id"),
+    },
+    {
+        "nome": "Perfil do usuário por username (authenticate)",
+        "sql": USER_PROFILE_SQL,
+        "params": ("username",),
+    },
+]
+
+
+def _seed_explain_data(cur, n):
+    """Gera n indicadores sintéticos, 36 meses de resultados para cada um e 50*n linhas em cada log."""
+    cur.execute("""
+        INSERT INTO indicadores (id, nome, formula, variaveis, unidade, meta, comparacao, tipo_grafico, responsavel)
+        SELECT 'explain_seed_' || g, 'Indicador sintético ' || g, 'a/b', '{}'::jsonb, '%%', 50,
+               'Maior é melhor', 'Linha', 'Setor sintético ' || (g %% 20)
+        FROM generate_series(1, %s) g;
+    """, (n,))
+    cur.execute("""
+        INSERT INTO resultados (indicator_id, data_referencia, resultado, usuario, status_analise)
+        SELECT 'explain_seed_' || g,
+               (date_trunc('month', CURRENT_DATE) - make_interval(months => m))::timestamp,
+               round((random() * 100)::numeric, 2), 'explain', 'N/A'
+        FROM generate_series(1, %s) g, generate_series(0, 35) m;
+    """, (n,))
+    refresh_indicator_summary(cur, [f"explain_seed_{g}" for g in range(1, n + 1)])
+    for table, column in (("log_backup", "file_name"), ("log_indicadores", "indicator_id"), ("log_usuarios", "username_affected")):
+        cur.execute(sql.SQL("""
+            INSERT INTO {} (timestamp, action, {}, user_performed)
+            SELECT CURRENT_TIMESTAMP - make_interval(mins => g), 'explain', 'explain_seed_' || g, 'explain'
+            FROM generate_series(1, %s) g;
+        """).format(sql.Identifier(table), sql.Identifier(column)), (n * 50,))
+    cur.execute("ANALYZE indicadores, resultados, indicator_summary, log_backup, log_indicadores, log_usuarios;")
+
+
+def _explain_samples(cur):
+    """Obtém do banco valores reais para os parâmetros das consultas canônicas."""
+    cur.execute("SELECT id FROM indicadores ORDER BY id LIMIT 5;")
+    indicator_ids = [row[0] for row in cur.fetchall()]
+    cur.execute("SELECT DISTINCT responsavel FROM indicadores WHERE responsavel IS NOT NULL ORDER BY responsavel LIMIT 2;")
+    setores = [row[0] for row in cur.fetchall()]
+    cur.execute("SELECT username FROM usuarios ORDER BY username LIMIT 1;")
+    row = cur.fetchone()
+    samples = {
+        "indicator_ids": indicator_ids[:1],
+        "setores": setores,
+        "status": ["Acima da Meta", "Abaixo da Meta"],
+        "busca": "%indicador%",
+        "username": row[0] if row else "admin",
+    }
+    # Cursor da segunda página de cada log (última entrada da primeira página), como o enviado por _load_audit_log
+    for table in AUDIT_LOG_TABLES:
+        cur.execute(sql.SQL("SELECT timestamp, id FROM {} ORDER BY timestamp DESC, id DESC OFFSET %s LIMIT 1;").format(
+            sql.Identifier(table)), (AUDIT_LOG_PAGE_SIZE - 1,))
+        cursor_row = cur.fetchone()
+        samples[f"{table}_cursor_timestamp"], samples[f"{table}_cursor_id"] = cursor_row if cursor_row else (datetime.now(), 0)
+    return samples
+
+
+def _plan_nodes(plan):
+    """Percorre recursivamente os nós de um plano JSON do EXPLAIN."""
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def explain_canonical_queries(seed=0):
+    """
+    Executa EXPLAIN (ANALYZE, FORMAT JSON) em cada consulta de CANONICAL_QUERIES.
+    seed > 0 gera dados sintéticos antes (ver _seed_explain_data). Tudo roda em uma única
+    transação desfeita ao final.
+    Retorna uma lista de dicionários com nome, tempo de execução, tipos de nó e varreduras sequenciais.
+    """
+    conn = get_db_connection()
+    if conn is None:
+        return []
+    cur = None
+    report = []
+    try:
+        cur = conn.cursor()
+        if seed > 0:
+            _seed_explain_data(cur, seed)
+        samples = _explain_samples(cur)
+        for query in CANONICAL_QUERIES:
+            params = tuple(samples[name] for name in query["params"])
+            cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query["sql"], params)
+            explained = cur.fetchone()[0][0]
+            nodes = list(_plan_nodes(explained["Plan"]))
+            report.append({
+                "nome": query["nome"],
+                "tempo_ms": explained.get("Execution Time", 0.0),
+                "nos": [node["Node Type"] for node in nodes],
+                "seq_scans": [node.get("Relation Name", "?") for node in nodes if node["Node Type"] == "Seq Scan"],
+            })
+        return report
+    except psycopg2.Error as e:
+        print(f"Erro ao analisar os planos de consulta: {e}")
+        return []
+    finally:
+        conn.rollback() # Desfaz os dados sintéticos (e as estatísticas geradas pelo ANALYZE)
+        if cur is not None: cur.close()
+        conn.close()
+
+
+def print_explain_report(report):
+    """Imprime o relatório de explain_canonical_queries. Retorna o número de consultas com varredura sequencial."""
+    flagged = 0
+    for item in report:
+        aviso = ""
+        if item["seq_scans"]:
+            flagged += 1
+            aviso = f"  <-- VARREDURA SEQUENCIAL em {', '.join(item['seq_scans'])}"
+        print(f"{item['nome']}: {item['tempo_ms']:.2f} ms [{' > '.join(item['nos'])}]{aviso}")
+    return flagged
+
+
+def run_cli(argv):
+    """Comandos de manutenção executados fora do Streamlit. Retorna o código de saída do processo."""
+    parser = argparse.ArgumentParser(prog="indicadores_scpc.py", description="Comandos de manutenção do Portal de Indicadores.")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+    subparsers.add_parser("migrate", help="Aplica as migrações de esquema pendentes.")
+    explain_parser = subparsers.add_parser("explain", help="Executa EXPLAIN ANALYZE nas consultas canônicas e aponta varreduras sequenciais.")
+    explain_parser.add_argument("--seed", type=int, default=0, metavar="N",
+                                help="Gera N indicadores sintéticos (com resultados e logs) antes da análise; os dados são descartados ao final.")
+    archive_parser = subparsers.add_parser("archive-logs", help="Arquiva e remove do banco as entradas antigas dos logs de auditoria.")
+    archive_parser.add_argument("--dias", type=int, default=365, help="Arquiva as entradas com mais de N dias (padrão: 365).")
+    args = parser.parse_args(argv)
+
+    if args.comando == "migrate":
+        ok = create_tables_if_not_exists()
+        for version, descricao, aplicada_em in get_schema_version():
+            print(f"Versão {version}: {descricao} (aplicada em {aplicada_em})")
+        print("Esquema atualizado." if ok else "Falha ao atualizar o esquema.")
+        return 0 if ok else 1
+
+    if args.comando == "explain":
+        report = explain_canonical_queries(seed=args.seed)
+        if not report:
+            return 1
+        flagged = print_explain_report(report)
+        print(f"{flagged} de {len(report)} consultas com varredura sequencial.")
+        return 1 if flagged else 0
+
+    if args.comando == "archive-logs":
+        archive_path, counts = archive_audit_logs(args.dias)
+        for table, count in counts.items():
+            print(f"{table}: {count} entradas arquivadas")
+        if archive_path:
+            print(f"Arquivo gerado: {archive_path}")
+        return 0 if counts else 1
+    return 1
+
+
 # --- Função Principal da Aplicação Streamlit ---
 
 def main():
@@ -4076,11 +6719,11 @@ def main():
 
 
     # --- Inicializa as tabelas do banco de dados ---
-    # Roda a função que cria tabelas se não existirem
-    create_tables_if_not_exists()
+    # Aplica as migrações pendentes uma única vez por processo (os reruns seguintes não acessam o banco)
+    ensure_schema()
 
     # Carrega configurações da aplicação (pode ser útil para temas, etc.)
-    app_config = load_config()
+    app_config = get_config_snapshot()
 
     # Define os ícones do menu
     MENU_ICONS = define_menu_icons()
@@ -4103,9 +6746,10 @@ def main():
         show_login_page()
         return # Sai da função main se não autenticado
 
-    # Se autenticado, carrega o tipo e setores do usuário logado no estado da sessão
-    # Isso foi movido para show_login_page após o login bem-sucedido.
-    # Apenas garantimos que existam no state, com fallbacks.
+    # Se autenticado, usa o tipo e setores do usuário logado guardados na sessão no login.
+    # O perfil só é relido do banco se o usuário foi alterado desde então.
+    if refresh_session_profile() is None:
+        logout() # O usuário foi excluído: encerra a sessão (banco indisponível mantém o perfil da sessão)
     user_type = st.session_state.get('user_type', 'Visualizador')
     user_sectors = st.session_state.get('user_sectors', []) # Pega a lista de setores
     username = st.session_state.get('username', 'Desconhecido')
@@ -4179,10 +6823,10 @@ def main():
 
     # Define os itens do menu baseados no tipo de usuário
     if user_type == "Administrador":
-        menu_items = ["Dashboard", "Criar Indicador", "Editar Indicador", "Preencher Indicador", "Visão Geral", "Configurações", "Gerenciar Usuários"]
+        menu_items = ["Dashboard", "Criar Indicador", "Editar Indicador", "Preencher Indicador", "Importar Resultados", "Visão Geral", "Configurações", "Gerenciar Usuários"]
     elif user_type == "Operador":
         # Operadores não podem criar/editar/gerenciar usuários/configurações
-        menu_items = ["Dashboard", "Preencher Indicador", "Visão Geral"]
+        menu_items = ["Dashboard", "Preencher Indicador", "Importar Resultados", "Visão Geral"]
         # Se a página atual não for permitida para Operador, redireciona para Dashboard
         if st.session_state.get('page') not in menu_items:
              st.session_state.page = "Dashboard"
@@ -4251,6 +6895,14 @@ def main():
             st.error("Você não tem permissão para acessar esta página.")
             st.session_state.page = "Dashboard"
             st.rerun()
+    elif st.session_state.page == "Importar Resultados":
+         # Verifica permissão (Admin ou Operador)
+        if user_type in ["Administrador", "Operador"]:
+            show_import_results()
+        else:
+            st.error("Você não tem permissão para acessar esta página.")
+            st.session_state.page = "Dashboard"
+            st.rerun()
     elif st.session_state.page == "Visão Geral":
         # Visualizadores e Operadores podem acessar, Admin também
         show_overview()
@@ -4293,5 +6945,8 @@ def main():
 
 
 # Ponto de entrada da aplicação Streamlit
+# Fora do Streamlit, "python indicadores_scpc.py <comando>" executa um comando de manutenção (ver run_cli).
 if __name__ == "__main__":
+    if not runtime.exists() and len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     main() # Chama a função principal para rodar a aplicação